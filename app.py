@@ -2,47 +2,160 @@
 
 from __future__ import unicode_literals
 
-import errno
+import time
+_IMPORT_START = time.perf_counter()
+
 import os
 import datetime
-import time
 import glob
 import sys
 import tempfile
+import shutil
+import io
+import mmap
+import array
+import struct
 import random
 import math
+import importlib
+import threading
+import collections
+import contextlib
+import hmac
+import heapq
+import bisect
+import itertools
+import functools
+import inspect
+import select
+import hashlib
+import gzip
+import json
+import atexit
+import signal
 import psycopg2
-import boto3
-import neologdn
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import concurrent.futures
+import requests
 import urllib.parse
 import urllib.request
-from PIL import Image
-from argparse import ArgumentParser
-from bs4 import BeautifulSoup
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify, send_file
 from linebot import (
     LineBotApi, WebhookHandler
 )
+from linebot.http_client import (
+    RequestsHttpClient, RequestsHttpResponse
+)
 from linebot.exceptions import (
     LineBotApiError, InvalidSignatureError
 )
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
     SourceUser, SourceGroup, SourceRoom,
-    TemplateSendMessage, ConfirmTemplate, MessageAction,
-    ButtonsTemplate, ImageCarouselTemplate, ImageCarouselColumn, URIAction,
-    PostbackAction, DatetimePickerAction,
-    CameraAction, CameraRollAction, LocationAction,
-    CarouselTemplate, CarouselColumn, PostbackEvent,
-    StickerMessage, StickerSendMessage, LocationMessage, LocationSendMessage,
-    ImageMessage, VideoMessage, AudioMessage, FileMessage,
-    UnfollowEvent, FollowEvent, JoinEvent, LeaveEvent, BeaconEvent,
+    TemplateSendMessage, MessageAction, URIAction,
+    CarouselTemplate, CarouselColumn,
+    ImageMessage, JoinEvent,
     FlexSendMessage, BubbleContainer, ImageComponent, BoxComponent,
     TextComponent, SpacerComponent, IconComponent, ButtonComponent,
-    SeparatorComponent, QuickReply, QuickReplyButton,
     ImageSendMessage
 )
 
+
+#重いモジュールは初回利用時に読み込む
+import_profile = {}
+
+
+class _Lazy_Module:
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            # 最初の利用が同時に来ても読み込みとログは1回だけ
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    elapsed = time.perf_counter() - start
+                    import_profile[self._name] = elapsed
+                    self._module = module
+
+                    print('[Import Log] lazy_import'
+                        + ' module=' + self._name
+                        + ' elapsed=' + '{:.3f}'.format(elapsed)
+                    )
+
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+boto3 = _Lazy_Module('boto3')
+boto3_s3_transfer = _Lazy_Module('boto3.s3.transfer')
+neologdn = _Lazy_Module('neologdn')
+bs4 = _Lazy_Module('bs4')
+Image = _Lazy_Module('PIL.Image')
+botocore_config = _Lazy_Module('botocore.config')
+botocore_exceptions = _Lazy_Module('botocore.exceptions')
+
+
+class _Metrics:
+    _SAMPLES = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._latencies = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self._counters[name + '.count'] += 1
+            samples = self._latencies.get(name)
+            if samples is None:
+                samples = collections.deque(maxlen=self._SAMPLES)
+                self._latencies[name] = samples
+            samples.append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            latencies_tp = [(name, sorted(samples)) for name, samples in self._latencies.items()]
+
+        latencies = {}
+        for name, samples in latencies_tp:
+            if not samples:
+                continue
+            latencies[name] = {
+                'samples': len(samples),
+                'avg': sum(samples) / len(samples),
+                'p50': samples[int(len(samples) * 0.50)],
+                'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                'max': samples[-1],
+            }
+
+        return {'counters': counters, 'latencies': latencies}
+
+
+metrics = _Metrics()
+
 app = Flask(__name__)
 
 # get CHANNEL_SECRET and CHANNEL_ACCESS_TOKEN from your environment variable
@@ -55,11 +168,432 @@ if CHANNEL_ACCESS_TOKEN is None:
     print('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
     sys.exit(1)
 
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(CHANNEL_SECRET)
+LINE_CONNECT_TIMEOUT = float(os.getenv('LINE_CONNECT_TIMEOUT', '3.05'))
+LINE_READ_TIMEOUT = float(os.getenv('LINE_READ_TIMEOUT', '10'))
+LINE_POOL_MAXSIZE = int(os.getenv('LINE_POOL_MAXSIZE', '10'))
+LINE_CONTENT_CHUNK_SIZE = int(os.getenv('LINE_CONTENT_CHUNK_SIZE', str(64 * 1024)))
+
+LINE_REPLY_TOKEN_TTL = float(os.getenv('LINE_REPLY_TOKEN_TTL', '50'))
+LINE_RETRY_MAX_ATTEMPTS = int(os.getenv('LINE_RETRY_MAX_ATTEMPTS', '5'))
+LINE_RETRY_QUEUE_SIZE = int(os.getenv('LINE_RETRY_QUEUE_SIZE', '100'))
+
+WEBHOOK_DEDUP_TTL = float(os.getenv('WEBHOOK_DEDUP_TTL', '600'))
+WEBHOOK_DEDUP_MAX_SIZE = int(os.getenv('WEBHOOK_DEDUP_MAX_SIZE', '10000'))
+WEBHOOK_DEDUP_SHARED = os.getenv('WEBHOOK_DEDUP_SHARED', 'False')
+
+FLOOD_CONTROL = os.getenv('FLOOD_CONTROL', 'False')
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', '0.5'))
+FLOOD_BURST = float(os.getenv('FLOOD_BURST', '5'))
+FLOOD_COALESCE_WINDOW = float(os.getenv('FLOOD_COALESCE_WINDOW', '5'))
+FLOOD_ADMIN_RATE = float(os.getenv('FLOOD_ADMIN_RATE', str(1.0 / 300)))
+FLOOD_ADMIN_BURST = float(os.getenv('FLOOD_ADMIN_BURST', '1'))
+
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', None)
+
+
+class _Line_Http_Client(RequestsHttpClient):
+
+    def __init__(self, timeout=(LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT)):
+        super(_Line_Http_Client, self).__init__(timeout=timeout)
+
+        # keep-aliveで接続を使い回す
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=2, pool_maxsize=LINE_POOL_MAXSIZE)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _endpoint_name(self, url):
+        path = urllib.parse.urlparse(url).path
+        names = []
+        for name in path.split('/'):
+            if name.isdigit() or len(name) >= 20:
+                name = '{id}'
+            names.append(name)
+
+        return '/'.join(names)
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+
+        name = 'line_api ' + method + ' ' + self._endpoint_name(url)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            metrics.incr(name + '.error')
+            raise
+        finally:
+            metrics.observe(name, time.perf_counter() - start)
+
+        metrics.incr(name + '.' + str(response.status_code))
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, timeout=timeout,
+            headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, timeout=timeout,
+            headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, timeout=timeout,
+            headers=headers, data=data)
+
+
+def create_line_bot_api(http_client=_Line_Http_Client):
+    return LineBotApi(
+        CHANNEL_ACCESS_TOKEN,
+        timeout=(LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT),
+        http_client=http_client)
+
+
+line_bot_api = create_line_bot_api()
+
+class _TTL_Cache:
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def _evict(self, now):
+        while self._items:
+            (key, (expires_at, _)) = next(iter(self._items.items()))
+            if expires_at > now and len(self._items) <= self.max_size:
+                break
+            del self._items[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] <= time.time():
+                return default
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.time()
+            self._items.pop(key, None)
+            self._items[key] = (now + self.ttl, value)
+            self._evict(now)
+
+    def add(self, key, value=True):
+        with self._lock:
+            now = time.time()
+            item = self._items.get(key)
+            if item is not None and item[0] > now:
+                return False
+
+            self._items.pop(key, None)
+            self._items[key] = (now + self.ttl, value)
+            self._evict(now)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+class _Event_Dedup:
+    _CLEANUP_INTERVAL = 60
+
+    _sql_insert = 'INSERT INTO public.webhook_events(event_key, received_at) \
+                    VALUES (%s, current_timestamp) \
+                    ON CONFLICT (event_key) DO NOTHING;'
+
+    _sql_cleanup = 'DELETE FROM public.webhook_events \
+                    WHERE received_at < current_timestamp - %s * INTERVAL \'1 second\';'
+
+    _sql_delete = 'DELETE FROM public.webhook_events \
+                    WHERE event_key = %s;'
+
+    def __init__(self, max_size=WEBHOOK_DEDUP_MAX_SIZE, ttl=WEBHOOK_DEDUP_TTL,
+            shared=(WEBHOOK_DEDUP_SHARED == 'True')):
+        self.seen = _TTL_Cache(max_size, ttl)
+        self.shared = shared
+        self._cleanup_at = 0
+
+    def event_key(self, event):
+        event_id = getattr(event, 'webhook_event_id', None)
+        if event_id:
+            return 'id:' + event_id
+
+        reply_token = getattr(event, 'reply_token', None)
+        if reply_token:
+            return 'reply:' + reply_token
+
+        message = getattr(event, 'message', None)
+        if message is not None and getattr(message, 'id', None):
+            return 'message:' + str(message.id)
+
+        user_id, group_id, room_id = get_line_id(event)
+        return ('event:' + str(getattr(event, 'type', ''))
+            + ':' + str(getattr(event, 'timestamp', ''))
+            + ':' + (group_id or room_id or user_id))
+
+    def first_seen(self, event):
+        key = self.event_key(event)
+        if not self.seen.add(key):
+            return False
+
+        if self.shared:
+            return self._first_seen_shared(key)
+
+        return True
+
+    def _first_seen_shared(self, key):
+        # 共有ストアが使えない時は処理を続ける
+        try:
+            with _db_connect() as conn:
+                with conn.cursor() as curs:
+
+                    curs.execute(self._sql_insert, (key,))
+                    inserted = curs.rowcount
+
+                    now = time.time()
+                    if now >= self._cleanup_at:
+                        self._cleanup_at = now + self._CLEANUP_INTERVAL
+                        curs.execute(self._sql_cleanup, (self.seen.ttl,))
+
+                    conn.commit()
+
+        except (psycopg2.Error, _Dependency_Unavailable) as e:
+            print('[Except Log] _Event_Dedup._first_seen_shared error=' + repr(e))
+            return True
+
+        return 0 < inserted
+
+    def forget(self, event):
+        # 処理に失敗したイベントはLINEの再送で処理し直せるように印を消す
+        key = self.event_key(event)
+        self.seen.discard(key)
+
+        if not self.shared:
+            return
+
+        try:
+            with _db_connect() as conn:
+                with conn.cursor() as curs:
+                    curs.execute(self._sql_delete, (key,))
+                conn.commit()
+
+        except (psycopg2.Error, _Dependency_Unavailable) as e:
+            print('[Except Log] _Event_Dedup.forget error=' + repr(e))
+
+
+event_dedup = _Event_Dedup()
+
+
+class _Token_Bucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        else:
+            return False
+
+
+class _Flood_Control:
+    _MAX_BUCKETS = 10000
+
+    def __init__(self, enabled=(FLOOD_CONTROL == 'True'),
+            rate=FLOOD_RATE, burst=FLOOD_BURST, coalesce_window=FLOOD_COALESCE_WINDOW,
+            admin_rate=FLOOD_ADMIN_RATE, admin_burst=FLOOD_ADMIN_BURST):
+        self.enabled = enabled
+        self.rate = rate
+        self.burst = burst
+        self.admin_rate = admin_rate
+        self.admin_burst = admin_burst
+
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+        self._recent_texts = _TTL_Cache(self._MAX_BUCKETS, coalesce_window)
+
+    def source_key(self, event):
+        user_id, group_id, room_id = get_line_id(event)
+        return group_id or room_id or user_id
+
+    def sender_key(self, event):
+        # グループでは発言者ごとに数える（別の人の同じ発言はまとめない）
+        user_id, group_id, room_id = get_line_id(event)
+        return (group_id or room_id or user_id) + '/' + user_id
+
+    def _take(self, key, rate, burst):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = _Token_Bucket(rate, burst)
+                self._buckets[key] = bucket
+                if len(self._buckets) > self._MAX_BUCKETS:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+
+            return bucket.take(time.monotonic())
+
+    def allow(self, event):
+        if not self.enabled:
+            return True
+
+        if self._take(('message', self.sender_key(event)), self.rate, self.burst):
+            return True
+
+        metrics.incr('flood_control.throttled')
+        return False
+
+    def coalesce(self, event, textn):
+        if not self.enabled:
+            return False
+
+        # 同じ発言の連投は最初の1回だけ返信する
+        if self._recent_texts.add((self.sender_key(event), textn)):
+            return False
+
+        metrics.incr('flood_control.coalesced')
+        return True
+
+    def allow_admin(self, event, command):
+        if not self.enabled:
+            return True
+
+        key = ('admin', command, self.source_key(event))
+        if self._take(key, self.admin_rate, self.admin_burst):
+            return True
+
+        metrics.incr('flood_control.admin_throttled')
+        return False
+
+
+flood_control = _Flood_Control()
+
+
+class _Nekobot_Webhook_Handler(WebhookHandler):
+
+    def handle(self, body, signature):
+        events = self.parser.parse(body, signature)
+
+        # 同じ送信元のイベントは順番に、別の送信元同士は並行に処理する
+        sources = collections.OrderedDict()
+        for event in self._accepted(events):
+            sources.setdefault(self._source_key(event), []).append(event)
+
+        # 返信の期限はWebhookを受け取った時点から数える
+        with latency_budget.start():
+            errors = webhook_fan_out.run(
+                *[functools.partial(self._dispatch_all, source_events) for source_events in sources.values()])
+
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def _source_key(self, event):
+        if getattr(event, 'source', None) is None:
+            return ''
+        return flood_control.source_key(event)
+
+    def _dispatch_all(self, events):
+        # 1件失敗しても同じ送信元の残りは処理する
+        error = None
+        for event in events:
+            try:
+                self.dispatch(event)
+            except Exception as e:
+                print('[Except Log] _Nekobot_Webhook_Handler.dispatch error=' + repr(e))
+                event_dedup.forget(event)
+                error = error or e
+
+        return error
+
+    def _accepted(self, events):
+        for event in events:
+            if not event_dedup.first_seen(event):
+                metrics.incr('webhook.duplicate')
+                print('[Event Log]'
+                    + ' duplicate_event'
+                    + ' key=' + event_dedup.event_key(event)
+                )
+                continue
+
+            if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+                if not flood_control.allow(event):
+                    print('[Event Log]'
+                        + ' throttled_event'
+                        + ' sender=' + flood_control.sender_key(event)
+                    )
+                    continue
+
+                if flood_control.coalesce(event, my_normalize(event.message.text)):
+                    print('[Event Log]'
+                        + ' coalesced_event'
+                        + ' sender=' + flood_control.sender_key(event)
+                    )
+                    continue
+
+            yield event
+
+    @staticmethod
+    def _handler_key(event, message=None):
+        if message is None:
+            return event.__name__
+        else:
+            return event.__name__ + '_' + message.__name__
+
+    def dispatch(self, event):
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(
+                self._handler_key(event.__class__, event.message.__class__), None)
+
+        if func is None:
+            func = self._handlers.get(self._handler_key(event.__class__), None)
+
+        if func is None:
+            func = self._default
+
+        if func is None:
+            return
+
+        with dictionary_snapshots.pinned(), latency_budget.start():
+            if len(inspect.signature(func).parameters) == 0:
+                func()
+            else:
+                func(event)
+
+
+handler = _Nekobot_Webhook_Handler(CHANNEL_SECRET)
 
 AP_URL = 'https://nekobot-line.herokuapp.com'
 DB_URL = os.getenv('DATABASE_URL', None)
+DICTIONARY_TTL = float(os.getenv('DICTIONARY_TTL', '60'))
+DICTIONARY_POLL_SECOND = float(os.getenv('DICTIONARY_POLL_SECOND', '5'))
+DICTIONARY_LISTEN = os.getenv('DICTIONARY_LISTEN', 'False')
+DICTIONARY_FILE = os.getenv('DICTIONARY_FILE', None)
+DICTIONARY_MODE = os.getenv('DICTIONARY_MODE', 'snapshot')
+EXTRACTION_CACHE_SIZE = int(os.getenv('EXTRACTION_CACHE_SIZE', '4096'))
+FAN_OUT_WORKERS = int(os.getenv('FAN_OUT_WORKERS', '8'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
 
 AWS_S3_BUCKET_NAME = os.getenv('AWS_S3_BUCKET_NAME', None)
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID', None)
@@ -67,6 +601,446 @@ AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY', None)
 
 static_tmp_path = os.path.join(os.path.dirname(__file__), 'static', 'tmp')
 
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', 'False')
+WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', '100'))
+WRITE_BEHIND_FLUSH_SECOND = float(os.getenv('WRITE_BEHIND_FLUSH_SECOND', '2'))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '5000'))
+EVENT_LOG_DB = os.getenv('EVENT_LOG_DB', 'False')
+EVENT_STORE_DIR = os.getenv('EVENT_STORE_DIR', '')
+EVENT_STORE_SEGMENT_ROWS = int(os.getenv('EVENT_STORE_SEGMENT_ROWS', '50000'))
+EVENT_STORE_SEGMENT_SECOND = float(os.getenv('EVENT_STORE_SEGMENT_SECOND', '3600'))
+EVENT_STORE_FLUSH_SECOND = float(os.getenv('EVENT_STORE_FLUSH_SECOND', '2'))
+EVENT_STORE_MAX_PENDING = int(os.getenv('EVENT_STORE_MAX_PENDING', '10000'))
+
+IMAGE_DEDUP = os.getenv('IMAGE_DEDUP', 'True')
+IMAGE_DEDUP_THRESHOLD = int(os.getenv('IMAGE_DEDUP_THRESHOLD', '6'))
+
+RANDOM_VALUES_RETENTION = int(os.getenv('RANDOM_VALUES_RETENTION', '500'))
+RANDOM_VALUES_RETENTION_CATEGORIES = os.getenv('RANDOM_VALUES_RETENTION_CATEGORIES', '')
+
+IMAGE_PROXY = os.getenv('IMAGE_PROXY', 'False')
+IMAGE_PROXY_SECRET = os.getenv('IMAGE_PROXY_SECRET', CHANNEL_SECRET or '')
+IMAGE_PROXY_EXPIRES = int(os.getenv('IMAGE_PROXY_EXPIRES', '259200'))
+IMAGE_PROXY_PREFIXES = tuple(os.getenv('IMAGE_PROXY_PREFIXES', 'image/,thumb/image/').split(','))
+IMAGE_PROXY_MAX_AGE = int(os.getenv('IMAGE_PROXY_MAX_AGE', str(365 * 24 * 60 * 60)))
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(static_tmp_path, 'imgcache'))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+TABELOG_ARCHIVE_DIR = os.getenv('TABELOG_ARCHIVE_DIR', '')
+TABELOG_ARCHIVE_S3_PREFIX = os.getenv('TABELOG_ARCHIVE_S3_PREFIX', '')
+
+EVENT_LATENCY_BUDGET = float(os.getenv('EVENT_LATENCY_BUDGET', '10'))
+DB_CONNECT_TIMEOUT = float(os.getenv('DB_CONNECT_TIMEOUT', '3'))
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', '5000'))
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', '2'))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', '5'))
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', '2'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET_SECOND = float(os.getenv('BREAKER_RESET_SECOND', '30'))
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '5'))
+IMAGE_KEYS_TTL = float(os.getenv('IMAGE_KEYS_TTL', '60'))
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', '20'))
+
+
+class _Dependency_Unavailable(Exception):
+    pass
+
+
+class _Circuit_Breaker:
+
+    def __init__(self, name, is_failure, failures=BREAKER_FAILURES, reset_second=BREAKER_RESET_SECOND):
+        self.name = name
+        self.is_failure = is_failure
+        self.failures = failures
+        self.reset_second = reset_second
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        elif self._trial or time.time() - self._opened_at < self.reset_second:
+            return 'open'
+        else:
+            return 'half_open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if self._trial or time.time() - self._opened_at < self.reset_second:
+                return False
+
+            # 一定時間経ったら1件だけ試しに通す
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print('[Event Log] circuit_breaker close name=' + self.name)
+
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if not self._trial and self._failures < self.failures:
+                return
+
+            if self._opened_at is None or self._trial:
+                metrics.incr('breaker.' + self.name + '.open')
+                print('[Event Log] circuit_breaker open'
+                    + ' name=' + self.name
+                    + ' failures=' + str(self._failures)
+                )
+
+            self._opened_at = time.time()
+            self._trial = False
+
+    @contextlib.contextmanager
+    def guard(self):
+        if not self.allow():
+            metrics.incr('breaker.' + self.name + '.rejected')
+            raise _Dependency_Unavailable(self.name + ' circuit open')
+
+        try:
+            yield
+        except Exception as e:
+            # 依存先が応答しているエラーは失敗に数えない
+            if self.is_failure(e):
+                self.failure()
+            else:
+                self.success()
+            raise
+        else:
+            self.success()
+
+    def get_status(self):
+        return {'state': self.state, 'failures': self._failures}
+
+
+class _Latency_Budget:
+
+    def __init__(self, seconds=EVENT_LATENCY_BUDGET):
+        self.seconds = seconds
+        self._local = threading.local()
+
+    def deadline(self):
+        return getattr(self._local, 'deadline', None)
+
+    @contextlib.contextmanager
+    def start(self, deadline=None):
+        previous = self.deadline()
+        if deadline is None:
+            deadline = previous or time.time() + self.seconds
+
+        self._local.deadline = deadline
+        try:
+            yield deadline
+        finally:
+            self._local.deadline = previous
+
+    def timeout(self, limit):
+        # イベント処理中でなければ依存先ごとの上限だけ
+        deadline = self.deadline()
+        if deadline is None:
+            return limit
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            metrics.incr('budget.exceeded')
+            raise _Dependency_Unavailable('latency budget exceeded')
+
+        return min(limit, remaining)
+
+
+class _Last_Known_Good:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def call(self, key, func, default=None):
+        try:
+            value = func()
+
+        except Exception as e:
+            metrics.incr('fallback.' + key.split(':')[0])
+            print('[Except Log] last_known_good'
+                + ' key=' + key
+                + ' error=' + repr(e)
+            )
+            with self._lock:
+                return self._values.get(key, default)
+
+        with self._lock:
+            self._values[key] = value
+        return value
+
+
+def _is_http_failure(e):
+    return isinstance(e, OSError) and getattr(e, 'code', 500) >= 500
+
+
+def _is_s3_failure(e):
+    if isinstance(e, botocore_exceptions.ClientError):
+        return e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) >= 500
+    return isinstance(e, botocore_exceptions.BotoCoreError)
+
+
+db_breaker = _Circuit_Breaker('db', lambda e: isinstance(e, psycopg2.OperationalError))
+s3_breaker = _Circuit_Breaker('s3', _is_s3_failure)
+http_breaker = _Circuit_Breaker('http', _is_http_failure)
+latency_budget = _Latency_Budget()
+last_known_good = _Last_Known_Good()
+
+
+def _connect_db(connect_timeout, statement_timeout):
+    return psycopg2.connect(DB_URL,
+        # libpqは秒単位で2秒未満を受け付けない
+        connect_timeout=max(2, int(math.ceil(connect_timeout))),
+        options='-c statement_timeout=' + str(int(statement_timeout)))
+
+
+class _DB_Pool:
+
+    def __init__(self, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX):
+        self.min_size = min_size
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_size))
+        self._pool = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _get_pool(self):
+        # fork後の子プロセスでは親の接続を使わない
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.min_size, self.max_size, DB_URL,
+                        connect_timeout=max(2, int(math.ceil(DB_CONNECT_TIMEOUT))),
+                        options='-c statement_timeout=' + str(DB_STATEMENT_TIMEOUT))
+                    self._pid = os.getpid()
+        return self._pool
+
+    @contextlib.contextmanager
+    def connection(self, connect_timeout, statement_timeout):
+        # 上限を超えたらPoolErrorではなく空きを待つ
+        if not self._slots.acquire(timeout=connect_timeout):
+            metrics.incr('db_pool.exhausted')
+            raise _Dependency_Unavailable('db pool exhausted')
+
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            broken = False
+            try:
+                with conn:
+                    # 残りの予算が短い時だけこのトランザクションの上限を下げる
+                    if statement_timeout < DB_STATEMENT_TIMEOUT:
+                        with conn.cursor() as curs:
+                            curs.execute('SET LOCAL statement_timeout = %s;', (int(statement_timeout),))
+                    yield conn
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+
+            finally:
+                pool.putconn(conn, close=broken or bool(conn.closed))
+
+        finally:
+            self._slots.release()
+
+    def warm(self):
+        # 最小数までの接続を先に張っておく
+        with contextlib.ExitStack() as stack:
+            for _ in range(max(1, self.min_size)):
+                conn = stack.enter_context(self.connection(DB_CONNECT_TIMEOUT, DB_STATEMENT_TIMEOUT))
+                with conn.cursor() as curs:
+                    curs.execute('SELECT 1;')
+
+    def get_status(self):
+        pool = self._pool
+        return {
+            'enabled': self.enabled,
+            'max_size': self.max_size,
+            'idle': len(pool._pool) if pool is not None else 0,
+            'in_use': len(pool._used) if pool is not None else 0,
+        }
+
+
+db_pool = _DB_Pool()
+
+
+@contextlib.contextmanager
+def _db_connect(statement_timeout=DB_STATEMENT_TIMEOUT):
+    connect_timeout = latency_budget.timeout(DB_CONNECT_TIMEOUT)
+    if statement_timeout:
+        statement_timeout = latency_budget.timeout(statement_timeout / 1000.0) * 1000
+
+    with db_breaker.guard():
+        # 上限なしのバッチ処理はプールを使わない
+        if db_pool.enabled and statement_timeout:
+            with db_pool.connection(connect_timeout, statement_timeout) as conn:
+                yield conn
+            return
+
+        conn = _connect_db(connect_timeout, statement_timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class _S3_Clients:
+    """client/resourceの生成は重いので、丸めたタイムアウトの組ごとに使い回す"""
+
+    _STEP = 0.25
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._local = threading.local()
+        self._pid = None
+
+    def _timeouts(self):
+        # 残り時間を切り下げて丸めるので期限は越えない（最小でも1刻み）
+        return tuple(max(self._STEP, math.floor(latency_budget.timeout(limit) / self._STEP) * self._STEP)
+            for limit in (S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT))
+
+    def _config(self, timeouts):
+        return botocore_config.Config(
+            connect_timeout=timeouts[0],
+            read_timeout=timeouts[1],
+            retries={'max_attempts': S3_MAX_ATTEMPTS})
+
+    def _check_pid(self):
+        # fork後の子プロセスでは親の接続を使わない
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._clients = {}
+                    self._local = threading.local()
+                    self._pid = os.getpid()
+
+    def client(self):
+        self._check_pid()
+        timeouts = self._timeouts()
+
+        client = self._clients.get(timeouts)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(timeouts)
+                if client is None:
+                    client = boto3.client('s3', config=self._config(timeouts))
+                    self._clients[timeouts] = client
+        return client
+
+    def resource(self):
+        # resourceはスレッド間で共有できないのでスレッドごとに持つ
+        self._check_pid()
+        timeouts = self._timeouts()
+
+        resources = getattr(self._local, 'resources', None)
+        if resources is None:
+            resources = self._local.resources = {}
+
+        resource = resources.get(timeouts)
+        if resource is None:
+            with self._lock:
+                resource = boto3.resource('s3', config=self._config(timeouts))
+            resources[timeouts] = resource
+        return resource
+
+    def get_status(self):
+        return {'clients': len(self._clients)}
+
+
+s3_clients = _S3_Clients()
+
+
+def get_s3_client():
+    return s3_clients.client()
+
+
+def get_s3_resource():
+    return s3_clients.resource()
+
+
+def http_urlopen(url):
+    timeout = latency_budget.timeout(HTTP_TIMEOUT)
+    with http_breaker.guard():
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read()
+
+
+class _Database_Lookup:
+    """テキストの部分文字列を列挙して example / synonym のインデックスを引く"""
+
+    _TABLES = {
+        'intent': ('public.intents', 'example'),
+        'entity': ('public.entities', 'synonym'),
+    }
+
+    _sql_select = 'SELECT id, name, {column}, weight, POSITION({column} IN %s) \
+                    FROM {table} \
+                    WHERE {column} = ANY(%s) \
+                    ORDER BY weight DESC;'
+
+    _sql_max_length = 'SELECT COALESCE(MAX(CHAR_LENGTH({column})), 0) \
+                    FROM {table};'
+
+    def __init__(self, ttl=DICTIONARY_TTL):
+        self._max_lengths = _TTL_Cache(len(self._TABLES), ttl)
+
+    def sql(self, kind, table=None):
+        (default_table, column) = self._TABLES[kind]
+        return self._sql_select.format(table=table or default_table, column=column)
+
+    def candidates(self, text, max_length):
+        # 登録されている最長の語より長い部分文字列は引かない
+        return sorted({
+            text[start:end]
+            for start in range(len(text))
+            for end in range(start + 1, min(len(text), start + max_length) + 1)
+        })
+
+    def max_length(self, kind, curs):
+        max_length = self._max_lengths.get(kind)
+        if max_length is None:
+            (table, column) = self._TABLES[kind]
+            curs.execute(self._sql_max_length.format(table=table, column=column))
+            (max_length,) = curs.fetchone()
+            self._max_lengths.set(kind, max_length)
+        return max_length
+
+    def select(self, kind, text, curs):
+        candidates = self.candidates(text, self.max_length(kind, curs))
+        if not candidates:
+            return []
+
+        curs.execute(self.sql(kind), (text, candidates,))
+        return curs.fetchall()
+
+
+database_lookup = _Database_Lookup()
+
 
 class Intent:
     def __init__(self, target_text):
@@ -82,7 +1056,16 @@ class Intent:
         self.text = target_text
         return self
 
-    def check_intent(self, exact_match=False):
+    def check_intent(self, exact_match=False, dictionary=None):
+
+        if dictionary is not None:
+            extraction = Extraction(self.text, dictionary).extract()
+            intent = extraction.intent_exact if exact_match else extraction.intent
+            if intent.match:
+                self.match = True
+                (self.id, self.name, self.example, self.weight, self.position) = \
+                    (intent.id, intent.name, intent.example, intent.weight, intent.position)
+            return self
 
         if exact_match:
             sql = 'SELECT id, name, example, weight, POSITION(example IN %s) \
@@ -90,18 +1073,17 @@ class Intent:
                     WHERE example = %s \
                     ORDER BY weight DESC;'
 
-        else:
-            sql = 'SELECT id, name, example, weight, POSITION(example IN %s) \
-                    FROM public.intents \
-                    WHERE 0 < POSITION(example IN %s) \
-                    ORDER BY weight DESC;'
-
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
-                curs.execute(sql, (self.text, self.text,))
-                if 0 < curs.rowcount:
-                    intent = curs.fetchone()
+                if exact_match:
+                    curs.execute(sql, (self.text, self.text,))
+                    intents = curs.fetchall()
+                else:
+                    intents = database_lookup.select('intent', self.text, curs)
+
+                if intents:
+                    intent = intents[0]
                     self.match = True
                 else:
                     intent = (0, 'Unknown', '', 0, 0)
@@ -109,6 +1091,11 @@ class Intent:
         (self.id, self.name, self.example, self.weight, self.position) = intent
         return self
 
+    def set_hit(self, hit):
+        self.match = True
+        (self.id, self.name, self.example, self.weight, self.position) = hit.get_row_tp()
+        return self
+
 
 class Entity:
     def __init__(self, target_text):
@@ -125,7 +1112,18 @@ class Entity:
         self.text = target_text
         return self
 
-    def check_entity(self, exact_match=False):
+    def check_entity(self, exact_match=False, dictionary=None):
+
+        if dictionary is not None:
+            extraction = Extraction(self.text, dictionary).extract()
+            entity = extraction.entity_exact if exact_match else extraction.entity_partial
+            if entity.match:
+                self.match = True
+                (self.id, self.name, self.synonym, self.weight, self.position, self.category) = \
+                    (entity.id, entity.name, entity.synonym, entity.weight, entity.position, entity.category)
+            else:
+                self.category = 'Unknown'
+            return self
 
         if exact_match:
             sql = 'SELECT id, name, synonym, weight, POSITION(synonym IN %s) \
@@ -133,18 +1131,17 @@ class Entity:
                     WHERE synonym = %s \
                     ORDER BY weight DESC;'
 
-        else:
-            sql = 'SELECT id, name, synonym, weight, POSITION(synonym IN %s) \
-                    FROM public.entities \
-                    WHERE 0 < POSITION(synonym IN %s) \
-                    ORDER BY weight DESC;'
-
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
-                curs.execute(sql, (self.text, self.text,))
-                if 0 < curs.rowcount:
-                    entity = curs.fetchone()
+                if exact_match:
+                    curs.execute(sql, (self.text, self.text,))
+                    entities = curs.fetchall()
+                else:
+                    entities = database_lookup.select('entity', self.text, curs)
+
+                if entities:
+                    entity = entities[0]
                     self.match = True
                 else:
                     entity = (0, 'Unknown', '', 0, 0)
@@ -162,7 +1159,7 @@ class Entity:
         
         if self.match:
 
-            with psycopg2.connect(DB_URL) as conn:
+            with _db_connect() as conn:
                 with conn.cursor() as curs:
 
                     curs.execute(sql, (self.name, ))
@@ -181,25 +1178,890 @@ class Entity:
         self.name = name
         return self
 
+    def set_hit(self, hit, category):
+        self.match = True
+        (self.id, self.name, self.synonym, self.weight, self.position) = hit.get_row_tp()
+        self.category = category
+        return self
 
-class Setting():
-
-    _sql_select = 'SELECT value \
-                    FROM public.settings \
-                    WHERE name = %s;'
 
-    _sql_update = 'UPDATE public.settings \
-                    SET value = %s \
-                    WHERE name = %s;'
+class _Matcher:
 
     def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+    def add(self, pattern, value):
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][ch] = next_state
+            state = next_state
+
+        self._out[state].append((len(pattern), value))
+        return self
 
-        self.enable_access_management = self._get_enable_access_management()
-        self.admin_line_users = self._get_admin_line_users()
-        self.current_upload_category = self._get_current_upload_category()
+    def build(self):
+        queue = collections.deque(self._goto[0].values())
 
-    def _get_enable_access_management(self):
-        with psycopg2.connect(DB_URL) as conn:
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+        return self
+
+    def iter_matches(self, text):
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+
+            for (length, value) in self._out[state]:
+                yield (i + 1 - length, i + 1, value)
+
+
+class _Dictionary:
+
+    _sql_intents = 'SELECT id, name, example, weight \
+                    FROM public.intents;'
+
+    _sql_entities = 'SELECT id, name, synonym, weight \
+                    FROM public.entities;'
+
+    _sql_categories = 'SELECT entity, name \
+                    FROM public.categories;'
+
+    _sql_replies = 'SELECT entity, reply_order, text \
+                    FROM public.replies;'
+
+    def __init__(self, version=0, source_version=None):
+        self.version = version
+        self.source_version = source_version
+        self.intents = []
+        self.entities = []
+        self.categories = {}
+        self.replies = {}
+        self.matcher = _Matcher()
+        self.built_at = 0
+        self.build_elapsed = 0
+
+    def load(self):
+        start = time.perf_counter()
+
+        with _db_connect() as conn:
+            with conn.cursor() as curs:
+
+                curs.execute(self._sql_intents)
+                self.intents = curs.fetchall()
+
+                curs.execute(self._sql_entities)
+                self.entities = curs.fetchall()
+
+                curs.execute(self._sql_categories)
+                for (entity, name) in curs.fetchall():
+                    self.categories.setdefault(entity, []).append(name)
+
+                curs.execute(self._sql_replies)
+                replies = {}
+                for (entity, reply_order, text) in curs.fetchall():
+                    replies.setdefault(entity, {}).setdefault(reply_order, []).append(text.strip())
+
+        for entity, orders in replies.items():
+            self.replies[entity] = [tuple(orders[order]) for order in sorted(orders)]
+
+        self.build()
+        self.build_elapsed = time.perf_counter() - start
+        return self
+
+    def build(self):
+        for row in self.intents:
+            if row[2]:
+                self.matcher.add(row[2], ('intent', row))
+
+        for row in self.entities:
+            if row[2]:
+                self.matcher.add(row[2], ('entity', row))
+
+        self.matcher.build()
+        self.built_at = time.time()
+        return self
+
+    def get_category(self, entity_name):
+        categories = self.categories.get(entity_name)
+        if categories:
+            return random.choice(categories)
+        else:
+            return 'Unknown'
+
+    def get_category_names(self):
+        return sorted({name for names in self.categories.values() for name in names})
+
+    def get_reply_texts(self, entity_name):
+        # reply_orderごとに1つをランダムに選ぶ
+        return [random.choice(texts) for texts in self.replies.get(entity_name, ())]
+
+    def get_s3_keys(self, prefix):
+        # S3の一覧は持っていないので毎回LISTする
+        return None
+
+    def get_status(self):
+        return {
+            'version': self.version,
+            'source_version': self.source_version,
+            'built_at': datetime.datetime.fromtimestamp(self.built_at).isoformat(),
+            'build_elapsed': self.build_elapsed,
+            'intents': len(self.intents),
+            'entities': len(self.entities),
+            'categories': len(self.categories),
+            'replies': len(self.replies),
+        }
+
+
+class _Dictionary_File:
+    _MAGIC = b'NEKODICT'
+    _FORMAT_VERSION = 1
+    _BYTE_ORDER = 0x01020304
+    _HEADER = struct.Struct('=8sIIqdI')
+    _SECTION = struct.Struct('=4sII')
+    _ALIGN = 8
+
+    _KINDS = ('intent', 'entity')
+
+    def __init__(self):
+        self._strings = []
+        self._string_ids = {}
+
+    def _intern(self, value):
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings.append(value)
+            self._string_ids[value] = string_id
+        return string_id
+
+    _INT_MIN = -2 ** 31
+    _INT_MAX = 2 ** 31 - 1
+
+    def _weight(self, row_id, name, weight):
+        # 行は32bit整数の配列に詰めるので入らない重みはここで止める
+        if weight is None:
+            return 0
+        try:
+            value = int(weight)
+        except (TypeError, ValueError):
+            value = None
+
+        if value is None or value != weight or not self._INT_MIN <= value <= self._INT_MAX:
+            raise ValueError('dictionary weight must be a 32-bit integer:'
+                + ' id=' + str(row_id) + ' name=' + str(name) + ' weight=' + repr(weight))
+        return value
+
+    def _rows(self, rows):
+        values = array.array('i')
+        for (row_id, name, pattern, weight) in rows:
+            values.extend((row_id, self._intern(name), self._intern(pattern or ''),
+                self._weight(row_id, name, weight)))
+        return values
+
+    def _matcher(self, dictionary):
+        row_index = {}
+        for (kind, rows) in ((0, dictionary.intents), (1, dictionary.entities)):
+            for (i, row) in enumerate(rows):
+                row_index[id(row)] = (kind, i)
+
+        nodes = array.array('I')
+        transitions = array.array('I')
+        outputs = array.array('I')
+
+        matcher = dictionary.matcher
+        for state in range(len(matcher._goto)):
+            goto = sorted((ord(ch), next_state) for ch, next_state in matcher._goto[state].items())
+            out = matcher._out[state]
+            nodes.extend((len(transitions) // 2, len(goto), matcher._fail[state], len(outputs) // 3, len(out)))
+
+            for (codepoint, next_state) in goto:
+                transitions.extend((codepoint, next_state))
+
+            for (length, (kind, row)) in out:
+                outputs.extend(row_index[id(row)] + (length,))
+
+        return nodes, transitions, outputs
+
+    def build(self, dictionary, s3_keys=None):
+        intents = self._rows(dictionary.intents)
+        entities = self._rows(dictionary.entities)
+
+        categories = sorted(
+            (self._intern(entity), self._intern(name))
+            for entity, names in dictionary.categories.items() for name in names)
+
+        replies = sorted(
+            (self._intern(entity), order, self._intern(text))
+            for entity, orders in dictionary.replies.items()
+            for order, texts in enumerate(orders) for text in texts)
+
+        keys = sorted(
+            (self._intern(prefix), self._intern(key))
+            for prefix, prefix_keys in (s3_keys or {}).items() for key in prefix_keys)
+
+        (nodes, transitions, outputs) = self._matcher(dictionary)
+
+        blob = bytearray()
+        offsets = array.array('I', [0])
+        for value in self._strings:
+            blob += value.encode('utf-8')
+            offsets.append(len(blob))
+
+        # 名前→文字列番号の二分探索用
+        sorted_ids = array.array('I', sorted(
+            range(len(self._strings)), key=lambda i: self._strings[i].encode('utf-8')))
+
+        sections = [
+            (b'STRB', bytes(blob)),
+            (b'STRO', offsets.tobytes()),
+            (b'STRS', sorted_ids.tobytes()),
+            (b'INTS', intents.tobytes()),
+            (b'ENTS', entities.tobytes()),
+            (b'CATS', array.array('I', [v for row in categories for v in row]).tobytes()),
+            (b'REPL', array.array('I', [v for row in replies for v in row]).tobytes()),
+            (b'S3KY', array.array('I', [v for row in keys for v in row]).tobytes()),
+            (b'NODE', nodes.tobytes()),
+            (b'TRAN', transitions.tobytes()),
+            (b'OUTP', outputs.tobytes()),
+        ]
+
+        source_version = dictionary.source_version
+        header = self._HEADER.pack(self._MAGIC, self._FORMAT_VERSION, self._BYTE_ORDER,
+            -1 if source_version is None else source_version, dictionary.built_at, len(sections))
+
+        offset = self._HEADER.size + self._SECTION.size * len(sections)
+        table = b''
+        body = b''
+        for (name, data) in sections:
+            padding = (-(offset + len(body))) % self._ALIGN
+            body += b'\0' * padding
+            table += self._SECTION.pack(name, offset + len(body), len(data))
+            body += data
+
+        return header + table + body
+
+    def write(self, path, dictionary, s3_keys=None):
+        data = self.build(dictionary, s3_keys)
+
+        # 書き込み中のファイルを読まれないようにrenameで置き換える
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        return len(data)
+
+
+class _Mapped_Matcher:
+
+    def __init__(self, mapped):
+        self._mapped = mapped
+        self._nodes = mapped.section('NODE', 'I')
+        self._transitions = mapped.section('TRAN', 'I')
+        self._outputs = mapped.section('OUTP', 'I')
+
+    def _next(self, state, codepoint):
+        lo = self._nodes[state * 5]
+        hi = lo + self._nodes[state * 5 + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self._transitions[mid * 2]
+            if value < codepoint:
+                lo = mid + 1
+            elif value > codepoint:
+                hi = mid
+            else:
+                return self._transitions[mid * 2 + 1]
+        return None
+
+    def iter_matches(self, text):
+        state = 0
+        for i, ch in enumerate(text):
+            codepoint = ord(ch)
+            next_state = self._next(state, codepoint)
+            while next_state is None and state:
+                state = self._nodes[state * 5 + 2]
+                next_state = self._next(state, codepoint)
+            state = next_state or 0
+
+            start = self._nodes[state * 5 + 3]
+            for j in range(start, start + self._nodes[state * 5 + 4]):
+                (kind, index, length) = self._outputs[j * 3:j * 3 + 3]
+                kind = _Dictionary_File._KINDS[kind]
+                yield (i + 1 - length, i + 1, (kind, self._mapped.row(kind, index)))
+
+
+class _Mapped_Dictionary:
+
+    def __init__(self, path, version=0):
+        self.path = path
+        self.version = version
+
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.file_id = (stat.st_ino, stat.st_mtime)
+        self._view = memoryview(self._mmap)
+
+        (magic, format_version, byte_order, source_version, built_at, count) = \
+            _Dictionary_File._HEADER.unpack_from(self._mmap, 0)
+        if magic != _Dictionary_File._MAGIC or format_version != _Dictionary_File._FORMAT_VERSION:
+            raise ValueError('unknown dictionary file ' + path)
+        if byte_order != _Dictionary_File._BYTE_ORDER:
+            raise ValueError('dictionary file byte order mismatch ' + path)
+
+        self.source_version = None if source_version < 0 else source_version
+        self.built_at = built_at
+        self.build_elapsed = 0
+
+        self._sections = {}
+        for i in range(count):
+            (name, offset, length) = _Dictionary_File._SECTION.unpack_from(
+                self._mmap, _Dictionary_File._HEADER.size + _Dictionary_File._SECTION.size * i)
+            self._sections[name.decode('ascii')] = (offset, length)
+
+        self._blob = self.section('STRB')
+        self._offsets = self.section('STRO', 'I')
+        self._sorted_ids = self.section('STRS', 'I')
+        self._intents = self.section('INTS', 'i')
+        self._entities = self.section('ENTS', 'i')
+        self._categories = self.section('CATS', 'I')
+        self._replies = self.section('REPL', 'I')
+        self._s3_keys = self.section('S3KY', 'I')
+        self.matcher = _Mapped_Matcher(self)
+
+    def section(self, name, fmt=None):
+        (offset, length) = self._sections[name]
+        view = self._view[offset:offset + length]
+        return view.cast(fmt) if fmt else view
+
+    def string(self, string_id):
+        return self._blob[self._offsets[string_id]:self._offsets[string_id + 1]].tobytes().decode('utf-8')
+
+    def _string_id(self, value):
+        target = value.encode('utf-8')
+        lo = 0
+        hi = len(self._sorted_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            string_id = self._sorted_ids[mid]
+            current = self._blob[self._offsets[string_id]:self._offsets[string_id + 1]].tobytes()
+            if current < target:
+                lo = mid + 1
+            elif current > target:
+                hi = mid
+            else:
+                return string_id
+        return None
+
+    def _range(self, rows, width, key):
+        # 先頭の列で昇順に並んだ行から key の範囲を探す
+        lo = 0
+        hi = len(rows) // width
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if rows[mid * width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        end = lo
+        while end < len(rows) // width and rows[end * width] == key:
+            end += 1
+
+        return [rows[i * width:(i + 1) * width].tolist() for i in range(lo, end)]
+
+    def row(self, kind, index):
+        rows = self._intents if kind == 'intent' else self._entities
+        (row_id, name, pattern, weight) = rows[index * 4:index * 4 + 4]
+        return (row_id, self.string(name), self.string(pattern), weight)
+
+    def _lookup(self, rows, width, name):
+        string_id = self._string_id(name)
+        if string_id is None:
+            return []
+        return self._range(rows, width, string_id)
+
+    def get_category(self, entity_name):
+        categories = self._lookup(self._categories, 2, entity_name)
+        if categories:
+            return self.string(random.choice(categories)[1])
+        else:
+            return 'Unknown'
+
+    def get_category_names(self):
+        return sorted({self.string(name) for name in self._categories[1::2]})
+
+    def get_reply_texts(self, entity_name):
+        orders = collections.OrderedDict()
+        for (_, order, text) in self._lookup(self._replies, 3, entity_name):
+            orders.setdefault(order, []).append(text)
+
+        return [self.string(random.choice(texts)) for texts in orders.values()]
+
+    def get_s3_keys(self, prefix):
+        keys = self._lookup(self._s3_keys, 2, prefix)
+        if not keys:
+            return None
+        return [self.string(key) for (_, key) in keys]
+
+    def get_status(self):
+        return {
+            'version': self.version,
+            'source_version': self.source_version,
+            'built_at': datetime.datetime.fromtimestamp(self.built_at).isoformat(),
+            'build_elapsed': self.build_elapsed,
+            'path': self.path,
+            'bytes': len(self._mmap),
+            'intents': len(self._intents) // 4,
+            'entities': len(self._entities) // 4,
+        }
+
+
+def build_dictionary_file(path, with_s3_keys=False):
+    dictionary = _Dictionary(0, dictionary_snapshots.source_version()).load()
+
+    s3_keys = {}
+    if with_s3_keys:
+        bulk = _S3_Bulk_Upload()
+        for category in sorted({name for names in dictionary.categories.values() for name in names}):
+            s3_keys[category] = sorted(
+                key for key in bulk.list_keys(category) if key.endswith('.jpg'))
+
+    size = _Dictionary_File().write(path, dictionary, s3_keys)
+    return dictionary, s3_keys, size
+
+
+class _Dictionary_Snapshots:
+    _CHANNEL = 'nekobot_dictionary'
+
+    _sql_version = 'SELECT version \
+                    FROM public.dictionary_version \
+                    WHERE id = 1;'
+
+    def __init__(self, poll_second=DICTIONARY_POLL_SECOND, ttl=DICTIONARY_TTL,
+            listen=(DICTIONARY_LISTEN == 'True'), path=DICTIONARY_FILE):
+        self.poll_second = poll_second
+        self.ttl = ttl
+        self.listen = listen
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._builds = itertools.count(1)
+        self._active = None
+        self._watcher = None
+        self._listen_conn = None
+        self._file_id = None
+        self.last_error = ''
+
+    def current(self):
+        pinned = getattr(self._local, 'snapshot', None)
+        if pinned is not None:
+            return pinned
+
+        snapshot = self._active
+        if snapshot is None:
+            with self._lock:
+                if self._active is None:
+                    self._active = self._build(self.source_version())
+                    self._start_watcher()
+                snapshot = self._active
+
+        return snapshot
+
+    @contextlib.contextmanager
+    def pinned(self, snapshot=None):
+        # 処理中のリクエストは開始時のバージョンを使い続ける
+        if getattr(self._local, 'snapshot', None) is not None:
+            yield self._local.snapshot
+            return
+
+        self._local.snapshot = snapshot or self.current()
+        try:
+            yield self._local.snapshot
+        finally:
+            self._local.snapshot = None
+
+    def reload(self):
+        snapshot = self._build(self.source_version())
+        self._swap(snapshot)
+        return snapshot
+
+    def _swap(self, snapshot):
+        self._active = snapshot
+        # 古い辞書の解析結果は二度と当たらないので捨てる
+        extraction_cache.clear()
+
+    def _use_file(self):
+        return bool(self.path) and os.path.exists(self.path)
+
+    def _build(self, source_version):
+        with metrics.timer('dictionary.build'):
+            snapshot = None
+            if self._use_file():
+                # ビルド済みのファイルを全プロセスで共有する
+                mapped = _Mapped_Dictionary(self.path, next(self._builds))
+                self._file_id = mapped.file_id
+
+                # DB側で辞書が更新されていたらファイルが作り直されるまでDBから読む
+                if source_version is None or mapped.source_version == source_version:
+                    snapshot = mapped
+                else:
+                    print('[Debug] _Dictionary_Snapshots stale file'
+                        + ' path=' + self.path
+                        + ' file_source_version=' + str(mapped.source_version)
+                        + ' source_version=' + str(source_version)
+                    )
+
+            if snapshot is None:
+                snapshot = _Dictionary(next(self._builds), source_version).load()
+
+        print('[Debug] _Dictionary_Snapshots build'
+            + ' version=' + str(snapshot.version)
+            + ' source_version=' + str(snapshot.source_version)
+            + ' elapsed=' + '{:.3f}'.format(snapshot.build_elapsed)
+        )
+        return snapshot
+
+    def source_version(self):
+        try:
+            with _db_connect() as conn:
+                with conn.cursor() as curs:
+
+                    curs.execute(self._sql_version)
+                    if 0 < curs.rowcount:
+                        (version,) = curs.fetchone()
+                    else:
+                        version = None
+
+        except (psycopg2.Error, _Dependency_Unavailable):
+            # dictionary_versionが無い環境では一定時間ごとに作り直す
+            version = None
+
+        return version
+
+    def _start_watcher(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(
+                target=self._watch, name='dictionary-watcher', daemon=True)
+            self._watcher.start()
+
+    def _wait(self):
+        if not self.listen:
+            time.sleep(self.poll_second)
+            return
+
+        if self._listen_conn is None:
+            self._listen_conn = psycopg2.connect(DB_URL, connect_timeout=int(DB_CONNECT_TIMEOUT))
+            self._listen_conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with self._listen_conn.cursor() as curs:
+                curs.execute('LISTEN ' + self._CHANNEL + ';')
+
+        if select.select([self._listen_conn], [], [], self.poll_second) != ([], [], []):
+            self._listen_conn.poll()
+            del self._listen_conn.notifies[:]
+
+    def _watch(self):
+        while True:
+            try:
+                self._wait()
+
+                active = self._active
+
+                source_version = self.source_version()
+                if self._use_file():
+                    stat = os.stat(self.path)
+                    changed = ((stat.st_ino, stat.st_mtime) != self._file_id
+                        or (source_version is not None and source_version != active.source_version))
+                elif source_version is None:
+                    changed = time.time() - active.built_at >= self.ttl
+                else:
+                    changed = source_version != active.source_version
+
+                if changed:
+                    self._swap(self._build(source_version))
+
+                self.last_error = ''
+
+            except Exception as e:
+                self.last_error = repr(e)
+                print('[Except Log] _Dictionary_Snapshots._watch error=' + repr(e))
+
+                if self._listen_conn is not None:
+                    try:
+                        self._listen_conn.close()
+                    except psycopg2.Error:
+                        pass
+                    self._listen_conn = None
+
+                time.sleep(self.poll_second)
+
+
+dictionary_snapshots = _Dictionary_Snapshots()
+
+
+class _Fan_Out:
+
+    def __init__(self, workers=FAN_OUT_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _call(self, snapshot, deadline, func):
+        # 呼び出し元と同じ辞書バージョン・同じ期限で動かす
+        with dictionary_snapshots.pinned(snapshot), latency_budget.start(deadline):
+            return func()
+
+    def run(self, *funcs):
+        if len(funcs) <= 1 or self.workers <= 1:
+            return [func() for func in funcs]
+
+        snapshot = dictionary_snapshots.current()
+        deadline = latency_budget.deadline()
+        futures = [self._get_executor().submit(self._call, snapshot, deadline, func) for func in funcs[1:]]
+
+        results = [funcs[0]()]
+        for (func, future) in zip(funcs[1:], futures):
+            # まだ始まっていなければ自分で実行する（入れ子の呼び出しでプールが詰まらないように）
+            if future.cancel():
+                results.append(func())
+            else:
+                results.append(future.result())
+
+        return results
+
+
+fan_out = _Fan_Out()
+webhook_fan_out = _Fan_Out(WEBHOOK_WORKERS)
+
+
+class _Hit:
+
+    def __init__(self, kind, row, start, end, exact):
+        (self.id, self.name, self.pattern, self.weight) = row
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.exact = exact
+
+    @property
+    def position(self):
+        return self.start + 1
+
+    def get_row_tp(self):
+        return (self.id, self.name, self.pattern, self.weight, self.position)
+
+
+class Extraction:
+
+    def __init__(self, target_text, dictionary=None):
+        self.text = target_text
+        self.dictionary = dictionary
+        self.intents = []
+        self.entities = []
+        self.intent = Intent(target_text)
+        self.intent_exact = Intent(target_text)
+        self.entity_exact = Entity(target_text)
+        self.entity_partial = Entity(target_text)
+
+    def _best(self, hits):
+        # weightが最大のもの、同じなら先に出現したもの
+        best = None
+        for hit in hits:
+            if best is None or (-hit.weight, hit.start, hit.id) < (-best.weight, best.start, best.id):
+                best = hit
+        return best
+
+    def _first_hits(self, hits):
+        # 同じ行の2回目以降の出現はPOSITIONと同じく無視する
+        first = collections.OrderedDict()
+        for hit in hits:
+            if (hit.kind, hit.id) not in first:
+                first[(hit.kind, hit.id)] = hit
+        return list(first.values())
+
+    def extract(self):
+        if self.dictionary is None:
+            self.dictionary = dictionary_snapshots.current()
+
+        cached = extraction_cache.get(self.text, self.dictionary)
+        if cached is not None:
+            return self._resolve(*cached)
+
+        with metrics.timer('extraction.match'):
+            for (start, end, (kind, row)) in self._iter_matches():
+                hit = _Hit(kind, row, start, end, start == 0 and end == len(self.text))
+                if kind == 'intent':
+                    self.intents.append(hit)
+                else:
+                    self.entities.append(hit)
+
+        self.intents.sort(key=lambda hit: (hit.start, hit.end))
+        self.entities.sort(key=lambda hit: (hit.start, hit.end))
+
+        intents = self._first_hits(self.intents)
+        entities = self._first_hits(self.entities)
+
+        picks = (
+            self._best(intents),
+            self._best([hit for hit in intents if hit.exact]),
+            self._best([hit for hit in entities if hit.exact]),
+            self._best(entities),
+        )
+
+        extraction_cache.set(self.text, self.dictionary, (tuple(self.intents), tuple(self.entities), picks))
+        return self._resolve(self.intents, self.entities, picks)
+
+    def _iter_matches(self):
+        if DICTIONARY_MODE != 'database':
+            return self.dictionary.matcher.iter_matches(self.text)
+
+        # DBで照合する場合は各行の最初の出現位置だけが分かる
+        matches = []
+        with _db_connect() as conn:
+            with conn.cursor() as curs:
+
+                for kind in ('intent', 'entity'):
+                    for (id, name, pattern, weight, position) in database_lookup.select(kind, self.text, curs):
+                        start = position - 1
+                        matches.append((start, start + len(pattern), (kind, (id, name, pattern, weight))))
+
+        return matches
+
+    def _resolve(self, intents, entities, picks):
+        self.intents = list(intents)
+        self.entities = list(entities)
+        (intent, intent_exact, entity_exact, entity_partial) = picks
+
+        if intent is not None:
+            self.intent.set_hit(intent)
+
+        if intent_exact is not None:
+            self.intent_exact.set_hit(intent_exact)
+
+        # categoryは毎回ランダムに選び直す
+        if entity_exact is not None:
+            self.entity_exact.set_hit(entity_exact,
+                self.dictionary.get_category(entity_exact.name))
+
+        if entity_partial is not None:
+            self.entity_partial.set_hit(entity_partial,
+                self.dictionary.get_category(entity_partial.name))
+
+        return self
+
+
+class _Extraction_Cache:
+
+    def __init__(self, max_size=EXTRACTION_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def _key(self, text, dictionary):
+        return (text, dictionary.version)
+
+    def get(self, text, dictionary):
+        if self.max_size <= 0:
+            return None
+
+        with self._lock:
+            item = self._items.get(self._key(text, dictionary))
+            # versionが同じでも別の辞書オブジェクトなら使わない
+            if item is None or item[0] is not dictionary:
+                metrics.incr('extraction.cache.miss')
+                return None
+
+            self._items.move_to_end(self._key(text, dictionary))
+
+        metrics.incr('extraction.cache.hit')
+        return item[1]
+
+    def set(self, text, dictionary, value):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._items[self._key(text, dictionary)] = (dictionary, value)
+            self._items.move_to_end(self._key(text, dictionary))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_status(self):
+        counters = metrics.snapshot()['counters']
+        hit = counters.get('extraction.cache.hit', 0)
+        miss = counters.get('extraction.cache.miss', 0)
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'hit': hit,
+            'miss': miss,
+            'hit_rate': hit / (hit + miss) if hit + miss else 0,
+        }
+
+
+extraction_cache = _Extraction_Cache()
+
+
+class Setting():
+
+    _sql_select = 'SELECT value \
+                    FROM public.settings \
+                    WHERE name = %s;'
+
+    _sql_update = 'UPDATE public.settings \
+                    SET value = %s \
+                    WHERE name = %s;'
+
+    def __init__(self):
+
+        # DBが使えない間は前回読めた設定を使う
+        self.enable_access_management = last_known_good.call(
+            'setting:enable_access_management', self._get_enable_access_management, 'True')
+        self.admin_line_users = last_known_good.call(
+            'setting:admin_line_users', self._get_admin_line_users, [])
+        self.current_upload_category = last_known_good.call(
+            'setting:current_upload_category', self._get_current_upload_category, '')
+
+    def _get_enable_access_management(self):
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(self._sql_select, ('enable_access_management',))
@@ -211,7 +2073,7 @@ class Setting():
         return enable_access_management
 
     def _get_admin_line_users(self):
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(self._sql_select, ('admin_line_user',))
@@ -228,7 +2090,7 @@ class Setting():
         return admin_line_users
 
     def _get_current_upload_category(self):
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(self._sql_select, ('current_upload_category',))
@@ -240,7 +2102,7 @@ class Setting():
         return current_upload_category
 
     def update_enable_access_management(self,value):
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(self._sql_update, (value, 'enable_access_management',))
@@ -251,7 +2113,7 @@ class Setting():
         return self
 
     def update_current_upload_category(self,value):
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(self._sql_update, (value, 'current_upload_category',))
@@ -306,6 +2168,122 @@ class _Tabelog_Value:
     def get_value_tp(self):
         return (self.name, self.image_key, self.url, self.score, self.station, self.genre, self.hours)
         
+class _Tabelog_Archive:
+    """取得したHTMLをgzipで内容アドレス保存する（objects/にsha256、refs/にURLごとの最新）"""
+
+    def __init__(self, root_dir=TABELOG_ARCHIVE_DIR, s3_prefix=TABELOG_ARCHIVE_S3_PREFIX):
+        self.root_dir = root_dir
+        self.s3_prefix = s3_prefix
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return bool(self.root_dir or self.s3_prefix)
+
+    def _object_name(self, digest):
+        return 'objects/' + digest[:2] + '/' + digest + '.html.gz'
+
+    def _ref_name(self, url):
+        return 'refs/' + hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+
+    def _exists(self, name):
+        if self.root_dir:
+            return os.path.exists(os.path.join(self.root_dir, name))
+
+        with s3_breaker.guard():
+            try:
+                get_s3_client().head_object(Bucket=AWS_S3_BUCKET_NAME, Key=self.s3_prefix + name)
+            except botocore_exceptions.ClientError as e:
+                if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404:
+                    return False
+                raise
+        return True
+
+    def _read(self, name):
+        if self.root_dir:
+            try:
+                with open(os.path.join(self.root_dir, name), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        s3_client = get_s3_client()
+        with s3_breaker.guard():
+            try:
+                obj = s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=self.s3_prefix + name)
+            except s3_client.exceptions.NoSuchKey:
+                return None
+            return obj['Body'].read()
+
+    def _write(self, name, data):
+        if self.root_dir:
+            path = os.path.join(self.root_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            return
+
+        with s3_breaker.guard():
+            get_s3_client().put_object(Bucket=AWS_S3_BUCKET_NAME, Key=self.s3_prefix + name, Body=data)
+
+    def put(self, url, html):
+        digest = hashlib.sha256(html).hexdigest()
+
+        # 内容が変わっていなければ本体は書かない
+        name = self._object_name(digest)
+        if not self._exists(name):
+            self._write(name, gzip.compress(html))
+
+        ref = {'url': url, 'sha256': digest, 'fetched_at': time.time()}
+        self._write(self._ref_name(url), json.dumps(ref).encode('utf-8'))
+        return digest
+
+    def _put_logged(self, url, html):
+        try:
+            self.put(url, html)
+        except Exception as e:
+            metrics.incr('tabelog_archive.error')
+            print('[Except Log] _Tabelog_Archive.put'
+                + ' url=' + url
+                + ' error=' + repr(e)
+            )
+
+    def put_async(self, url, html):
+        # 返信の途中で取得した時もS3への書き込みは待たない
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='tabelog-archive')
+                atexit.register(self.close)
+
+        return self._executor.submit(self._put_logged, url, html)
+
+    def close(self):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def get(self, url):
+        ref = self._read(self._ref_name(url))
+        if ref is None:
+            return None
+
+        data = self._read(self._object_name(json.loads(ref.decode('utf-8'))['sha256']))
+        if data is None:
+            return None
+
+        return gzip.decompress(data)
+
+
+tabelog_archive = _Tabelog_Archive()
+
+
 class _Tabelog_Scraping:
 
     def __init__(self):
@@ -320,9 +2298,20 @@ class _Tabelog_Scraping:
         hoursn = hoursn[:100]
         return hoursn
     
+    def fetch(self, url):
+        html = http_urlopen(url)
+
+        # パーサを直した時に取り直さなくて済むように残しておく
+        if tabelog_archive.enabled:
+            tabelog_archive.put_async(url, html)
+
+        return html
+
     def tabelog_scraping(self,url):
-        html = urllib.request.urlopen(url).read()
-        soup = BeautifulSoup(html, 'html.parser')
+        return self.parse(url, self.fetch(url))
+
+    def parse(self, url, html):
+        soup = bs4.BeautifulSoup(html, 'html.parser')
 
         #name
         name = soup.find(class_='display-name').span.string.strip()
@@ -390,7 +2379,7 @@ class _Tabelog_Insert:
                 FROM public.tabelog \
                 WHERE url = %s;'
                 
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(sql, (self.url,))
@@ -422,7 +2411,7 @@ class _Tabelog_Insert:
                 name, image_key, url, score, station, genre, hours) \
                 VALUES (%s, %s, %s, %s, %s, %s, %s);'
                 
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(sql, self.value.get_value_tp())
@@ -457,7 +2446,7 @@ class _Tabelog_Select:
                ORDER BY RANDOM() \
                LIMIT %s ;'
         
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(sql, (self._LIMIT,))
@@ -477,7 +2466,7 @@ class _Tabelog_Select:
                     FROM public.tabelog \
                     WHERE entity = %s;'
 
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(sql, (entity_name,))
@@ -489,21 +2478,7 @@ class _Tabelog_Select:
         return value
 
     def _tabelog_action_text(self):
-        sql = 'SELECT DISTINCT ON (reply_order) text, reply_order \
-                FROM public.replies \
-                WHERE entity = %s \
-                ORDER BY reply_order ASC, RANDOM();'
-        
-        with psycopg2.connect(DB_URL) as conn:
-            with conn.cursor() as curs:
-
-                curs.execute(sql, ('@event.tabelog.neko', ))
-                if 0 < curs.rowcount:
-                    reply_texts = curs.fetchone()
-
-                else:
-                    reply_texts = ()
-        
+        reply_texts = dictionary_snapshots.current().get_reply_texts('@event.tabelog.neko')
         return reply_texts[0]
 
     def carousel_columns(self):
@@ -662,8 +2637,17 @@ class _Tabelog_Select:
         message = FlexSendMessage(alt_text="tabelog flex", contents=bubble)
         return message
 
+def _parse_tabelog_html(url, html):
+    return _Tabelog_Scraping().parse(url, html).value.get_value_tp()
+
+
 class _Tabelog_Update:
     _SLEEP_SECOND = 3
+    _BATCH_SIZE = 100
+
+    _sql_update = 'UPDATE public.tabelog \
+	            SET name=%s, score=%s, station=%s, genre=%s, hours=%s \
+	            WHERE id = %s;'
 
     def __init__(self):
         self.scraping = _Tabelog_Scraping()
@@ -673,7 +2657,7 @@ class _Tabelog_Update:
 	           FROM public.tabelog \
                ORDER BY id ASC;'
 
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(sql)
@@ -685,15 +2669,11 @@ class _Tabelog_Update:
         return keys
 
     def update_tabelog_link(self, id, value):
-        sql = 'UPDATE public.tabelog \
-	            SET name=%s, score=%s, station=%s, genre=%s, hours=%s \
-	            WHERE id = %s;'
-                
-        with psycopg2.connect(DB_URL) as conn:
+        with _db_connect() as conn:
             with conn.cursor() as curs:
 
                 curs.execute(
-                    sql,
+                    self._sql_update,
                     (value.name, value.score, value.station, value.genre, value.hours, id)
                 )
                 conn.commit()
@@ -722,6 +2702,193 @@ class _Tabelog_Update:
         print('[Debug] _Tabelog_Update.update_link_batch end')
         return
 
+    def update_values(self, values):
+        rows = [(value.name, value.score, value.station, value.genre, value.hours, id)
+            for (id, value) in values]
+
+        with _db_connect(statement_timeout=0) as conn:
+            with conn.cursor() as curs:
+
+                psycopg2.extras.execute_batch(curs, self._sql_update, rows, page_size=self._BATCH_SIZE)
+                conn.commit()
+
+        return len(rows)
+
+    def reparse_archive(self, workers=None, dry_run=False):
+        start = time.perf_counter()
+        keys = self._select_all_keys()
+
+        # アーカイブの読み出しはI/O、解析はCPUなので分けて並列にする
+        pages = []
+        missing = []
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as reader:
+            futures = [(id, url, reader.submit(tabelog_archive.get, url)) for (id, url) in keys]
+
+            for (id, url, future) in futures:
+                # 読めなかったページは成功扱いにせずエラーとして返す
+                try:
+                    html = future.result()
+                except Exception as e:
+                    errors.append((url, repr(e)))
+                    continue
+
+                if html is None:
+                    missing.append(url)
+                else:
+                    pages.append((id, url, html))
+
+        values = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as parser:
+            futures = {parser.submit(_parse_tabelog_html, url, html): (id, url) for (id, url, html) in pages}
+
+            for future in concurrent.futures.as_completed(futures):
+                (id, url) = futures[future]
+                try:
+                    values.append((id, _Tabelog_Value().set_value_tp(future.result())))
+                except Exception as e:
+                    errors.append((url, repr(e)))
+
+        values.sort(key=lambda value: value[0])
+        updated = 0 if dry_run else self.update_values(values)
+
+        return {
+            'rows': len(keys),
+            'archived': len(pages),
+            'missing': missing,
+            'parsed': len(values),
+            'errors': errors,
+            'updated': updated,
+            'elapsed': time.perf_counter() - start,
+        }
+
+
+class _Rate_Limiter:
+
+    def __init__(self, rate, burst=1):
+        self._lock = threading.Lock()
+        self._bucket = _Token_Bucket(rate, burst)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self._bucket.take(time.monotonic()):
+                    return
+                wait = (1 - self._bucket.tokens) / self._bucket.rate
+
+            time.sleep(wait)
+
+
+class _Tabelog_Bulk_Insert:
+    _BATCH_SIZE = 50
+
+    _sql_exists = 'SELECT url \
+                    FROM public.tabelog \
+                    WHERE url = ANY(%s);'
+
+    _sql_insert = 'INSERT INTO public.tabelog(\
+                    name, image_key, url, score, station, genre, hours) \
+                    VALUES %s;'
+
+    def normalize_urls(self, urls):
+        normalized = collections.OrderedDict()
+        invalid = []
+
+        for url in urls:
+            url = url.strip()
+            if not url or url.startswith('#'):
+                continue
+
+            t_insert = _Tabelog_Insert().set_target_url(url)
+            if t_insert.url:
+                normalized.setdefault(t_insert.url, url)
+            else:
+                invalid.append(url)
+
+        return list(normalized), invalid
+
+    def existing_urls(self, urls):
+        if not urls:
+            return set()
+
+        with _db_connect() as conn:
+            with conn.cursor() as curs:
+
+                curs.execute(self._sql_exists, (list(urls),))
+                return {url for (url,) in curs.fetchall()}
+
+    def _scrape(self, url, limiter):
+        limiter.acquire()
+        with metrics.timer('tabelog.scraping'):
+            return _Tabelog_Scraping().tabelog_scraping(url).value
+
+    def scrape_urls(self, urls, workers, rate):
+        limiter = _Rate_Limiter(rate)
+        values = []
+        errors = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._scrape, url, limiter): url for url in urls}
+
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                try:
+                    values.append(future.result())
+                except Exception as e:
+                    errors.append((url, repr(e)))
+                    print('[Except Log] _Tabelog_Bulk_Insert.scrape_urls'
+                        + ' url=' + url
+                        + ' error=' + repr(e)
+                    )
+
+        return values, errors
+
+    def insert_values(self, values):
+        inserted = 0
+
+        with _db_connect(statement_timeout=0) as conn:
+            with conn.cursor() as curs:
+
+                for i in range(0, len(values), self._BATCH_SIZE):
+                    batch = [value.get_value_tp() for value in values[i:i + self._BATCH_SIZE]]
+                    psycopg2.extras.execute_values(curs, self._sql_insert, batch)
+                    conn.commit()
+                    inserted += len(batch)
+
+                    print('[Event Log] insert_tabelog_links'
+                        + ' inserted=' + str(inserted)
+                        + '/' + str(len(values))
+                    )
+
+        return inserted
+
+    def import_urls(self, urls, workers=4, rate=0.5, dry_run=False):
+        start = time.perf_counter()
+        urls = list(urls)
+
+        normalized, invalid = self.normalize_urls(urls)
+        existing = self.existing_urls(normalized)
+        targets = [url for url in normalized if url not in existing]
+
+        if dry_run:
+            values, errors = [], []
+            inserted = 0
+        else:
+            values, errors = self.scrape_urls(targets, workers, rate)
+            inserted = self.insert_values(values)
+
+        return {
+            'input': len([url for url in urls if url.strip() and not url.strip().startswith('#')]),
+            'invalid': invalid,
+            'unique': len(normalized),
+            'existing': len(existing),
+            'targets': len(targets),
+            'scraped': len(values),
+            'errors': errors,
+            'inserted': inserted,
+            'elapsed': time.perf_counter() - start,
+        }
+
 
 class Tabelog:
 
@@ -729,6 +2896,7 @@ class Tabelog:
         self.insert = _Tabelog_Insert()
         self.select = _Tabelog_Select()
         self.update = _Tabelog_Update()
+        self.bulk = _Tabelog_Bulk_Insert()
 
 def my_normalize(text):
     text = neologdn.normalize(text)
@@ -743,27 +2911,13 @@ def my_normalize(text):
     return text
 
 
-def text_send_messages_db(entity,prefix='',suffix=''):
-    
-    sql = 'SELECT DISTINCT ON (reply_order) text, reply_order \
-            FROM public.replies \
-            WHERE entity = %s \
-            ORDER BY reply_order ASC, RANDOM();'
-    
-    if entity.match:
-        with psycopg2.connect(DB_URL) as conn:
-            with conn.cursor() as curs:
-
-                curs.execute(sql, (entity.name, ))
-                if 0 < curs.rowcount:
-                    reply_texts_tp = curs.fetchall()
+def text_send_messages_db(entity,prefix='',suffix='',dictionary=None):
 
-                    reply_texts = []
-                    for reply_text in reply_texts_tp:
-                        reply_texts.append(reply_text[0].strip())
+    if entity.match:
+        if dictionary is None:
+            dictionary = dictionary_snapshots.current()
 
-                else:
-                    reply_texts = []
+        reply_texts = dictionary.get_reply_texts(entity.name)
 
     else:
         reply_texts = []
@@ -774,69 +2928,630 @@ def text_send_messages_db(entity,prefix='',suffix=''):
 
     return messages
 
-def insert_random_values(value, category):
+class _Write_Behind:
 
-    sql = 'INSERT INTO public.random_values(\
-            category, value, timestamp) \
-            VALUES(%s, %s, current_timestamp);'
-            
-    with psycopg2.connect(DB_URL) as conn:
-        with conn.cursor() as curs:
+    def __init__(self, enabled=(WRITE_BEHIND == 'True'), max_rows=WRITE_BEHIND_MAX_ROWS,
+            flush_second=WRITE_BEHIND_FLUSH_SECOND, max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.flush_second = flush_second
+        self.max_pending = max_pending
+
+        self._statements = {}
+        self._pending = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._worker = None
+        self._closed = False
+
+    def register(self, name, sql, template=None):
+        self._statements[name] = (sql, template)
+        return self
 
-            curs.execute(sql, (category,value,))
+    def append(self, name, row):
+        with self._cond:
+            if self._closed or len(self._pending) >= self.max_pending:
+                metrics.incr('write_behind.dropped')
+                return False
+
+            self._pending.append((name, row))
+
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='write-behind', daemon=True)
+                self._worker.start()
+
+            if len(self._pending) >= self.max_rows:
+                self._cond.notify()
+
+        return True
+
+    def pending_rows(self, name):
+        with self._cond:
+            return [row for (pending_name, row) in self._pending if pending_name == name]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                pending = self._pending
+                self._pending = []
+
+            if not pending:
+                return 0
+
+            rows = collections.OrderedDict()
+            for (name, row) in pending:
+                rows.setdefault(name, []).append(row)
+
+            # 1つの文が失敗しても他の文を止めないように文ごとにトランザクションを分ける
+            written = 0
+            retry = []
+            for name, values in rows.items():
+                start = time.perf_counter()
+                try:
+                    self._write(name, values)
+
+                except (psycopg2.OperationalError, _Dependency_Unavailable) as e:
+                    # 接続断やタイムアウトは一時的なので戻して次回に回す
+                    metrics.incr('write_behind.flush_error')
+                    print('[Except Log] _Write_Behind.flush name=' + name + ' error=' + repr(e))
+                    retry.extend((name, row) for row in values)
+                    continue
+
+                except Exception as e:
+                    # テーブルが無い・行が合わないなどは何度やっても通らないので捨てる
+                    metrics.incr('write_behind.flush_error')
+                    metrics.incr('write_behind.dropped', len(values))
+                    print('[Except Log] _Write_Behind.flush name=' + name
+                        + ' dropped=' + str(len(values)) + ' error=' + repr(e))
+                    continue
+
+                metrics.observe('write_behind.flush', time.perf_counter() - start)
+                metrics.incr('write_behind.rows', len(values))
+                written += len(values)
+
+            if retry:
+                # 書けなかった行は入る分だけ戻す
+                with self._cond:
+                    room = max(0, self.max_pending - len(self._pending))
+                    self._pending[0:0] = retry[:room]
+                    metrics.incr('write_behind.dropped', len(retry) - min(room, len(retry)))
+
+            return written
+
+    def _write(self, name, values):
+        (sql, template) = self._statements[name]
+        with _db_connect() as conn:
+            with conn.cursor() as curs:
+                psycopg2.extras.execute_values(
+                    curs, sql, values, template=template, page_size=self.max_rows)
             conn.commit()
 
-    return
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.max_rows and not self._closed:
+                    self._cond.wait(self.flush_second)
 
-def select_recent_random_values(category,limit):
+                closed = self._closed
 
-    sql = 'SELECT value \
-            FROM public.random_values \
-            WHERE category = %s \
-            ORDER BY timestamp DESC \
-            LIMIT %s;'
+            try:
+                self.flush()
+            except Exception as e:
+                # ワーカーが止まると以後の行が全部溜まるだけになる
+                metrics.incr('write_behind.flush_error')
+                print('[Except Log] _Write_Behind._run error=' + repr(e))
 
-    with psycopg2.connect(DB_URL) as conn:
-        with conn.cursor() as curs:
+            if closed:
+                return
 
-            curs.execute(sql, (category,limit, ))
-            if 0 < curs.rowcount:
-                values_tp = curs.fetchall()
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
 
-                values = []
-                for value_tp in values_tp:
-                    values.append(value_tp[0])
+        flushed = self.flush()
+        if flushed:
+            print('[Debug] _Write_Behind.close flushed=' + str(flushed))
 
-            else:
-                values = []
 
-    return values
+write_behind = _Write_Behind()
+atexit.register(write_behind.close)
 
-def same_random_value(current_value, recent_values):
 
-    ret = False
+class _Event_Store:
+    """メッセージイベントをgzipのセグメントファイルに追記する
+    セグメントごとに日別の集計を横に置き、集計はそちらだけを読む"""
 
-    for recent_value in recent_values:
-        if current_value == recent_value:
-            ret = True
+    FIELDS = ('received_at', 'kind', 'user_id', 'group_id', 'room_id',
+        'text', 'intent', 'entity_exact', 'entity_partial', 'latency')
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-    return ret
+    def __init__(self, root_dir=EVENT_STORE_DIR, segment_rows=EVENT_STORE_SEGMENT_ROWS,
+            segment_second=EVENT_STORE_SEGMENT_SECOND, flush_second=EVENT_STORE_FLUSH_SECOND,
+            max_pending=EVENT_STORE_MAX_PENDING):
+        self.root_dir = root_dir
+        self.segment_rows = segment_rows
+        self.segment_second = segment_second
+        self.flush_second = flush_second
+        self.max_pending = max_pending
 
+        self._pending = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._worker = None
+        self._closed = False
 
-def genelate_image_url_s3(category):
+        self._segment = None
+        self._segment_seq = 0
 
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
+    @property
+    def enabled(self):
+        return bool(self.root_dir)
 
-    obj_collections = bucket.objects.filter(Prefix=category)
-    keys = [obj_summary.key for obj_summary in obj_collections if obj_summary.key.endswith('.jpg')]
+    def append(self, record):
+        with self._cond:
+            if self._closed or len(self._pending) >= self.max_pending:
+                metrics.incr('event_store.dropped')
+                return False
 
-    if not keys:
-        return '',''
+            self._pending.append(record)
 
-    same_key = True
-    counter = 0
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='event-store', daemon=True)
+                self._worker.start()
+
+        return True
+
+    @classmethod
+    def day(cls, received_at):
+        return time.strftime('%Y-%m-%d', time.localtime(received_at))
+
+    @classmethod
+    def new_summary(cls):
+        return {
+            'events': {},
+            'intent': {},
+            'entity_exact': {},
+            'entity_partial': {},
+            'latency': {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(cls.LATENCY_BUCKETS) + 1)},
+        }
+
+    @classmethod
+    def add_to_summary(cls, days, record):
+        row = dict(zip(cls.FIELDS, record))
+        summary = days.setdefault(cls.day(row['received_at']), cls.new_summary())
+
+        summary['events'][row['kind']] = summary['events'].get(row['kind'], 0) + 1
+        for field in ('intent', 'entity_exact', 'entity_partial'):
+            if row[field]:
+                summary[field][row[field]] = summary[field].get(row[field], 0) + 1
+
+        latency = row['latency']
+        if latency is not None:
+            summary['latency']['count'] += 1
+            summary['latency']['sum'] += latency
+            summary['latency']['max'] = max(summary['latency']['max'], latency)
+            summary['latency']['buckets'][bisect.bisect_left(cls.LATENCY_BUCKETS, latency)] += 1
+
+    @classmethod
+    def merge_summary(cls, total, summary):
+        for field in ('events', 'intent', 'entity_exact', 'entity_partial'):
+            for name, count in summary[field].items():
+                total[field][name] = total[field].get(name, 0) + count
+
+        total['latency']['count'] += summary['latency']['count']
+        total['latency']['sum'] += summary['latency']['sum']
+        total['latency']['max'] = max(total['latency']['max'], summary['latency']['max'])
+        total['latency']['buckets'] = [a + b for (a, b) in
+            zip(total['latency']['buckets'], summary['latency']['buckets'])]
+        return total
+
+    def _segment_dir(self):
+        return os.path.join(self.root_dir, 'segments')
+
+    def _open_segment(self):
+        # プロセスごとに別のファイルに書くのでworker間でロックは要らない
+        self._segment_seq += 1
+        name = (time.strftime('%Y%m%dT%H%M%S') + '-' + str(os.getpid())
+            + '-' + '{:04d}'.format(self._segment_seq))
+        os.makedirs(self._segment_dir(), exist_ok=True)
+
+        self._segment = {
+            'path': os.path.join(self._segment_dir(), name + '.jsonl.gz'),
+            'opened_at': time.time(),
+            'rows': 0,
+            'days': {},
+        }
+
+    def _write_summary(self, sealed):
+        path = self._segment['path'][:-len('.jsonl.gz')] + '.summary.json'
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                'segment': os.path.basename(self._segment['path']),
+                'rows': self._segment['rows'],
+                'sealed': sealed,
+                'days': self._segment['days'],
+            }, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def _seal(self):
+        if self._segment is None:
+            return
+
+        self._write_summary(sealed=True)
+        print('[Debug] _Event_Store seal segment=' + os.path.basename(self._segment['path'])
+            + ' rows=' + str(self._segment['rows']))
+        self._segment = None
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                pending = self._pending
+                self._pending = []
+
+            if not pending:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                if self._segment is None:
+                    self._open_segment()
+
+                # バッチごとに独立したgzipメンバーを追記するので途中で落ちても前のバッチは読める
+                data = ''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+                    for record in pending).encode('utf-8')
+                with open(self._segment['path'], 'ab') as f:
+                    f.write(gzip.compress(data))
+
+                for record in pending:
+                    self.add_to_summary(self._segment['days'], record)
+                self._segment['rows'] += len(pending)
+
+                if (self._segment['rows'] >= self.segment_rows
+                        or time.time() - self._segment['opened_at'] >= self.segment_second):
+                    self._seal()
+                else:
+                    self._write_summary(sealed=False)
+
+            except OSError as e:
+                metrics.incr('event_store.flush_error')
+                metrics.incr('event_store.dropped', len(pending))
+                print('[Except Log] _Event_Store.flush error=' + repr(e))
+                return 0
+
+            metrics.observe('event_store.flush', time.perf_counter() - start)
+            metrics.incr('event_store.rows', len(pending))
+            return len(pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_second)
+
+                closed = self._closed
+
+            self.flush()
+
+            if closed:
+                return
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+        flushed = self.flush()
+        with self._flush_lock:
+            self._seal()
+        if flushed:
+            print('[Debug] _Event_Store.close flushed=' + str(flushed))
+
+    def _summary_paths(self):
+        return sorted(glob.glob(os.path.join(self._segment_dir(), '*.summary.json')))
+
+    def _segment_paths(self):
+        return sorted(glob.glob(os.path.join(self._segment_dir(), '*.jsonl.gz')))
+
+    def read_segment(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def rebuild_summaries(self):
+        # 集計ファイルが欠けた・古いときに生ログから作り直す
+        rebuilt = 0
+        for path in self._segment_paths():
+            days = {}
+            rows = 0
+            try:
+                for record in self.read_segment(path):
+                    self.add_to_summary(days, record)
+                    rows += 1
+            except (OSError, EOFError, ValueError) as e:
+                # 書きかけの末尾は読めたところまでで集計する
+                print('[Except Log] _Event_Store.rebuild_summaries path=' + path + ' error=' + repr(e))
+
+            summary_path = path[:-len('.jsonl.gz')] + '.summary.json'
+            sealed = False
+            if os.path.exists(summary_path):
+                with open(summary_path) as f:
+                    sealed = json.load(f).get('sealed', False)
+
+            with open(summary_path + '.tmp', 'w') as f:
+                json.dump({'segment': os.path.basename(path), 'rows': rows, 'sealed': sealed, 'days': days},
+                    f, ensure_ascii=False)
+            os.replace(summary_path + '.tmp', summary_path)
+            rebuilt += 1
+
+        return rebuilt
+
+    def daily(self, since=None, until=None):
+        days = {}
+        segments = 0
+        for path in self._summary_paths():
+            with open(path) as f:
+                summary = json.load(f)
+            segments += 1
+
+            for day, day_summary in summary['days'].items():
+                if (since and day < since) or (until and day > until):
+                    continue
+                self.merge_summary(days.setdefault(day, self.new_summary()), day_summary)
+
+        return collections.OrderedDict(sorted(days.items())), segments
+
+    @classmethod
+    def latency_quantile(cls, latency, q):
+        # バケットの上限で近似する
+        if not latency['count']:
+            return None
+
+        target = q * latency['count']
+        seen = 0
+        for bound, count in zip(cls.LATENCY_BUCKETS + (latency['max'],), latency['buckets']):
+            seen += count
+            if seen >= target:
+                return min(bound, latency['max'])
+        return latency['max']
+
+    def get_status(self):
+        with self._cond:
+            pending = len(self._pending)
+        segment = self._segment
+        return {
+            'enabled': self.enabled,
+            'pending': pending,
+            'segment': os.path.basename(segment['path']) if segment else None,
+            'segment_rows': segment['rows'] if segment else 0,
+        }
+
+
+event_store = _Event_Store()
+atexit.register(event_store.close)
+
+
+class _Random_Values_Store:
+
+    _sql_insert = 'INSERT INTO public.random_values(\
+                    category, value, timestamp) \
+                    VALUES(%s, %s, current_timestamp);'
+
+    _sql_select_recent = 'SELECT value \
+                    FROM public.random_values \
+                    WHERE category = %s \
+                    ORDER BY timestamp DESC \
+                    LIMIT %s;'
+
+    _sql_categories = 'SELECT category, COUNT(*) \
+                    FROM public.random_values \
+                    GROUP BY category \
+                    ORDER BY category;'
+
+    _sql_compact = 'DELETE FROM public.random_values \
+                    WHERE ctid IN ( \
+                        SELECT ctid FROM ( \
+                            SELECT ctid, ROW_NUMBER() OVER (ORDER BY timestamp DESC) AS rn \
+                            FROM public.random_values \
+                            WHERE category = %s \
+                        ) ranked \
+                        WHERE rn > %s \
+                    );'
+
+    _sql_table_size = "SELECT pg_total_relation_size('public.random_values');"
+
+    def __init__(self, retention=RANDOM_VALUES_RETENTION,
+            retention_categories=RANDOM_VALUES_RETENTION_CATEGORIES):
+        self.retention = retention
+        self.retention_categories = {}
+        for item in retention_categories.split(','):
+            if '=' in item:
+                (category, value) = item.rsplit('=', 1)
+                self.retention_categories[category.strip()] = int(value)
+
+    def get_retention(self, category):
+        return self.retention_categories.get(category, self.retention)
+
+    def insert(self, value, category):
+        if write_behind.enabled:
+            write_behind.append('random_values', (category, value))
+            return
+
+        with _db_connect() as conn:
+            with conn.cursor() as curs:
+
+                curs.execute(self._sql_insert, (category, value,))
+                conn.commit()
+
+    def select_recent(self, category, limit):
+        # 保持件数より古い値は見ない
+        limit = min(limit, self.get_retention(category))
+
+        # まだ書き込まれていない値も含める
+        pending = [row[1] for row in write_behind.pending_rows('random_values') if row[0] == category]
+        values = pending[::-1][:limit]
+
+        if len(values) < limit:
+            with _db_connect() as conn:
+                with conn.cursor() as curs:
+
+                    curs.execute(self._sql_select_recent, (category, limit - len(values),))
+                    values += [value_tp[0] for value_tp in curs.fetchall()]
+
+        return values
+
+    def stats(self):
+        with _db_connect(statement_timeout=0) as conn:
+            with conn.cursor() as curs:
+
+                curs.execute(self._sql_table_size)
+                (table_size,) = curs.fetchone()
+
+                curs.execute(self._sql_categories)
+                categories = curs.fetchall()
+
+                latencies = {}
+                for (category, _) in categories:
+                    limit = self.get_retention(category)
+                    start = time.perf_counter()
+                    curs.execute(self._sql_select_recent, (category, limit,))
+                    curs.fetchall()
+                    latencies[category] = time.perf_counter() - start
+
+        return {
+            'table_size': table_size,
+            'rows': dict(categories),
+            'select_recent_latency': latencies,
+        }
+
+    def compact(self, dry_run=False, retention=None):
+        # retentionを指定したらカテゴリ別の設定より優先する
+        deleted = {}
+        override = retention
+
+        with _db_connect(statement_timeout=0) as conn:
+            with conn.cursor() as curs:
+
+                curs.execute(self._sql_categories)
+                for (category, count) in curs.fetchall():
+                    retention = self.get_retention(category) if override is None else override
+                    if count <= retention:
+                        deleted[category] = 0
+                        continue
+
+                    if dry_run:
+                        deleted[category] = count - retention
+                    else:
+                        curs.execute(self._sql_compact, (category, retention,))
+                        deleted[category] = curs.rowcount
+
+                    print('[Event Log] compact_random_values'
+                        + ' category=' + category
+                        + ' rows=' + str(count)
+                        + ' retention=' + str(retention)
+                        + ' deleted=' + str(deleted[category])
+                    )
+
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+
+        return deleted
+
+    def vacuum(self):
+        conn = psycopg2.connect(DB_URL, connect_timeout=int(DB_CONNECT_TIMEOUT))
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as curs:
+                curs.execute('VACUUM ANALYZE public.random_values;')
+        finally:
+            conn.close()
+
+
+random_values = _Random_Values_Store()
+
+# 時刻は元と同じくDB側で付ける（clock_timestampならまとめて書いても行ごとに順序が付く）
+write_behind.register('random_values',
+    'INSERT INTO public.random_values(category, value, timestamp) VALUES %s;',
+    template='(%s, %s, clock_timestamp())')
+
+write_behind.register('event_logs',
+    'INSERT INTO public.event_logs(\
+        received_at, kind, user_id, group_id, room_id, text, intent, entity_exact, entity_partial) \
+        VALUES %s;')
+
+
+def log_event(kind, event, text='', intent='', entity_exact='', entity_partial='', latency=None):
+    if EVENT_LOG_DB != 'True' and not event_store.enabled:
+        return
+
+    user_id, group_id, room_id = get_line_id(event)
+    timestamp = getattr(event, 'timestamp', None)
+    if timestamp:
+        received_at = datetime.datetime.fromtimestamp(timestamp / 1000.0, datetime.timezone.utc)
+    else:
+        received_at = datetime.datetime.now(datetime.timezone.utc)
+
+    if EVENT_LOG_DB == 'True':
+        write_behind.append('event_logs',
+            (received_at, kind, user_id, group_id, room_id, text, intent, entity_exact, entity_partial))
+
+    if event_store.enabled:
+        event_store.append((round(received_at.timestamp(), 3), kind, user_id, group_id, room_id,
+            text, intent, entity_exact, entity_partial,
+            round(latency, 4) if latency is not None else None))
+
+
+@contextlib.contextmanager
+def logging_event(kind, event, **fields):
+    # 処理時間も残すのでハンドラーの終わりで記録する（途中のreturnや例外でも残す）
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        log_event(kind, event, latency=time.perf_counter() - start, **fields)
+
+
+def insert_random_values(value, category):
+    random_values.insert(value, category)
+    return
+
+def select_recent_random_values(category,limit):
+    return random_values.select_recent(category, limit)
+
+def same_random_value(current_value, recent_values):
+
+    ret = False
+
+    for recent_value in recent_values:
+        if current_value == recent_value:
+            ret = True
+
+    return ret
+
+
+def genelate_image_url_s3(category):
+
+    # LISTと直近の値の取得は独立しているので同時に投げる
+    # 件数はLISTが終わるまで分からないので保持件数分を取って後で切る
+    # 失敗したら前回取れた値で返信する
+    (keys, recent_values) = fan_out.run(
+        lambda: last_known_good.call('s3_keys:' + category,
+            lambda: list_image_keys_s3(category), []),
+        lambda: last_known_good.call('recent_values:' + category,
+            lambda: select_recent_random_values(category, random_values.get_retention(category)), []),
+    )
+
+    if not keys:
+        return '',''
+
+    same_key = True
+    counter = 0
     limit = math.floor(len(keys)/2)
+    recent_keys = recent_values[:limit]
     while same_key:
         image_key = random.choice(keys)
         thumb_key = os.path.join('thumb', image_key)
@@ -845,7 +3560,6 @@ def genelate_image_url_s3(category):
             same_key = False
 
         else:
-            recent_keys = select_recent_random_values(category,limit)
             same_key = same_random_value(image_key, recent_keys)
         
         counter += 1
@@ -859,7 +3573,10 @@ def genelate_image_url_s3(category):
         if counter >= 3:
             break
 
-    insert_random_values(image_key, category)
+    try:
+        insert_random_values(image_key, category)
+    except (psycopg2.Error, _Dependency_Unavailable) as e:
+        print('[Except Log] genelate_image_url_s3 insert_random_values error=' + repr(e))
 
     print('[Image Log] genelate_image_url_s3'
         + ' random_choice'
@@ -882,8 +3599,7 @@ def genelate_image_url_s3(category):
     #         + ' exist_thumb'
     #     )
         
-    image_url = my_s3_presigned_url(image_key)
-    thumb_url = my_s3_presigned_url(thumb_key)
+    image_url, thumb_url = image_url_pair(image_key, thumb_key)
 
     print('[Image Log] genelate_image_url_s3'
         + ' generate_presigned_url'
@@ -893,8 +3609,34 @@ def genelate_image_url_s3(category):
 
     return image_url, thumb_url
 
+def list_image_keys_s3(category):
+
+    #ビルド済みの辞書ファイルにあればLISTしない
+    keys = dictionary_snapshots.current().get_s3_keys(category)
+    if keys is not None:
+        return keys
+
+    keys = image_key_index.get(category)
+    if keys is not None:
+        return keys
+
+    s3 = get_s3_resource()
+    bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
+
+    with s3_breaker.guard():
+        obj_collections = bucket.objects.filter(Prefix=category)
+        keys = [obj_summary.key for obj_summary in obj_collections if obj_summary.key.endswith('.jpg')]
+
+    image_key_index.set(category, keys)
+    return keys
+
+
+#カテゴリごとのS3のキー一覧（アップロードしたら捨てる）
+image_key_index = _TTL_Cache(256, IMAGE_KEYS_TTL)
+
+
 def my_s3_presigned_url(key):
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
     url = s3_client.generate_presigned_url(
             ClientMethod = 'get_object',
             Params = {'Bucket' : AWS_S3_BUCKET_NAME, 'Key' : key},
@@ -909,7 +3651,7 @@ def my_s3_link_url(key):
 
 
 def exist_key_s3(key):
-    s3 = boto3.resource('s3')
+    s3 = get_s3_resource()
     bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
     
     try:
@@ -922,22 +3664,24 @@ def exist_key_s3(key):
 
 def download_from_s3(key):
 
-    s3 = boto3.resource('s3')
+    s3 = get_s3_resource()
     bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
 
     download_path = os.path.join(static_tmp_path,os.path.basename(key))
 
-    bucket.download_file(key, download_path)
+    with s3_breaker.guard():
+        bucket.download_file(key, download_path)
 
     return download_path
 
 
 def upload_to_s3(source_path, key):
     
-    s3 = boto3.resource('s3')
+    s3 = get_s3_resource()
     bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
 
-    bucket.upload_file(source_path, key)
+    with s3_breaker.guard():
+        bucket.upload_file(source_path, key)
 
     return key
 
@@ -946,6 +3690,7 @@ def upload_to_s3_category(source_path, category):
 
     key = os.path.join(category, os.path.basename(source_path))
     key = upload_to_s3(source_path,key)
+    image_key_index.discard(category)
 
     return key
 
@@ -965,39 +3710,50 @@ def image_send_messages_s3(category):
     return message
 
 
+_EXIF_TRANSPOSE = {
+    # そのまま
+    1: lambda img: img,
+    # 左右反転
+    2: lambda img: img.transpose(Image.FLIP_LEFT_RIGHT),
+    # 180度回転
+    3: lambda img: img.transpose(Image.ROTATE_180),
+    # 上下反転
+    4: lambda img: img.transpose(Image.FLIP_TOP_BOTTOM),
+    # 左右反転＆反時計回りに90度回転
+    5: lambda img: img.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90),
+    # 反時計回りに270度回転
+    6: lambda img: img.transpose(Image.ROTATE_270),
+    # 左右反転＆反時計回りに270度回転
+    7: lambda img: img.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270), 
+    # 反時計回りに90度回転
+    8: lambda img: img.transpose(Image.ROTATE_90),
+}
+
+
+def exif_transpose(img):
+    # EXIFの向きどおりに回す（サムネイルは回した後で保存されるのでEXIFが無い）
+    if getattr(img, '_getexif', None) is None:
+        return img
+
+    try:
+        exif = img._getexif()
+        if exif:
+            orientation = exif.get(0x112, 1)
+            img = _EXIF_TRANSPOSE[orientation](img)
+    except:
+        print('[Except Log] def=exif_transpose exif = img._getexif()')
+
+    return img
+
+
 def shrink_image(source_path,save_path, target_width, target_height):
     img = Image.open(source_path)
     w, h = img.size
 
-    convert_image = {
-        # そのまま
-        1: lambda img: img,
-        # 左右反転
-        2: lambda img: img.transpose(Image.FLIP_LEFT_RIGHT),
-        # 180度回転
-        3: lambda img: img.transpose(Image.ROTATE_180),
-        # 上下反転
-        4: lambda img: img.transpose(Image.FLIP_TOP_BOTTOM),
-        # 左右反転＆反時計回りに90度回転
-        5: lambda img: img.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90),
-        # 反時計回りに270度回転
-        6: lambda img: img.transpose(Image.ROTATE_270),
-        # 左右反転＆反時計回りに270度回転
-        7: lambda img: img.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270), 
-        # 反時計回りに90度回転
-        8: lambda img: img.transpose(Image.ROTATE_90),
-    }
-
     if target_width < w or target_height < h:
         img.thumbnail((target_width, target_height), Image.ANTIALIAS)
 
-    try:
-        exif = img._getexif()
-        if exif:
-            orientation = exif.get(0x112, 1)
-            img = convert_image[orientation](img)
-    except:
-        print('[Except Log] def=shrink_image exif = img._getexif()')
+    img = exif_transpose(img)
 
     img.save(save_path)
     return save_path
@@ -1012,10 +3768,596 @@ def create_s3_thumb(image_key):
     return thumb_key
 
 
+class _Image_Cache:
+    _CONTENT_TYPES = {
+        '.jpg': 'image/jpeg',
+        '.jpeg': 'image/jpeg',
+        '.png': 'image/png',
+    }
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+
+        self._lock = threading.Lock()
+        self._fill_locks = {}
+        self._entries = collections.OrderedDict()
+        self._loaded = False
+
+    def content_type(self, key):
+        return self._CONTENT_TYPES.get(os.path.splitext(key)[1].lower())
+
+    def _file_prefix(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        # 再起動後もディスク上のキャッシュを使う（古い順に並べる）
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if '-' not in name or '.part' in name:
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_atime, name, path, stat.st_size))
+
+        for (_, name, path, size) in sorted(files):
+            (file_prefix, etag) = name.split('-', 1)
+            self._entries[file_prefix] = (path, size, etag)
+            self.total_bytes += size
+
+        self._loaded = True
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            (_, (path, size, _)) = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            metrics.incr('image_cache.evicted')
+
+    def get(self, key):
+        # 送信中に追い出されても読めるように、ロックを持ったまま開いて返す
+        file_prefix = self._file_prefix(key)
+
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+            entry = self._entries.get(file_prefix)
+            if entry is None:
+                return None
+
+            (path, size, etag) = entry
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                # ディスクから消されていたら取り直す
+                self._entries.pop(file_prefix)
+                self.total_bytes -= size
+                return None
+
+            self._entries.move_to_end(file_prefix)
+
+        return (f, size, etag)
+
+    def get_or_fill(self, key, fill):
+        opened = self.get(key)
+        if opened is not None:
+            metrics.incr('image_cache.hit')
+            return opened
+
+        file_prefix = self._file_prefix(key)
+        with self._lock:
+            fill_lock = self._fill_locks.setdefault(file_prefix, threading.Lock())
+
+        # 同じキーの取得は1回だけ行う
+        part_path = os.path.join(self.cache_dir,
+            file_prefix + '.part' + os.path.splitext(key)[1])
+        try:
+            with fill_lock:
+                opened = self.get(key)
+                if opened is not None:
+                    metrics.incr('image_cache.hit')
+                    return opened
+
+                metrics.incr('image_cache.miss')
+
+                with metrics.timer('image_cache.fill'):
+                    etag = fill(key, part_path)
+
+                if etag is None:
+                    return None
+
+                path = os.path.join(self.cache_dir, file_prefix + '-' + etag)
+                os.replace(part_path, path)
+                f = open(path, 'rb')
+                entry = (path, os.fstat(f.fileno()).st_size, etag)
+
+                with self._lock:
+                    if file_prefix in self._entries:
+                        self.total_bytes -= self._entries[file_prefix][1]
+                    self._entries[file_prefix] = entry
+                    self.total_bytes += entry[1]
+                    self._evict()
+
+                return (f, entry[1], etag)
+
+        finally:
+            # 失敗しても書きかけのファイルとロックを残さない
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+            with self._lock:
+                self._fill_locks.pop(file_prefix, None)
+
+
+image_cache = _Image_Cache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+
+def _s3_missing(e):
+    # ListBucket権限が無いとキーが無いときもAccessDeniedが返る
+    return e.response.get('Error', {}).get('Code') in ('NoSuchKey', 'AccessDenied', '404', '403')
+
+
+def _fill_image_from_s3(key, save_path):
+    s3_client = get_s3_client()
+
+    try:
+        with s3_breaker.guard():
+            obj = s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=key)
+
+    except botocore_exceptions.ClientError as e:
+        if not _s3_missing(e):
+            raise
+
+        if not key.startswith('thumb/'):
+            return None
+
+        # S3にサムネイルが無ければ元画像から作る
+        image_key = key[len('thumb/'):]
+        if _fill_image_from_s3(image_key, save_path) is None:
+            return None
+
+        shrink_image(save_path, save_path, 240, 240)
+        with open(save_path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    with open(save_path, 'wb') as f:
+        for chunk in iter(lambda: obj['Body'].read(LINE_CONTENT_CHUNK_SIZE), b''):
+            f.write(chunk)
+
+    return obj['ETag'].strip('"').replace('-', '_')
+
+
+def image_proxy_allowed(key):
+    if '..' in key.split('/'):
+        return False
+
+    if image_cache.content_type(key) is None:
+        return False
+
+    for prefix in IMAGE_PROXY_PREFIXES:
+        if key.startswith(prefix):
+            return True
+
+    return False
+
+
+def _image_proxy_signature(key, expires):
+    message = (key + '\n' + str(expires)).encode('utf-8')
+    return hmac.new(IMAGE_PROXY_SECRET.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def image_proxy_url(key, now=None):
+    # 署名付きURLと同じく期限付きにする（1時間単位で揃えてURLをキャッシュに載せる）
+    now = int(now or time.time())
+    expires = (now // 3600 + 1) * 3600 + IMAGE_PROXY_EXPIRES
+    return (AP_URL + '/img/' + urllib.parse.quote(key)
+        + '?' + urllib.parse.urlencode({'e': expires, 's': _image_proxy_signature(key, expires)}))
+
+
+def image_proxy_verify(key, expires, signature, now=None):
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return None
+
+    if expires <= (now or time.time()):
+        return None
+    if not hmac.compare_digest(signature or '', _image_proxy_signature(key, expires)):
+        return None
+
+    return expires
+
+
+def image_url_pair(image_key, thumb_key):
+    if IMAGE_PROXY == 'True':
+        return image_proxy_url(image_key), image_proxy_url(thumb_key)
+    else:
+        # 署名はローカルの計算だけなので並列にしない
+        return my_s3_presigned_url(image_key), my_s3_presigned_url(thumb_key)
+
+
+def image_dhash(source_path):
+    # 元画像とサムネイルで同じ値になるように向きを揃えてから計算する
+    img = exif_transpose(Image.open(source_path)).convert('L').resize((9, 8), Image.ANTIALIAS)
+    pixels = list(img.getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+
+    return value
+
+
+def _hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class _BK_Tree:
+
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, value, key):
+        node = (value, key, {})
+        self.size += 1
+
+        if self._root is None:
+            self._root = node
+            return
+
+        current = self._root
+        while True:
+            distance = _hamming_distance(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, max_distance):
+        found = []
+        if self._root is None:
+            return found
+
+        nodes = [self._root]
+        while nodes:
+            (node_value, node_key, children) = nodes.pop()
+            distance = _hamming_distance(value, node_value)
+            if distance <= max_distance:
+                found.append((distance, node_key))
+
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+
+        return sorted(found)
+
+
+class _Image_Hash_Index:
+
+    _sql_select = 'SELECT key, hash \
+                    FROM public.image_hashes;'
+
+    _sql_insert = 'INSERT INTO public.image_hashes(key, category, hash) \
+                    VALUES %s \
+                    ON CONFLICT (key) DO UPDATE SET hash = EXCLUDED.hash;'
+
+    def __init__(self, enabled=(IMAGE_DEDUP == 'True'), threshold=IMAGE_DEDUP_THRESHOLD):
+        self.enabled = enabled
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._tree = None
+        self._keys = set()
+
+    def _to_signed(self, value):
+        return value - (1 << 64) if value >= (1 << 63) else value
+
+    def _to_unsigned(self, value):
+        return value + (1 << 64) if value < 0 else value
+
+    def _load(self):
+        tree = _BK_Tree()
+        keys = set()
+
+        with _db_connect() as conn:
+            with conn.cursor() as curs:
+
+                curs.execute(self._sql_select)
+                for (key, value) in curs.fetchall():
+                    tree.add(self._to_unsigned(value), key)
+                    keys.add(key)
+
+        print('[Image Log] _Image_Hash_Index load size=' + str(tree.size))
+        return tree, keys
+
+    def _ready(self):
+        if self._tree is None:
+            with self._lock:
+                if self._tree is None:
+                    (tree, keys) = self._load()
+                    self._keys = keys
+                    self._tree = tree
+
+        return self._tree
+
+    def keys(self):
+        self._ready()
+        with self._lock:
+            return set(self._keys)
+
+    def find_duplicate(self, value):
+        try:
+            tree = self._ready()
+        except (psycopg2.Error, _Dependency_Unavailable) as e:
+            print('[Except Log] _Image_Hash_Index.find_duplicate error=' + repr(e))
+            return None
+
+        with self._lock:
+            found = tree.search(value, self.threshold)
+
+        if found:
+            return found[0]
+        else:
+            return None
+
+    def add_many(self, items):
+        if not items:
+            return
+
+        with _db_connect(statement_timeout=0) as conn:
+            with conn.cursor() as curs:
+
+                psycopg2.extras.execute_values(curs, self._sql_insert,
+                    [(key, category, self._to_signed(value)) for (key, category, value) in items])
+                conn.commit()
+
+        tree = self._ready()
+        with self._lock:
+            for (key, category, value) in items:
+                if key not in self._keys:
+                    tree.add(value, key)
+                    self._keys.add(key)
+
+    def add(self, key, category, value):
+        self.add_many([(key, category, value)])
+
+
+image_hashes = _Image_Hash_Index()
+
+
+def _hash_s3_image(key):
+    s3_client = get_s3_client()
+    obj = s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=key)
+    return image_dhash(io.BytesIO(obj['Body'].read()))
+
+
+def backfill_image_hashes(prefix='image/', workers=8):
+    start = time.perf_counter()
+    bulk = _S3_Bulk_Upload()
+
+    image_keys = sorted(key for key in bulk.list_keys(prefix) if key.lower().endswith('.jpg'))
+    thumb_keys = bulk.list_keys(os.path.join('thumb', prefix))
+    hashed_keys = image_hashes.keys()
+    targets = [key for key in image_keys if key not in hashed_keys]
+
+    items = []
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for key in targets:
+            # サムネイルがあれば小さい方で計算する
+            thumb_key = os.path.join('thumb', key)
+            source_key = thumb_key if thumb_key in thumb_keys else key
+            futures[executor.submit(_hash_s3_image, source_key)] = key
+
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                items.append((key, os.path.dirname(key) + '/', future.result()))
+            except Exception as e:
+                errors.append((key, repr(e)))
+                continue
+
+            if len(items) >= 100:
+                image_hashes.add_many(items)
+                items = []
+
+    image_hashes.add_many(items)
+
+    return {
+        'images': len(image_keys),
+        'hashed': len(targets) - len(errors),
+        'skipped': len(image_keys) - len(targets),
+        'errors': errors,
+        'elapsed': time.perf_counter() - start,
+    }
+
+
+def _shrink_thumb(source_path, save_path):
+    return shrink_image(source_path, save_path, 240, 240)
+
+
+class _S3_Bulk_Upload:
+    _EXTENSIONS = ('.jpg', '.jpeg')
+    _MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+    def __init__(self, workers=8, thumb_workers=None):
+        self.workers = workers
+        self.thumb_workers = thumb_workers or os.cpu_count() or 1
+
+    def list_keys(self, prefix):
+        s3_client = get_s3_client()
+        paginator = s3_client.get_paginator('list_objects_v2')
+
+        keys = set()
+        for page in paginator.paginate(Bucket=AWS_S3_BUCKET_NAME, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                keys.add(obj['Key'])
+
+        return keys
+
+    def local_files(self, source_dir):
+        return sorted(
+            os.path.join(source_dir, name) for name in os.listdir(source_dir)
+            if name.lower().endswith(self._EXTENSIONS)
+        )
+
+    def image_key(self, category, path):
+        # 配信側は小文字の.jpgだけを拾うので拡張子を揃える
+        return os.path.join(category, os.path.splitext(os.path.basename(path))[0] + '.jpg')
+
+    def _upload(self, s3_client, transfer_config, path, key):
+        s3_client.upload_file(path, AWS_S3_BUCKET_NAME, key, Config=transfer_config)
+        return os.path.getsize(path)
+
+    def _filter_duplicates(self, originals):
+        # 既存の画像とも、今回の画像同士とも重複しないものだけ残す
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.thumb_workers) as hasher:
+            values = list(hasher.map(image_dhash, [path for (path, _) in originals]))
+
+        hashes = {}
+        duplicates = []
+        batch = _BK_Tree()
+        for ((path, key), value) in zip(originals, values):
+            found = image_hashes.find_duplicate(value)
+            if found is None:
+                found = (batch.search(value, image_hashes.threshold) or [None])[0]
+
+            if found is not None:
+                duplicates.append((key, found[1]))
+                continue
+
+            batch.add(value, key)
+            hashes[key] = value
+
+        return hashes, duplicates
+
+    def upload_dir(self, source_dir, category, dry_run=False):
+        start = time.perf_counter()
+        if not category.endswith('/'):
+            category += '/'
+
+        # 既存キーはHEADではなくLIST1回で調べる
+        existing = self.list_keys(category) | self.list_keys(os.path.join('thumb', category))
+
+        files = self.local_files(source_dir)
+        originals = []
+        thumbs = []
+        skipped = []
+        planned = set()
+        for path in files:
+            image_key = self.image_key(category, path)
+            thumb_key = os.path.join('thumb', image_key)
+
+            # a.jpeg と a.JPG のように同じキーになるものは先の1つだけ
+            if image_key in planned:
+                skipped.append((image_key, 'same key as another file: ' + os.path.basename(path)))
+                continue
+            planned.add(image_key)
+
+            if image_key not in existing:
+                originals.append((path, image_key))
+            if thumb_key not in existing:
+                thumbs.append((path, thumb_key))
+
+        summary = {
+            'files': len(files),
+            'originals': len(originals),
+            'thumbs': len(thumbs),
+            'duplicates': [],
+            'uploaded': 0,
+            'bytes': 0,
+            'skipped': skipped,
+            'errors': [],
+        }
+
+        hashes = {}
+        if image_hashes.enabled and originals:
+            (hashes, duplicates) = self._filter_duplicates(originals)
+            duplicate_keys = {key for (key, _) in duplicates}
+            originals = [(path, key) for (path, key) in originals if key not in duplicate_keys]
+            thumbs = [(path, key) for (path, key) in thumbs
+                if key[len('thumb/'):] not in duplicate_keys]
+            summary['duplicates'] = duplicates
+
+        if dry_run:
+            summary['elapsed'] = time.perf_counter() - start
+            return summary
+
+        s3_client = get_s3_client()
+        transfer_config = boto3_s3_transfer.TransferConfig(
+            multipart_threshold=self._MULTIPART_CHUNKSIZE,
+            multipart_chunksize=self._MULTIPART_CHUNKSIZE,
+            max_concurrency=4)
+
+        thumb_dir = tempfile.mkdtemp(dir=static_tmp_path, prefix='thumb-')
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as uploader, \
+                    concurrent.futures.ProcessPoolExecutor(max_workers=self.thumb_workers) as shrinker:
+
+                uploads = {}
+                for (path, key) in originals:
+                    future = uploader.submit(self._upload, s3_client, transfer_config, path, key)
+                    uploads[future] = key
+
+                # サムネイルは別プロセスで並列に作る
+                shrinks = {}
+                for (i, (path, key)) in enumerate(thumbs):
+                    thumb_path = os.path.join(thumb_dir, str(i) + '-' + os.path.basename(path))
+                    shrinks[shrinker.submit(_shrink_thumb, path, thumb_path)] = key
+
+                for future in concurrent.futures.as_completed(shrinks):
+                    key = shrinks[future]
+                    try:
+                        thumb_path = future.result()
+                    except Exception as e:
+                        summary['errors'].append((key, repr(e)))
+                        continue
+
+                    future = uploader.submit(self._upload, s3_client, transfer_config, thumb_path, key)
+                    uploads[future] = key
+
+                uploaded_hashes = []
+                for future in concurrent.futures.as_completed(uploads):
+                    key = uploads[future]
+                    try:
+                        summary['bytes'] += future.result()
+                        summary['uploaded'] += 1
+                    except Exception as e:
+                        summary['errors'].append((key, repr(e)))
+                        continue
+
+                    if key in hashes:
+                        uploaded_hashes.append((key, category, hashes[key]))
+
+                    print('[Image Log] bulk_upload key=' + key)
+
+            image_hashes.add_many(uploaded_hashes)
+
+        finally:
+            shutil.rmtree(thumb_dir, ignore_errors=True)
+
+        summary['elapsed'] = time.perf_counter() - start
+        return summary
+
+
 def update_s3_thumb_bach(prefix):
     print('[Debug] update_s3_thumb_bach start')
 
-    s3 = boto3.resource('s3')
+    s3 = get_s3_resource()
     bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
 
     obj_collections = bucket.objects.filter(Prefix=prefix)
@@ -1034,126 +4376,557 @@ def update_s3_thumb_bach(prefix):
                 + ' thumb_key=' + thumb_key
             )
 
-        else:
-            print('[Image Log] update_s3_thumb'
-                + ' exist'
-                + ' image_key=' + image_key
-                + ' thumb_key=' + thumb_key
-            )
+        else:
+            print('[Image Log] update_s3_thumb'
+                + ' exist'
+                + ' image_key=' + image_key
+                + ' thumb_key=' + thumb_key
+            )
+
+    print('[Debug] update_s3_thumb_bach end')
+    return
+
+
+def get_message_pattern(text):
+    if text in{'てすと', 'テスト', 'test'}:
+        return 'test'
+
+
+def get_img_dir(message_pattern):
+    if message_pattern in{
+        'neko_quu'
+    }:
+        return 'static/quuimg'
+
+    elif message_pattern in{
+        'neko_choco'
+    }:
+        return 'static/chocoimg'
+
+    elif message_pattern in{
+        'test'
+    }:
+        return 'static/nekoimg'
+
+
+def image_send_message_dir(img_dir):
+    image_name = random.choice([os.path.basename(f) for f in (
+        glob.glob(os.path.join(img_dir, '*.jpg')))])
+    image_url = os.path.join(AP_URL, img_dir, image_name)
+    image_thumb_url = os.path.join(AP_URL, img_dir, 'thumb', image_name)
+
+    message = ImageSendMessage(
+        original_content_url=image_url,
+        preview_image_url=image_thumb_url
+    )
+    print('[Image Log] image_send_message_dir image_url=' + image_url)
+    return message
+
+
+def image_send_message_list(img_dir, img_list):
+    image_name = random.choice(img_list)
+    image_url = os.path.join(AP_URL, img_dir, image_name)
+    image_thumb_url = os.path.join(AP_URL, img_dir, 'thumb', image_name)
+
+    message = ImageSendMessage(
+        original_content_url=image_url,
+        preview_image_url=image_thumb_url
+    )
+    print('[Image Log] image_send_message_list image_url=' + image_url)
+    return message
+
+
+def restaurant_image_url(restaurant):
+    image_name = restaurant + '.jpg'
+    image_url = os.path.join(AP_URL, 'static/restaurantimg', image_name)
+
+    print('[Debug] restaurant_image_url:' + image_url)
+    return image_url
+
+
+def warning_messages():
+    warning_entity = Entity
+    warning_entity.match = True
+    warning_entity.name = '@warning'
+
+    messages = text_send_messages_db(warning_entity)
+
+    return messages
+
+
+def restaurant_message_text():
+    text = random.choice([
+        '猫', 'ねこ', 'ネコ', 'cat', 'neko', 'ひめ','ちゅーる'
+    ])
+    return text
+
+
+def get_line_id(event):
+    try:
+        if isinstance(event.source, SourceUser):
+            #profile = line_bot_api.get_profile(event.source.user_id)
+
+            user_id = event.source.user_id
+            group_id = ''
+            room_id = ''
+
+        elif isinstance(event.source, SourceGroup):
+            #profile = line_bot_api.get_group_member_profile(
+            #    event.source.group_id, event.source.user_id)
+
+            user_id = event.source.user_id
+            group_id = event.source.group_id
+            room_id = ''
+
+        elif isinstance(event.source, SourceRoom):
+            #profile = line_bot_api.get_room_member_profile(
+            #    event.source.room_id, event.source.user_id)
+
+            user_id = event.source.user_id
+            group_id = ''
+            room_id = event.source.room_id
+
+    except:
+        user_id = ''
+        group_id = ''
+        room_id = ''
+
+    return user_id, group_id, room_id
+
+
+class _Outbound_Message:
+
+    def __init__(self, reply_token, to, messages, received_at):
+        self.reply_token = reply_token
+        self.to = to
+        self.messages = messages
+        self.received_at = received_at
+        self.attempts = 0
+        self.method = None
+
+
+class _Line_Sender:
+    _BACKOFF_BASE = 0.5
+    _BACKOFF_MAX = 30.0
+
+    # 送信結果
+    SENT = 'sent'
+    RETRY = 'retry'
+    FAILED = 'failed'
+
+    def __init__(self, max_queue=LINE_RETRY_QUEUE_SIZE, max_attempts=LINE_RETRY_MAX_ATTEMPTS,
+            reply_token_ttl=LINE_REPLY_TOKEN_TTL):
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.reply_token_ttl = reply_token_ttl
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._pause_until = 0
+        self._worker = None
+
+    def reply(self, event, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+
+        if not messages:
+            print('[Debug] _Line_Sender.reply empty messages')
+            return self.FAILED
+
+        user_id, group_id, room_id = get_line_id(event)
+        timestamp = getattr(event, 'timestamp', None)
+        if timestamp:
+            received_at = timestamp / 1000.0
+        else:
+            received_at = time.time()
+
+        outbound = _Outbound_Message(
+            event.reply_token, group_id or room_id or user_id, list(messages), received_at)
+
+        result = self._send(outbound)
+        if result == self.RETRY:
+            self._enqueue(outbound)
+
+        return result
+
+    def _reply_token_valid(self, outbound):
+        if not outbound.reply_token:
+            return False
+
+        return time.time() - outbound.received_at < self.reply_token_ttl
+
+    def _retryable(self, method, e):
+        # replyのタイムアウトや5xxは届いている可能性があるので送り直さない
+        # （送り直すとtokenは使用済みになっていて、pushに回すと二重に届く）
+        if method == 'reply':
+            return e.status_code == 429
+        return e.status_code == 429 or 500 <= e.status_code < 600
+
+    def _send(self, outbound):
+        outbound.attempts += 1
+
+        # replyかpushかは最初の送信時に決めて変えない
+        # 最初の時点でreply tokenが失効していた場合だけpushで送る
+        if outbound.method is None:
+            if self._reply_token_valid(outbound):
+                outbound.method = 'reply'
+            elif outbound.to:
+                outbound.method = 'push'
+            else:
+                metrics.incr('line_sender.failed')
+                print('[Except Log] _Line_Sender._send no reply token and no destination')
+                return self.FAILED
+
+        method = outbound.method
+        if method == 'reply':
+            call = lambda: line_bot_api.reply_message(outbound.reply_token, outbound.messages)
+        else:
+            call = lambda: line_bot_api.push_message(outbound.to, outbound.messages)
+
+        try:
+            call()
+
+        except LineBotApiError as e:
+            if self._retryable(method, e):
+                if e.status_code == 429:
+                    metrics.incr('line_sender.rate_limited')
+                    self._pause(self._backoff(outbound.attempts))
+
+                print('[Except Log] _Line_Sender._send'
+                    + ' method=' + method
+                    + ' status_code=' + str(e.status_code)
+                    + ' attempts=' + str(outbound.attempts)
+                )
+                return self.RETRY
+
+            metrics.incr('line_sender.ambiguous' if 500 <= e.status_code < 600 else 'line_sender.failed')
+            print('[Except Log] _Line_Sender._send'
+                + ' method=' + method
+                + ' status_code=' + str(e.status_code)
+                + ' error=' + str(e)
+            )
+            return self.FAILED
+
+        except requests.RequestException as e:
+            print('[Except Log] _Line_Sender._send'
+                + ' method=' + method
+                + ' error=' + repr(e)
+            )
+            if method == 'reply':
+                metrics.incr('line_sender.ambiguous')
+                return self.FAILED
+            return self.RETRY
+
+        metrics.incr('line_sender.' + method)
+        metrics.observe('line_sender.delivery', time.time() - outbound.received_at)
+        return self.SENT
+
+    def _backoff(self, attempts):
+        backoff = min(self._BACKOFF_MAX, self._BACKOFF_BASE * (2 ** (attempts - 1)))
+        return backoff * random.uniform(0.5, 1.0)
+
+    def _pause(self, seconds):
+        with self._cond:
+            self._pause_until = max(self._pause_until, time.time() + seconds)
+
+    def _enqueue(self, outbound):
+        if outbound.attempts >= self.max_attempts:
+            metrics.incr('line_sender.gave_up')
+            print('[Except Log] _Line_Sender gave up attempts=' + str(outbound.attempts))
+            return False
+
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                metrics.incr('line_sender.dropped')
+                print('[Except Log] _Line_Sender queue full, dropped')
+                return False
+
+            delay = self._backoff(outbound.attempts)
+            heapq.heappush(self._queue, (time.time() + delay, next(self._seq), outbound))
+            metrics.incr('line_sender.retried')
+
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='line-sender', daemon=True)
+                self._worker.start()
+
+            self._cond.notify()
+
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._queue:
+                        wait = max(self._queue[0][0], self._pause_until) - now
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+
+                (_, _, outbound) = heapq.heappop(self._queue)
+
+            if self._send(outbound) == self.RETRY:
+                self._enqueue(outbound)
+
+    def queue_size(self):
+        with self._cond:
+            return len(self._queue)
+
+
+line_sender = _Line_Sender()
+
+
+class _Route_Context:
+
+    def __init__(self, event, text, textn, extraction):
+        self.event = event
+        self.text = text
+        self.textn = textn
+        self.extraction = extraction
+        self.intent = extraction.intent
+        self.entity_exact = extraction.entity_exact
+        self.entity_partial = extraction.entity_partial
+        self.message_pattern = get_message_pattern(textn)
+        self.user_id, self.group_id, self.room_id = get_line_id(event)
+        self.route = ''
+        self._setting = None
+
+    @property
+    def setting(self):
+        # 設定は必要になった時だけ読む
+        if self._setting is None:
+            self._setting = Setting()
+        return self._setting
+
+    def reply(self, messages):
+        return line_sender.reply(self.event, messages)
+
+    def reply_text(self, send_text):
+        if send_text != '':
+            self.reply(TextSendMessage(text=send_text))
+
+    def reply_event(self, entity_name, extra_messages=()):
+        entity_event = Entity('').set_name(entity_name)
+        replies = text_send_messages_db(entity_event) + list(extra_messages)
+        self.reply(replies)
+
+
+class _Route_Rule:
+
+    def __init__(self, order, stage, action):
+        self.order = order
+        self.stage = stage
+        self.action = action
+        name = action.__name__
+        if name.startswith('_route_'):
+            name = name[len('_route_'):]
+        self.name = stage + ':' + name
+
+
+class _Text_Router:
+
+    # ステージは上から順に判定し、各ステージでは先に登録したルールを優先する
+    _STAGES = (
+        ('exact', lambda ctx: ctx.entity_exact.match),
+        ('intent', lambda ctx: ctx.intent.match),
+        ('partial', lambda ctx: ctx.entity_partial.match),
+        ('pattern', lambda ctx: True),
+        ('fallback', lambda ctx: True),
+    )
+
+    _KEYS = {
+        ('exact', 'entity'): lambda ctx: ctx.entity_exact.name,
+        ('exact', 'entity_prefix'): lambda ctx: ctx.entity_exact.name,
+        ('exact', 'partial_entity'): lambda ctx: ctx.entity_partial.name,
+        ('intent', 'intent'): lambda ctx: ctx.intent.name,
+        ('partial', 'entity'): lambda ctx: ctx.entity_partial.name,
+        ('partial', 'entity_prefix'): lambda ctx: ctx.entity_partial.name,
+        ('pattern', 'pattern'): lambda ctx: ctx.message_pattern,
+    }
+
+    def __init__(self):
+        self._rules = []
+        self._tables = None
+
+    def rule(self, stage, **keys):
+        def decorator(action):
+            rule = _Route_Rule(len(self._rules), stage, action)
+            rule.keys = keys
+            self._rules.append(rule)
+            self._tables = None
+            return action
+
+        return decorator
+
+    def compile(self):
+        tables = []
+        for (stage, guard) in self._STAGES:
+            lookups = collections.OrderedDict()
+            default = None
+
+            for rule in self._rules:
+                if rule.stage != stage:
+                    continue
+
+                for kind, names in rule.keys.items():
+                    if kind == 'default':
+                        default = default or rule
+                        continue
+
+                    if (stage, kind) not in self._KEYS:
+                        raise ValueError('unknown route key ' + stage + ':' + kind)
+
+                    if isinstance(names, str):
+                        names = (names,)
+
+                    (table, lengths) = lookups.setdefault(kind, ({}, set()))
+                    for name in names:
+                        table.setdefault(name, rule)
+                        if kind == 'entity_prefix':
+                            lengths.add(len(name))
+
+            compiled = []
+            for kind, (table, lengths) in lookups.items():
+                compiled.append((kind, self._KEYS[(stage, kind)], table, sorted(lengths)))
+
+            tables.append((stage, guard, compiled, default))
+
+        self._tables = tables
+        return self
+
+    def _select(self, ctx, compiled, default):
+        selected = None
+        for (kind, key_fn, table, lengths) in compiled:
+            key = key_fn(ctx)
+            if key is None:
+                continue
+
+            if kind == 'entity_prefix':
+                candidates = [table.get(key[:length]) for length in lengths if len(key) >= length]
+            else:
+                candidates = [table.get(key)]
 
-    print('[Debug] update_s3_thumb_bach end')
-    return
+            for rule in candidates:
+                if rule is not None and (selected is None or rule.order < selected.order):
+                    selected = rule
 
+        return selected or default
 
-def get_message_pattern(text):
-    if text in{'てすと', 'テスト', 'test'}:
-        return 'test'
+    def dispatch(self, ctx):
+        if self._tables is None:
+            self.compile()
 
+        for (stage, guard, compiled, default) in self._tables:
+            if not guard(ctx):
+                continue
 
-def get_img_dir(message_pattern):
-    if message_pattern in{
-        'neko_quu'
-    }:
-        return 'static/quuimg'
+            rule = self._select(ctx, compiled, default)
+            if rule is None:
+                continue
 
-    elif message_pattern in{
-        'neko_choco'
-    }:
-        return 'static/chocoimg'
+            start = time.perf_counter()
+            handled = rule.action(ctx)
+            metrics.observe('route.' + rule.name, time.perf_counter() - start)
 
-    elif message_pattern in{
-        'test'
-    }:
-        return 'static/nekoimg'
+            if handled:
+                ctx.route = rule.name
+                metrics.incr('route.' + rule.name + '.handled')
+                return rule.name
 
+        ctx.route = 'unhandled'
+        metrics.incr('route.unhandled')
+        return None
 
-def image_send_message_dir(img_dir):
-    image_name = random.choice([os.path.basename(f) for f in (
-        glob.glob(os.path.join(img_dir, '*.jpg')))])
-    image_url = os.path.join(AP_URL, img_dir, image_name)
-    image_thumb_url = os.path.join(AP_URL, img_dir, 'thumb', image_name)
 
-    message = ImageSendMessage(
-        original_content_url=image_url,
-        preview_image_url=image_thumb_url
-    )
-    print('[Image Log] image_send_message_dir image_url=' + image_url)
-    return message
+text_router = _Text_Router()
 
+@app.route('/')
+def hello_world():
+    return 'にゃー'
 
-def image_send_message_list(img_dir, img_list):
-    image_name = random.choice(img_list)
-    image_url = os.path.join(AP_URL, img_dir, image_name)
-    image_thumb_url = os.path.join(AP_URL, img_dir, 'thumb', image_name)
 
-    message = ImageSendMessage(
-        original_content_url=image_url,
-        preview_image_url=image_thumb_url
-    )
-    print('[Image Log] image_send_message_list image_url=' + image_url)
-    return message
+@app.route('/img/<path:key>')
+def image_proxy(key):
+    if not image_proxy_allowed(key):
+        abort(404)
 
+    expires = image_proxy_verify(key, request.args.get('e'), request.args.get('s'))
+    if expires is None:
+        abort(403)
 
-def restaurant_image_url(restaurant):
-    image_name = restaurant + '.jpg'
-    image_url = os.path.join(AP_URL, 'static/restaurantimg', image_name)
+    try:
+        opened = image_cache.get_or_fill(key, _fill_image_from_s3)
+    except (_Dependency_Unavailable, botocore_exceptions.BotoCoreError, botocore_exceptions.ClientError) as e:
+        print('[Except Log] image_proxy key=' + key + ' error=' + repr(e))
+        abort(503)
 
-    print('[Debug] restaurant_image_url:' + image_url)
-    return image_url
+    if opened is None:
+        abort(404)
 
+    (f, size, etag) = opened
 
-def warning_messages():
-    warning_entity = Entity
-    warning_entity.match = True
-    warning_entity.name = '@warning'
+    # URLの期限を越えてキャッシュさせない
+    max_age = max(0, min(IMAGE_PROXY_MAX_AGE, int(expires - time.time())))
 
-    messages = text_send_messages_db(warning_entity)
+    response = send_file(f,
+        mimetype=image_cache.content_type(key),
+        add_etags=False, cache_timeout=max_age)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=' + str(max_age) + ', immutable'
 
-    return messages
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
 
 
-def restaurant_message_text():
-    text = random.choice([
-        '猫', 'ねこ', 'ネコ', 'cat', 'neko', 'ひめ','ちゅーる'
-    ])
-    return text
+def _check_admin_token():
+    if not ADMIN_API_TOKEN:
+        abort(404)
 
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        abort(403)
 
-def get_line_id(event):
-    try:
-        if isinstance(event.source, SourceUser):
-            #profile = line_bot_api.get_profile(event.source.user_id)
 
-            user_id = event.source.user_id
-            group_id = ''
-            room_id = ''
+@app.route('/admin/dictionary', methods=['GET', 'POST'])
+def admin_dictionary():
+    _check_admin_token()
 
-        elif isinstance(event.source, SourceGroup):
-            #profile = line_bot_api.get_group_member_profile(
-            #    event.source.group_id, event.source.user_id)
+    if request.method == 'POST':
+        snapshot = dictionary_snapshots.reload()
+    else:
+        snapshot = dictionary_snapshots.current()
 
-            user_id = event.source.user_id
-            group_id = event.source.group_id
-            room_id = ''
+    return jsonify(
+        active=snapshot.get_status(),
+        last_error=dictionary_snapshots.last_error,
+    )
 
-        elif isinstance(event.source, SourceRoom):
-            #profile = line_bot_api.get_room_member_profile(
-            #    event.source.room_id, event.source.user_id)
 
-            user_id = event.source.user_id
-            group_id = ''
-            room_id = event.source.room_id
+@app.route('/ready')
+def ready():
+    # Procfile以外から起動された場合もここで始める
+    status = warmup.start().get_status()
+    return jsonify(status), (200 if status['ready'] else 503)
 
-    except:
-        user_id = ''
-        group_id = ''
-        room_id = ''
 
-    return user_id, group_id, room_id
+@app.route('/admin/metrics')
+def admin_metrics():
+    _check_admin_token()
 
-@app.route('/')
-def hello_world():
-    return 'にゃー'
+    return jsonify(
+        metrics=metrics.snapshot(),
+        extraction_cache=extraction_cache.get_status(),
+        db_pool=db_pool.get_status(),
+        s3_clients=s3_clients.get_status(),
+        event_store=event_store.get_status(),
+        breakers={breaker.name: breaker.get_status() for breaker in (db_breaker, s3_breaker, http_breaker)},
+        import_profile=import_profile,
+        startup_elapsed=startup_elapsed,
+    )
 
 
 @app.route('/callback', methods=['POST'])
@@ -1174,377 +4947,371 @@ def callback():
     return 'OK'
 
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event):
+#Entity完全一致の判定
 
-    epsilon = 0.1
-    text = event.message.text
-    textn = my_normalize(text)
+_SPECIAL_EPSILON = 0.1
 
-    intent = Intent(textn).check_intent(False)
-    entity_exact = Entity(textn).check_entity(True)
-    entity_partial = Entity(textn).check_entity(False)
-    setting = Setting()
-    
-    #古い判定
-    message_pattern = get_message_pattern(textn)
+# スペシャル判定
+@text_router.rule('exact', entity=('@gatarou', '@ghost'))
+def _route_special(ctx):
+    if _SPECIAL_EPSILON <= random.random():
+        replies = warning_messages()
 
-    user_id, group_id, room_id = get_line_id(event)
-    print('[Event Log]'
-        + ' text_message'
-        + ' user_id=' + str(user_id)
-        + ' group_id=' + str(group_id)
-        + ' room_id=' + str(room_id)
-        + ' text=' + str(text)
-        + ' textn=' + str(textn)
-        + ' intent.name=' + str(intent.name)
-        + ' entity_exact.name=' + str(entity_exact.name)
-        + ' entity_partial.name=' + str(entity_partial.name)
+    else:
+        (replies, images) = fan_out.run(
+            lambda: text_send_messages_db(ctx.entity_exact),
+            lambda: image_send_messages_s3(ctx.entity_exact.category),
+        )
+        replies[1:0] = images
+
+    ctx.reply(replies)
+    return True
+
+
+def _tabelog_carousel_message():
+    t_select = Tabelog().select
+    t_select.select_tanelog_links()
+
+    if t_select.selected_count <= 0:
+        return None
+
+    return TemplateSendMessage(
+        alt_text='Tabelog Carousel',
+        template=CarouselTemplate(columns=t_select.carousel_columns())
     )
 
-    send_text = ''
 
-    #Entity完全一致の判定
-    if entity_exact.match:
-        
-        # スペシャル判定
-        if entity_exact.name in {
-            '@gatarou','@ghost',
-        }:
+#飲みいく判定（食べログカルーセルを表示）
+@text_router.rule('exact', entity='@godrinking')
+def _route_godrinking(ctx):
+    template_message = _tabelog_carousel_message()
+    if template_message is None:
+        return False
 
-            if epsilon <= random.random():
-                replies = warning_messages()
-                
-            else:
-                replies = text_send_messages_db(entity_exact)
-                replies[1:0] = image_send_messages_s3(entity_exact.category)
+    ctx.reply(text_send_messages_db(ctx.entity_exact) + [template_message])
+    return True
 
-            line_bot_api.reply_message(event.reply_token, replies)
-            return
 
-        #飲みいく判定（食べログカルーセルを表示）
-        elif entity_exact.name in {
-            '@godrinking'
-        }:
+def _reply_tabelog_flex(ctx, entity):
+    flex = Tabelog().select.flex_send_message_entity(entity)
+    if not flex:
+        return False
 
-            t_select = Tabelog().select
-            t_select.select_tanelog_links()
+    ctx.reply_event('@event.tabelog.flex', [flex])
+    return True
 
-            if t_select.selected_count > 0:
 
-                template_message = TemplateSendMessage(
-                    alt_text='Tabelog Carousel',
-                    template=CarouselTemplate(columns=t_select.carousel_columns())
-                )
+#tabelogリンク判定
+@text_router.rule('exact', entity_prefix='@tabelog_')
+def _route_tabelog_exact(ctx):
+    return _reply_tabelog_flex(ctx, ctx.entity_exact)
 
-                replies = text_send_messages_db(entity_exact) + [template_message]
-                line_bot_api.reply_message(event.reply_token,replies)
 
-                return
+# イヌ判定（テキストを返信して退出）
+@text_router.rule('exact', entity='@dog')
+def _route_dog(ctx):
+    ctx.reply(text_send_messages_db(ctx.entity_exact, ctx.textn))
 
-        #tabelogリンク判定
-        elif entity_exact.name.startswith('@tabelog_'):
+    if isinstance(ctx.event.source, SourceGroup):
+        line_bot_api.leave_group(ctx.event.source.group_id)
+    elif isinstance(ctx.event.source, SourceRoom):
+        line_bot_api.leave_room(ctx.event.source.room_id)
 
-            t_select = Tabelog().select
-            flex = t_select.flex_send_message_entity(entity_exact)
+    return True
 
-            if flex:
-                entity_event = Entity('').set_name('@event.tabelog.flex')
-                replies = text_send_messages_db(entity_event)
-                replies.append(flex)
-                line_bot_api.reply_message(event.reply_token, replies)
-                
-                return
 
-        # イヌ判定（テシストを返信して退出）
-        elif entity_exact.name in {
-            '@dog'
-        }:
+# テキスト返信判定
+@text_router.rule('exact', partial_entity='@nomicomm')
+def _route_nomicomm_exact(ctx):
+    ctx.reply(text_send_messages_db(ctx.entity_exact))
+    return True
 
-            replies = text_send_messages_db(entity_exact, textn)
-            line_bot_api.reply_message(event.reply_token, replies)
 
-            if isinstance(event.source, SourceGroup):
-                line_bot_api.leave_group(event.source.group_id)
-            elif isinstance(event.source, SourceRoom):
-                line_bot_api.leave_room(event.source.room_id)
+#テキスト＋画像返信判定
+@text_router.rule('exact', default=True)
+def _route_text_image(ctx):
+    (texts, images) = fan_out.run(
+        lambda: text_send_messages_db(ctx.entity_exact),
+        lambda: image_send_messages_s3(ctx.entity_exact.category),
+    )
 
-            return
+    replies = texts + images
+    if not replies:
+        return False
 
-        # テキスト返信判定
-        elif entity_partial.name in {
-            '@nomicomm',
-        }:
+    ctx.reply(replies)
+    return True
 
-            replies = text_send_messages_db(entity_exact)
-            line_bot_api.reply_message(event.reply_token, replies)
-            
-            return
 
-        #テキスト＋画像返信判定
-        else:
-            replies = text_send_messages_db(entity_exact) + image_send_messages_s3(entity_exact.category)
-            if replies:
-                line_bot_api.reply_message(event.reply_token,replies)
-                return
+#Intent一致の判定
 
-    #Intent一致の判定
-    if intent.match:
+_ISBAD_EVENTS = {
+    '@kitada': '@event.isbad.positive',
+    '@wakamatsu': '@event.isbad.positive',
+    '@yoneda': '@event.isbad.positive',
+    '@ozeki': '@event.isbad.positive',
+    '@yoshi': '@event.isbad.negative',
+}
 
-        if intent.name in {
-            '#is_bad','#bad_is',
-        }:
-        
-            if entity_partial.match:
-
-                if entity_partial.name in {
-                    '@kitada','@wakamatsu','@yoneda','@ozeki',
-                }:
-                    entity_event = Entity('').set_name('@event.isbad.positive')
-                    replies = text_send_messages_db(entity_event)
-                    line_bot_api.reply_message(event.reply_token, replies)
-                    return
-                    
-                elif entity_partial.name in {
-                    '@yoshi'
-                }:
-                    entity_event = Entity('').set_name('@event.isbad.negative')
-                    replies = text_send_messages_db(entity_event)
-                    line_bot_api.reply_message(event.reply_token, replies)
-                    return
+_UPLOAD_TARGETS = {
+    '@neko_image': ('image/neko/', 'ねこ画像を送って'),
+    '@neko_cyu-ru_image': ('image/neko_cyu-ru/', 'ちゅーる画像を送って'),
+    '@kitada_image': ('image/kitada/', '北田さん画像を送って'),
+    '@wakamatsu_image': ('image/gakky/', '若松さん（ガッキー）画像を送って'),
+    '@tebelog_link': ('tabelog/godrinking/', '食べログのリンク送って'),
+    '@tabelog_izakaya': ('tabelog/godrinking/', '食べログのリンク送って'),
+}
 
-        elif intent.name == '#change_setting':
-            
-            if setting.check_admin_line_user(user_id):
 
-                if entity_partial.match:
-                    if entity_partial.position < intent.position:
-                    
-                        if entity_partial.name == '@access_management':
+def _entity_before_intent(ctx):
+    return ctx.entity_partial.match and ctx.entity_partial.position < ctx.intent.position
 
-                            if setting.enable_access_management == 'True':
-                                setting = setting.update_enable_access_management('False')
-                                send_text = 'にゃー（アクセス管理 オフ）'
-                            else:
-                                setting = setting.update_enable_access_management('True')
-                                send_text = 'にゃー（アクセス管理 オン）'
 
-                        if send_text != '':
-                            line_bot_api.reply_message(
-                                event.reply_token, TextMessage(text=send_text))
+@text_router.rule('intent', intent=('#is_bad', '#bad_is'))
+def _route_is_bad(ctx):
+    if not ctx.entity_partial.match:
+        return False
 
-                        return
+    event_name = _ISBAD_EVENTS.get(ctx.entity_partial.name)
+    if event_name is None:
+        return False
 
-        elif intent.name == '#change_setting_on':
-            
-            if setting.check_admin_line_user(user_id):
+    ctx.reply_event(event_name)
+    return True
 
-                if entity_partial.match:
-                    if entity_partial.position < intent.position:
-                    
-                        if entity_partial.name == '@access_management':
 
-                            if setting.enable_access_management == 'True':
-                                send_text = 'すでにアクセス管理は有効だよ'
-                            else:
-                                setting = setting.update_enable_access_management('True')
-                                send_text = 'にゃー（アクセス管理 オン）'
+@text_router.rule('intent', intent='#change_setting')
+def _route_change_setting(ctx):
+    if not ctx.setting.check_admin_line_user(ctx.user_id) or not _entity_before_intent(ctx):
+        return False
 
-                        if send_text != '':
-                            line_bot_api.reply_message(
-                                event.reply_token, TextMessage(text=send_text))
+    send_text = ''
+    if ctx.entity_partial.name == '@access_management':
 
-                        return
+        if ctx.setting.enable_access_management == 'True':
+            ctx.setting.update_enable_access_management('False')
+            send_text = 'にゃー（アクセス管理 オフ）'
+        else:
+            ctx.setting.update_enable_access_management('True')
+            send_text = 'にゃー（アクセス管理 オン）'
 
-        elif intent.name == '#change_setting_off':
-            
-            if setting.check_admin_line_user(user_id):
+    ctx.reply_text(send_text)
+    return True
 
-                if entity_partial.match:
-                    if entity_partial.position < intent.position:
-                    
-                        if entity_partial.name == '@access_management':
 
-                            if setting.enable_access_management == 'True':
-                                setting = setting.update_enable_access_management('False')
-                                send_text = 'にゃー（アクセス管理 オフ）'
-                            else:
-                                send_text = 'すでにアクセス管理は無効だよ'
+@text_router.rule('intent', intent='#change_setting_on')
+def _route_change_setting_on(ctx):
+    if not ctx.setting.check_admin_line_user(ctx.user_id) or not _entity_before_intent(ctx):
+        return False
 
-                            if send_text != '':
-                                line_bot_api.reply_message(
-                                    event.reply_token, TextMessage(text=send_text))
+    send_text = ''
+    if ctx.entity_partial.name == '@access_management':
 
-                            return
-                    
-                        elif entity_partial.name == '@current_upload_category':
-                            if entity_partial.position < intent.position:
+        if ctx.setting.enable_access_management == 'True':
+            send_text = 'すでにアクセス管理は有効だよ'
+        else:
+            ctx.setting.update_enable_access_management('True')
+            send_text = 'にゃー（アクセス管理 オン）'
 
-                                setting.update_current_upload_category('')
-                                send_text = 'にゃー（アップロード機能 オフ）'
+    ctx.reply_text(send_text)
+    return True
 
-                            if send_text != '':
-                                line_bot_api.reply_message(
-                                    event.reply_token, TextMessage(text=send_text))
 
-                            return
+@text_router.rule('intent', intent='#change_setting_off')
+def _route_change_setting_off(ctx):
+    if not ctx.setting.check_admin_line_user(ctx.user_id) or not _entity_before_intent(ctx):
+        return False
 
-        elif intent.name == '#change_upload_target':
+    if ctx.entity_partial.name == '@access_management':
 
-            if setting.check_access_allow(user_id):
+        if ctx.setting.enable_access_management == 'True':
+            ctx.setting.update_enable_access_management('False')
+            send_text = 'にゃー（アクセス管理 オフ）'
+        else:
+            send_text = 'すでにアクセス管理は無効だよ'
 
-                if entity_partial.match:
-                    if entity_partial.position < intent.position:
+    elif ctx.entity_partial.name == '@current_upload_category':
+        ctx.setting.update_current_upload_category('')
+        send_text = 'にゃー（アップロード機能 オフ）'
 
-                        if entity_partial.name == '@neko_image':
-                            setting.update_current_upload_category('image/neko/')
-                            send_text = 'ねこ画像を送って'
+    else:
+        return False
 
-                        elif entity_partial.name == '@neko_cyu-ru_image':
-                            setting.update_current_upload_category('image/neko_cyu-ru/')
-                            send_text = 'ちゅーる画像を送って'
+    ctx.reply_text(send_text)
+    return True
 
-                        elif entity_partial.name == '@kitada_image':
-                            setting.update_current_upload_category('image/kitada/')
-                            send_text = '北田さん画像を送って'
 
-                        elif entity_partial.name == '@wakamatsu_image':
-                            setting.update_current_upload_category('image/gakky/')
-                            send_text = '若松さん（ガッキー）画像を送って'
+@text_router.rule('intent', intent='#change_upload_target')
+def _route_change_upload_target(ctx):
+    if not ctx.setting.check_access_allow(ctx.user_id) or not _entity_before_intent(ctx):
+        return False
 
-                        elif entity_partial.name in {
-                            '@tebelog_link', '@tabelog_izakaya',
-                        }:
-                            setting.update_current_upload_category('tabelog/godrinking/')
-                            send_text = '食べログのリンク送って'
+    send_text = ''
+    target = _UPLOAD_TARGETS.get(ctx.entity_partial.name)
+    if target is not None:
+        (category, send_text) = target
+        ctx.setting.update_current_upload_category(category)
 
-                        if send_text != '':
-                            line_bot_api.reply_message(
-                                event.reply_token, TextMessage(text=send_text))
+    ctx.reply_text(send_text)
+    return True
 
-                        return
 
-        elif intent.name == '#check_setting':
+@text_router.rule('intent', intent='#check_setting')
+def _route_check_setting(ctx):
+    if not _entity_before_intent(ctx):
+        return False
 
-            if entity_partial.match:
-                if entity_partial.position < intent.position:
+    send_text = ''
+    if ctx.entity_partial.name == '@access_management':
+        if ctx.setting.enable_access_management == 'True':
+            send_text = 'アクセス管理 オンだよ'
+        else:
+            send_text = 'アクセス管理 オフだよ'
 
-                    if entity_partial.name == '@access_management':
-                        if setting.enable_access_management == 'True':
-                            send_text = 'アクセス管理 オンだよ'
-                        else:
-                            send_text = 'アクセス管理 オフだよ'
+    elif ctx.entity_partial.name == '@current_upload_category':
+        if ctx.setting.current_upload_category == '':
+            send_text = 'アップロード機能はオフだよ'
+        else:
+            send_text = '現在のアップロードカテゴリ： ' + ctx.setting.current_upload_category
 
-                    elif entity_partial.name == '@current_upload_category':
-                        if setting.current_upload_category == '':
-                            send_text = 'アップロード機能はオフだよ'
-                        else:
-                            send_text = '現在のアップロードカテゴリ： ' + setting.current_upload_category
+    ctx.reply_text(send_text)
+    return True
 
-                    if send_text != '':
-                        line_bot_api.reply_message(
-                            event.reply_token, TextMessage(text=send_text))
 
-                    return
+def _start_batch(name, func, *args):
+    # 管理用のバッチは返信の期限の外（別スレッド）で最後まで回す
+    def run():
+        start = time.perf_counter()
+        try:
+            func(*args)
+        except Exception as e:
+            print('[Except Log] batch=' + name + ' error=' + repr(e))
+            return
 
-        elif intent.name == '#update':
-            
-            if entity_partial.match:
-                if entity_partial.position < intent.position:
+        print('[Debug] batch=' + name + ' elapsed=' + '{:.1f}'.format(time.perf_counter() - start))
 
-                    if entity_partial.name == '@thumb':
-                        if setting.enable_access_management == 'True':
+    thread = threading.Thread(target=run, name='batch-' + name, daemon=True)
+    thread.start()
+    return thread
 
-                            send_text = 'サムネイル更新しとく'
-                            line_bot_api.reply_message(
-                                event.reply_token, TextMessage(text=send_text))
 
-                            update_s3_thumb_bach('image')
+@text_router.rule('intent', intent='#update')
+def _route_update(ctx):
+    if not _entity_before_intent(ctx):
+        return False
 
-                    elif entity_partial.name == '@tebelog_link':
-                        if setting.enable_access_management == 'True':
+    if ctx.entity_partial.name == '@thumb':
+        (send_text, name, func, args) = (
+            'サムネイル更新しとく', 'update_s3_thumb', update_s3_thumb_bach, ('image',))
+    elif ctx.entity_partial.name == '@tebelog_link':
+        (send_text, name, func, args) = (
+            '食べログ更新しとく', 'update_tabelog_link', lambda: Tabelog().update.update_link_batch(), ())
+    else:
+        return True
 
-                            send_text = '食べログ更新しとく'
-                            line_bot_api.reply_message(
-                                event.reply_token, TextMessage(text=send_text))
+    if ctx.setting.enable_access_management != 'True':
+        return True
 
-                            t_update = Tabelog().update
-                            t_update.update_link_batch()
+    # 実行できるコマンドのときだけ枠を使う
+    command = ctx.intent.name + ' ' + ctx.entity_partial.name
+    if not flood_control.allow_admin(ctx.event, command):
+        print('[Event Log]'
+            + ' throttled_admin_command'
+            + ' command=' + command
+            + ' source=' + flood_control.source_key(ctx.event)
+        )
+        ctx.reply_text('さっき更新したばかりだからちょっと待って')
+        return True
 
-                    return
+    ctx.reply_text(send_text)
+    _start_batch(name, func, *args)
 
+    return True
 
-    #Entity部分一致の判定
-    if entity_partial.match:
-        
-        # 飲みニケーション判定
-        if entity_partial.name in {
-            '@nomicomm',
-        }:
 
-            replies = text_send_messages_db(entity_partial)
-            line_bot_api.reply_message(event.reply_token,replies)
+#Entity部分一致の判定
 
-            return
+# 飲みニケーション判定
+@text_router.rule('partial', entity='@nomicomm')
+def _route_nomicomm_partial(ctx):
+    ctx.reply(text_send_messages_db(ctx.entity_partial))
+    return True
 
-        #tabelogリンク判定
-        elif entity_partial.name.startswith('@tabelog_'):
 
-            t_select = Tabelog().select
-            flex = t_select.flex_send_message_entity(entity_partial)
-            
-            if flex:
-                entity_event = Entity('').set_name('@event.tabelog.flex')
-                replies = text_send_messages_db(entity_event)
-                replies.append(flex)
-                line_bot_api.reply_message(event.reply_token, replies)
-                
-                return
+#tabelogリンク判定
+@text_router.rule('partial', entity_prefix='@tabelog_')
+def _route_tabelog_partial(ctx):
+    return _reply_tabelog_flex(ctx, ctx.entity_partial)
 
-    # test判定
-    send_text = ''
-    if message_pattern == 'test':
 
-        t_select = Tabelog().select
-        t_select.select_tanelog_links()
+# test判定
+@text_router.rule('pattern', pattern='test')
+def _route_test(ctx):
+    template_message = _tabelog_carousel_message()
+    if template_message is None:
+        return False
 
-        if t_select.selected_count > 0:
+    ctx.reply(
+        [
+            TextSendMessage(text=random.choice(['tabelog test','食べログ テスト'])),
+            template_message,
+        ]
+    )
+    return True
 
-            template_message = TemplateSendMessage(
-                alt_text='Tabelog Carousel',
-                template=CarouselTemplate(columns=t_select.carousel_columns())
-            )
 
-            line_bot_api.reply_message(event.reply_token,
-                [
-                    TextSendMessage(text=random.choice(['tabelog test','食べログ テスト'])),
-                    template_message,
-                ]
-            )
-            return
+#食べログのリンク判定
+@text_router.rule('fallback', default=True)
+def _route_tabelog_link(ctx):
+    if not ctx.setting.check_access_allow(ctx.user_id):
+        return False
 
-    #食べログのリンク判定
-    if setting.check_access_allow(user_id):
-        if setting.current_upload_category == 'tabelog/godrinking/':
-            
-            t_insert = Tabelog().insert
-            t_insert.set_target_url(text)
+    if ctx.setting.current_upload_category != 'tabelog/godrinking/':
+        return False
 
-            if t_insert.url_exists():
-                entity_event = Entity('').set_name('@event.exist.tabeloglink')
-                replies = text_send_messages_db(entity_event)
-                line_bot_api.reply_message(event.reply_token,replies)
+    t_insert = Tabelog().insert
+    t_insert.set_target_url(ctx.text)
 
-                return
+    if t_insert.url_exists():
+        ctx.reply_event('@event.exist.tabeloglink')
+        return True
 
-            if t_insert.is_tabelog_domain():
-                entity_event = Entity('').set_name('@event.get.tabeloglink')
-                replies = text_send_messages_db(entity_event)
-                line_bot_api.reply_message(event.reply_token,replies)
+    if t_insert.is_tabelog_domain():
+        ctx.reply_event('@event.get.tabeloglink')
+        t_insert.insert_tabelog_link()
+        return True
 
-                t_insert.insert_tabelog_link()
+    return False
 
-                return
+
+text_router.compile()
+
+
+@handler.add(MessageEvent, message=TextMessage)
+def handle_text_message(event):
+
+    text = event.message.text
+    textn = my_normalize(text)
+
+    extraction = Extraction(textn).extract()
+    ctx = _Route_Context(event, text, textn, extraction)
+
+    print('[Event Log]'
+        + ' text_message'
+        + ' user_id=' + str(ctx.user_id)
+        + ' group_id=' + str(ctx.group_id)
+        + ' room_id=' + str(ctx.room_id)
+        + ' text=' + str(text)
+        + ' textn=' + str(textn)
+        + ' intent.name=' + str(ctx.intent.name)
+        + ' entity_exact.name=' + str(ctx.entity_exact.name)
+        + ' entity_partial.name=' + str(ctx.entity_partial.name)
+        + ' intent_hits=' + ','.join(hit.name for hit in extraction.intents)
+        + ' entity_hits=' + ','.join(hit.name for hit in extraction.entities)
+    )
+    with logging_event('text_message', event, text=text, intent=ctx.intent.name,
+            entity_exact=ctx.entity_exact.name, entity_partial=ctx.entity_partial.name):
+        text_router.dispatch(ctx)
 
 
 @handler.add(MessageEvent, message=ImageMessage)
@@ -1563,44 +5330,204 @@ def handle_image_message(event):
         + ' room_id=' + str(room_id)
         + ' current_upload_category=' + str(setting.current_upload_category)
     )
-
-    if setting.check_access_allow(user_id):
-        if setting.current_upload_category.split('/')[0] == 'image':
+    with logging_event('image_message', event, text=setting.current_upload_category):
+        if setting.check_access_allow(user_id):
+            if setting.current_upload_category.split('/')[0] == 'image':
             
-            entity_event = Entity('').set_name('@event.get.image')
-            replies = text_send_messages_db(entity_event)
-            line_bot_api.reply_message(event.reply_token,replies)
-
-            message_content = line_bot_api.get_message_content(event.message.id)
+                message_content = line_bot_api.get_message_content(event.message.id)
 
-            with tempfile.NamedTemporaryFile(dir=static_tmp_path, prefix=str_now+'-', delete=False) as tf:
-                for chunk in message_content.iter_content():
-                    tf.write(chunk)
+                with tempfile.NamedTemporaryFile(dir=static_tmp_path, prefix=str_now+'-', delete=False) as tf:
+                    for chunk in message_content.iter_content(LINE_CONTENT_CHUNK_SIZE):
+                        tf.write(chunk)
                 
-                tf_path = tf.name
+                    tf_path = tf.name
 
-            dist_path = tf_path + extension
-            os.rename(tf_path, dist_path)
-            
-            image_key = upload_to_s3_category(dist_path, setting.current_upload_category)
-            thumb_key = create_s3_thumb(image_key)
+                dist_path = tf_path + extension
+                os.rename(tf_path, dist_path)
 
-            print('[Image Log]'
-                    + ' image_message'
-                    + ' upload_image'
-                    + ' image_key=' + str(image_key)
-                    + ' thumb_key=' + str(thumb_key)
-            )
+                entity_event = Entity('').set_name('@event.get.image')
+                replies = text_send_messages_db(entity_event)
+                line_sender.reply(event, replies)
+
+                #重複画像の判定（返信の後に行い、重複ならアップロードしない）
+                image_hash = None
+                if image_hashes.enabled:
+                    try:
+                        image_hash = image_dhash(dist_path)
+                    except (OSError, ValueError, Image.DecompressionBombError) as e:
+                        # 読めない画像は重複判定だけ飛ばす
+                        print('[Except Log] image_message image_dhash error=' + repr(e))
+
+                if image_hash is not None:
+                    duplicate = image_hashes.find_duplicate(image_hash)
+
+                    if duplicate:
+                        print('[Image Log]'
+                                + ' image_message'
+                                + ' duplicate_image'
+                                + ' distance=' + str(duplicate[0])
+                                + ' image_key=' + str(duplicate[1])
+                        )
+
+                        os.remove(dist_path)
+                        return
 
-            return
+                image_key = upload_to_s3_category(dist_path, setting.current_upload_category)
+                thumb_key = create_s3_thumb(image_key)
+
+                if image_hash is not None:
+                    try:
+                        image_hashes.add(image_key, setting.current_upload_category, image_hash)
+                    except (psycopg2.Error, _Dependency_Unavailable) as e:
+                        print('[Except Log] image_message image_hashes.add error=' + repr(e))
+
+                print('[Image Log]'
+                        + ' image_message'
+                        + ' upload_image'
+                        + ' image_key=' + str(image_key)
+                        + ' thumb_key=' + str(thumb_key)
+                )
+
+                return
 
 @handler.add(JoinEvent)
 def handle_join(event):
     entity_event = Entity('').set_name('@event.join')
     replies = text_send_messages_db(entity_event)
-    line_bot_api.reply_message(event.reply_token,replies)
+    line_sender.reply(event, replies)
+
+
+class _Warmup:
+    """起動直後の最初のWebhookが接続やクライアント生成の待ちを払わないように先に済ませる"""
+
+    def __init__(self, timeout=WARMUP_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = None
+        self._phases = collections.defaultdict(list)
+        self.started_at = None
+        self.finished_at = None
+        self.steps = collections.OrderedDict()
+
+    def step(self, name, phase=0):
+        def decorator(func):
+            self._phases[phase].append((name, func))
+            return func
+        return decorator
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return self
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name='warmup', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run_step(self, name, func):
+        start = time.perf_counter()
+        try:
+            func()
+            error = ''
+        except Exception as e:
+            error = repr(e)
+            print('[Except Log] warmup step=' + name + ' error=' + error)
+
+        self.steps[name] = {'elapsed': time.perf_counter() - start, 'error': error}
+
+    def _run(self):
+        # 各依存先のタイムアウトは全体の残り時間で頭打ちにする
+        with latency_budget.start(self.started_at + self.timeout):
+            for phase in sorted(self._phases):
+                fan_out.run(*[functools.partial(self._run_step, name, func)
+                    for (name, func) in self._phases[phase]])
+
+        self.finished_at = time.time()
+        self._done.set()
+
+        print('[Debug] warmup finished'
+            + ' elapsed=' + '{:.3f}'.format(self.finished_at - self.started_at)
+            + ' errors=' + ','.join(name for name, step in self.steps.items() if step['error'])
+        )
+
+    @property
+    def timed_out(self):
+        return (not self._done.is_set() and self.started_at is not None
+            and time.time() >= self.started_at + self.timeout)
+
+    @property
+    def ready(self):
+        # 時間内に終わらなければ残りは裏で続けつつ受け付ける
+        return self._done.is_set() or self.timed_out
+
+    def get_status(self):
+        return {
+            'ready': self.ready,
+            'finished': self._done.is_set(),
+            'timed_out': self.timed_out,
+            'elapsed': ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0,
+            'steps': dict(self.steps),
+        }
+
+
+warmup = _Warmup()
+
+
+@warmup.step('db')
+def _warmup_db():
+    if db_pool.enabled:
+        db_pool.warm()
+    else:
+        with _db_connect() as conn:
+            with conn.cursor() as curs:
+                curs.execute('SELECT 1;')
+
+
+@warmup.step('s3')
+def _warmup_s3():
+    # 期限いっぱいの組を作っておけば最初のリクエストはそれを使う
+    with latency_budget.start(time.time() + latency_budget.seconds):
+        get_s3_client()
+    my_s3_presigned_url('warmup')
+
+
+@warmup.step('line')
+def _warmup_line():
+    # api.line.meへのTLS接続をkeep-aliveのプールに入れておく
+    session = getattr(line_bot_api.http_client, 'session', None)
+    if session is not None:
+        session.head(LineBotApi.DEFAULT_API_ENDPOINT, timeout=latency_budget.timeout(LINE_CONNECT_TIMEOUT))
+
+
+@warmup.step('dictionary')
+def _warmup_dictionary():
+    dictionary_snapshots.current()
+
+
+@warmup.step('image_hashes')
+def _warmup_image_hashes():
+    if image_hashes.enabled:
+        image_hashes.keys()
+
+
+@warmup.step('image_keys', phase=1)
+def _warmup_image_keys():
+    categories = [category for category in dictionary_snapshots.current().get_category_names()
+        if category.split('/')[0] == 'image']
+    fan_out.run(*[functools.partial(list_image_keys_s3, category) for category in categories])
+
+
+startup_elapsed = time.perf_counter() - _IMPORT_START
 
 
 if __name__ == "__main__":
+    print('[Debug] startup elapsed=' + '{:.3f}'.format(startup_elapsed))
+
+    # SIGTERMでもatexit（書き込みバッファのflush）を実行する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    warmup.start()
+
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import io
+import itertools
+import json
+import time
+import uuid
+import base64
+import hashlib
+import hmac
+import random
+import shutil
+import tempfile
+import threading
+import contextlib
+import collections
+import concurrent.futures
+
+import requests
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+DEFAULT_TEXTS = ('ねこ', '猫かわいい', 'いぬ', '飲もう', 'よしは悪い', 'こんにちは')
+
+#スタブDBに入れておく辞書
+_FIXTURE_INTENTS = [
+    (1, '#is_bad', 'は悪い', 10),
+]
+_FIXTURE_ENTITIES = [
+    (1, '@neko', 'ねこ', 10),
+    (2, '@neko', '猫', 10),
+    (3, '@dog', 'いぬ', 10),
+    (4, '@nomicomm', '飲もう', 10),
+    (5, '@yoshi', 'よし', 10),
+]
+_FIXTURE_CATEGORIES = {
+    '@neko': ['image/neko/'],
+}
+_FIXTURE_REPLIES = {
+    '@neko': [('にゃー',), ('にゃん', 'にゃーん')],
+    '@dog': [('わん',)],
+    '@nomicomm': [('飲もう',)],
+    '@event.isbad.negative': [('ひどい',)],
+    '@event.get.image': [('ありがとう',)],
+}
+_FIXTURE_IMAGE_KEYS = 50
+
+
+def _jpeg_bytes(seed, size=64):
+    from PIL import Image
+
+    rand = random.Random(seed)
+    img = Image.new('L', (size, size))
+    img.putdata([rand.randrange(256) for _ in range(size * size)])
+
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+class _Stub_Latency:
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def wait(self):
+        if self.seconds > 0:
+            # 平均がsecondsになるよう指数分布でばらつかせる
+            time.sleep(random.expovariate(1.0 / self.seconds))
+
+
+class _Stub_Line_Http_Client(RequestsHttpClient):
+    latency = _Stub_Latency(0)
+
+    def _response(self, url, stream=False):
+        self.latency.wait()
+
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        if url.endswith('/content'):
+            response.headers['Content-Type'] = 'image/jpeg'
+            response.raw = io.BytesIO(_jpeg_bytes(url))
+        else:
+            response.headers['Content-Type'] = 'application/json'
+            response._content = b'{}'
+
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._response(url, stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._response(url)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._response(url)
+
+
+class _Stub_Cursor:
+
+    def __init__(self, conn):
+        self.connection = conn
+        self.rowcount = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.connection.latency.wait()
+
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8')
+
+        self._rows = self.connection.respond(' '.join(sql.split()), params or ())
+        self.rowcount = len(self._rows)
+
+    def mogrify(self, template, args):
+        return b'(' + b','.join(b'%s' for _ in args) + b')'
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+class _Stub_Connection:
+    encoding = 'UTF8'
+
+    def __init__(self, latency, settings):
+        self.latency = latency
+        self.settings = settings
+
+    def respond(self, sql, params):
+        if 'FROM public.settings' in sql:
+            value = self.settings.get(params[0])
+            if value is None:
+                return []
+            elif isinstance(value, list):
+                return [(v,) for v in value]
+            else:
+                return [(value,)]
+
+        return []
+
+    def cursor(self):
+        return _Stub_Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Stub_S3_Object:
+
+    def __init__(self, key):
+        self.key = key
+
+    def load(self):
+        pass
+
+
+class _Stub_S3_Objects:
+
+    def __init__(self, s3):
+        self._s3 = s3
+
+    def filter(self, Prefix=''):
+        self._s3.latency.wait()
+        return [_Stub_S3_Object(key) for key in self._s3.keys if key.startswith(Prefix)]
+
+
+class _Stub_S3_Bucket:
+
+    def __init__(self, s3):
+        self._s3 = s3
+        self.objects = _Stub_S3_Objects(s3)
+
+    def Object(self, key):
+        return _Stub_S3_Object(key)
+
+    def download_file(self, key, path):
+        self._s3.latency.wait()
+        with open(path, 'wb') as f:
+            f.write(_jpeg_bytes(key))
+
+    def upload_file(self, path, key, **kwargs):
+        self._s3.latency.wait()
+
+
+class _Stub_S3:
+
+    def __init__(self, latency, keys):
+        self.latency = latency
+        self.keys = keys
+
+    # boto3.resource('s3')
+    def Bucket(self, name):
+        return _Stub_S3_Bucket(self)
+
+    # boto3.client('s3')
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600, HttpMethod='GET'):
+        return 'https://stub.s3.local/' + Params['Key'] + '?Expires=' + str(ExpiresIn)
+
+    def get_object(self, Bucket, Key):
+        self.latency.wait()
+        data = _jpeg_bytes(Key)
+        return {'Body': io.BytesIO(data), 'ETag': '"' + hashlib.md5(data).hexdigest() + '"'}
+
+    def upload_file(self, path, bucket, key, **kwargs):
+        self.latency.wait()
+
+
+def install_stubs(app, db_latency=0.002, s3_latency=0.02, line_latency=0.03,
+        upload_category='image/neko/', dictionary_file=None):
+    """app.pyのDB・S3・LINEをプロセス内のスタブに差し替える"""
+
+    settings = {
+        'enable_access_management': 'False',
+        'admin_line_user': [],
+        'current_upload_category': upload_category,
+    }
+    conn = _Stub_Connection(_Stub_Latency(db_latency), settings)
+
+    @contextlib.contextmanager
+    def _stub_db_connect(statement_timeout=None):
+        yield conn
+
+    app._db_connect = _stub_db_connect
+
+    keys = ['image/neko/{:04d}.jpg'.format(i) for i in range(_FIXTURE_IMAGE_KEYS)]
+    s3 = _Stub_S3(_Stub_Latency(s3_latency), keys)
+    app.get_s3_client = lambda: s3
+    app.get_s3_resource = lambda: s3
+
+    # 受信画像の一時ファイルが static/tmp に溜まらないようにする
+    app.static_tmp_path = tempfile.mkdtemp(prefix='nekobot-loadtest-')
+
+    _Stub_Line_Http_Client.latency = _Stub_Latency(line_latency)
+    app.line_bot_api = app.create_line_bot_api(http_client=_Stub_Line_Http_Client)
+
+    if dictionary_file:
+        app.dictionary_snapshots.path = dictionary_file
+        app.dictionary_snapshots.reload()
+    else:
+        dictionary = app._Dictionary(0, None)
+        dictionary.intents = list(_FIXTURE_INTENTS)
+        dictionary.entities = list(_FIXTURE_ENTITIES)
+        dictionary.categories = dict(_FIXTURE_CATEGORIES)
+        dictionary.replies = dict(_FIXTURE_REPLIES)
+        app.dictionary_snapshots._swap(dictionary.build())
+
+
+def remove_stubs_tmp(app):
+    shutil.rmtree(app.static_tmp_path, ignore_errors=True)
+
+
+class _Route_Recorder:
+    """reply_tokenごとにどのルートで処理されたかを記録する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def install(self, app):
+        dispatch = app.text_router.dispatch
+
+        def _dispatch(ctx):
+            route = dispatch(ctx)
+            self.set(ctx.event.reply_token, route or 'unhandled')
+            return route
+
+        app.text_router.dispatch = _dispatch
+
+    def set(self, reply_token, route):
+        with self._lock:
+            self._routes[reply_token] = route
+
+    def pop(self, reply_token, default):
+        with self._lock:
+            return self._routes.pop(reply_token, default)
+
+
+class Webhook_Generator:
+
+    def __init__(self, channel_secret, texts=DEFAULT_TEXTS, image_ratio=0.1, users=100):
+        self.channel_secret = channel_secret.encode('utf-8')
+        self.texts = texts
+        self.image_ratio = image_ratio
+        self.users = ['U' + uuid.uuid5(uuid.NAMESPACE_OID, str(i)).hex for i in range(users)]
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        with self._lock:
+            return next(self._seq)
+
+    def sign(self, body):
+        digest = hmac.new(self.channel_secret, body.encode('utf-8'), hashlib.sha256).digest()
+        return base64.b64encode(digest).decode('utf-8')
+
+    def event(self):
+        seq = self._next_id()
+        if random.random() < self.image_ratio:
+            message = {'type': 'image', 'id': str(10 ** 13 + seq)}
+        else:
+            message = {'type': 'text', 'id': str(10 ** 13 + seq), 'text': random.choice(self.texts)}
+
+        return {
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'webhookEventId': uuid.uuid4().hex.upper(),
+            'replyToken': uuid.uuid4().hex,
+            'source': {'type': 'user', 'userId': random.choice(self.users)},
+            'message': message,
+        }
+
+    def body(self, events=1):
+        events = [self.event() for _ in range(events)]
+        body = json.dumps({'destination': 'Uloadtest', 'events': events}, ensure_ascii=False)
+        return events, body, self.sign(body)
+
+
+class _Result:
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+    def add(self, latency, ok):
+        self.latencies.append(latency)
+        if not ok:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        samples = sorted(self.latencies)
+        count = len(samples)
+
+        def percentile(p):
+            return samples[min(count - 1, int(count * p))] if count else 0
+
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'error_rate': self.errors / count if count else 0,
+            'throughput': count / elapsed if elapsed else 0,
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': samples[-1] if samples else 0,
+        }
+
+
+class Load_Test:
+
+    def __init__(self, generator, url=None, app=None, recorder=None, events_per_body=1):
+        self.generator = generator
+        self.url = url
+        self.app = app
+        self.recorder = recorder
+        self.events_per_body = events_per_body
+        self._lock = threading.Lock()
+        self._results = collections.defaultdict(_Result)
+        self._local = threading.local()
+
+    def _post(self, body, signature):
+        headers = {'Content-Type': 'application/json', 'X-Line-Signature': signature}
+
+        if self.url:
+            session = getattr(self._local, 'session', None)
+            if session is None:
+                session = self._local.session = requests.Session()
+            return session.post(self.url, data=body.encode('utf-8'), headers=headers).status_code
+
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.app.test_client()
+        return client.post('/callback', data=body.encode('utf-8'), headers=headers).status_code
+
+    def _route(self, event):
+        if event['message']['type'] == 'image':
+            return 'image_message'
+        if self.recorder is None:
+            return 'text_message'
+        return self.recorder.pop(event['replyToken'], 'text_message')
+
+    def send(self, scheduled_at=None):
+        (events, body, signature) = self.generator.body(self.events_per_body)
+
+        # 予定時刻から測って送信待ちの時間も含める
+        start = scheduled_at or time.perf_counter()
+        try:
+            ok = self._post(body, signature) == 200
+        except Exception as e:
+            print('[Load Test] error=' + repr(e))
+            ok = False
+        latency = time.perf_counter() - start
+
+        with self._lock:
+            for event in events:
+                self._results[self._route(event)].add(latency, ok)
+            self._results['total'].add(latency, ok)
+
+    def run(self, duration, rps=0, concurrency=8):
+        start = time.perf_counter()
+        end = start + duration
+
+        if rps > 0:
+            # 一定間隔で投げる（応答を待たない）
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                n = 0
+                while True:
+                    scheduled_at = start + n / rps
+                    if scheduled_at >= end:
+                        break
+                    delay = scheduled_at - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    executor.submit(self.send, scheduled_at)
+                    n += 1
+
+        else:
+            # 各ワーカーが応答を待って次を投げる
+            def worker():
+                while time.perf_counter() < end:
+                    self.send()
+
+            threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.perf_counter() - start
+        return {name: result.summary(elapsed) for name, result in self._results.items()}
@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#起動時に読み込まれてはいけないモジュール
+LAZY_MODULES = ('boto3', 'botocore', 'PIL', 'bs4', 'neologdn')
+
+_COLDSTART_SCRIPT = '''
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+loaded = sorted(set(sys.modules) - before)
+print('[Coldstart] ' + json.dumps({'elapsed': elapsed, 'modules': loaded}))
+'''
+
+
+def _parse_importtime(stderr):
+    profile = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        cols = line[len('import time:'):].split('|')
+        if len(cols) != 3 or not cols[0].strip().isdigit():
+            continue
+
+        name = cols[2].rstrip()
+        # app自身とその直下のimportだけ集計
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth > 1:
+            continue
+
+        profile.append((name.strip(), int(cols[0]), int(cols[1])))
+
+    return profile
+
+
+def _run_coldstart():
+    env = dict(os.environ)
+    env.setdefault('LINE_CHANNEL_SECRET', 'coldstart')
+    env.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'coldstart')
+
+    cmd = [sys.executable]
+    if sys.version_info >= (3, 7):
+        cmd += ['-X', 'importtime']
+    cmd += ['-c', _COLDSTART_SCRIPT]
+
+    proc = subprocess.run(
+        cmd, cwd=BASE_DIR, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+
+    if proc.returncode != 0:
+        print(proc.stderr)
+        raise SystemExit('import app failed')
+
+    # atexitなど他の出力が混ざるので目印の行を探す
+    lines = [line for line in proc.stdout.splitlines() if line.startswith('[Coldstart] ')]
+    if not lines:
+        print(proc.stdout)
+        raise SystemExit('import app printed no result')
+
+    result = json.loads(lines[-1][len('[Coldstart] '):])
+    result['profile'] = _parse_importtime(proc.stderr)
+    return result
+
+
+def coldstart(args):
+    runs = [_run_coldstart() for _ in range(args.repeat)]
+    elapsed = sorted(run['elapsed'] for run in runs)
+    median = elapsed[len(elapsed) // 2]
+
+    print('[Coldstart] import app'
+        + ' runs=' + str(args.repeat)
+        + ' median=' + '{:.3f}'.format(median)
+        + ' min=' + '{:.3f}'.format(elapsed[0])
+        + ' max=' + '{:.3f}'.format(elapsed[-1])
+        + ' budget=' + '{:.3f}'.format(args.budget)
+    )
+
+    profile = sorted(runs[-1]['profile'], key=lambda p: p[2], reverse=True)
+    if profile:
+        print('[Coldstart] top imports (cumulative us)')
+        for name, self_us, cumulative_us in profile[:args.top]:
+            print('  {:>10} {:>10}  {}'.format(cumulative_us, self_us, name))
+
+    failed = False
+
+    eager = sorted({
+        module for module in runs[-1]['modules']
+        if module.split('.')[0] in LAZY_MODULES
+    })
+    if eager:
+        failed = True
+        print('[Coldstart] NG eager import: ' + ', '.join(eager))
+
+    if median > args.budget:
+        failed = True
+        print('[Coldstart] NG median exceeds budget')
+
+    if failed:
+        return 1
+
+    print('[Coldstart] OK')
+    return 0
+
+
+def _print_random_values_stats(label, stats):
+    print('[Random Values] ' + label
+        + ' table_size=' + str(stats['table_size'])
+        + ' rows=' + str(sum(stats['rows'].values()))
+    )
+    for category in sorted(stats['rows']):
+        print('  {:<30} rows={:<8} select_recent={:.4f}s'.format(
+            category, stats['rows'][category], stats['select_recent_latency'][category]))
+
+
+def compact_random_values(args):
+    import app
+
+    store = app.random_values
+
+    _print_random_values_stats('before', store.stats())
+
+    deleted = store.compact(dry_run=args.dry_run, retention=args.retention)
+    print('[Random Values] deleted=' + str(sum(deleted.values()))
+        + (' (dry run)' if args.dry_run else ''))
+
+    if args.vacuum and not args.dry_run:
+        store.vacuum()
+
+    _print_random_values_stats('after', store.stats())
+    return 0
+
+
+def import_tabelog(args):
+    import app
+
+    if args.file == '-':
+        urls = sys.stdin.read().splitlines()
+    else:
+        with open(args.file, encoding='utf-8') as f:
+            urls = f.read().splitlines()
+
+    summary = app.Tabelog().bulk.import_urls(
+        urls, workers=args.workers, rate=args.rate, dry_run=args.dry_run)
+
+    print('[Tabelog Import]'
+        + ' input=' + str(summary['input'])
+        + ' invalid=' + str(len(summary['invalid']))
+        + ' unique=' + str(summary['unique'])
+        + ' existing=' + str(summary['existing'])
+        + ' targets=' + str(summary['targets'])
+        + ' scraped=' + str(summary['scraped'])
+        + ' errors=' + str(len(summary['errors']))
+        + ' inserted=' + str(summary['inserted'])
+        + ' elapsed=' + '{:.1f}'.format(summary['elapsed'])
+        + (' (dry run)' if args.dry_run else '')
+    )
+    for url in summary['invalid']:
+        print('  invalid ' + url)
+    for url, error in summary['errors']:
+        print('  error   ' + url + ' ' + error)
+
+    return 1 if summary['errors'] else 0
+
+
+def upload_images(args):
+    import app
+
+    bulk = app._S3_Bulk_Upload(workers=args.workers, thumb_workers=args.thumb_workers)
+    summary = bulk.upload_dir(args.directory, args.category, dry_run=args.dry_run)
+
+    elapsed = summary['elapsed']
+    print('[Image Upload]'
+        + ' files=' + str(summary['files'])
+        + ' originals=' + str(summary['originals'])
+        + ' thumbs=' + str(summary['thumbs'])
+        + ' duplicates=' + str(len(summary['duplicates']))
+        + ' skipped=' + str(len(summary['skipped']))
+        + ' uploaded=' + str(summary['uploaded'])
+        + ' errors=' + str(len(summary['errors']))
+        + ' elapsed=' + '{:.1f}'.format(elapsed)
+        + (' (dry run)' if args.dry_run else '')
+    )
+    if summary['uploaded'] and elapsed > 0:
+        print('[Image Upload] throughput'
+            + ' {:.1f} objects/s'.format(summary['uploaded'] / elapsed)
+            + ' {:.2f} MB/s'.format(summary['bytes'] / elapsed / 1024 / 1024)
+        )
+    for key, existing_key in summary['duplicates']:
+        print('  duplicate ' + key + ' ~ ' + existing_key)
+    for key, reason in summary['skipped']:
+        print('  skipped ' + key + ' ' + reason)
+    for key, error in summary['errors']:
+        print('  error ' + key + ' ' + error)
+
+    return 1 if summary['errors'] else 0
+
+
+def phash_backfill(args):
+    import app
+
+    summary = app.backfill_image_hashes(prefix=args.prefix, workers=args.workers)
+
+    print('[Image Hash]'
+        + ' images=' + str(summary['images'])
+        + ' hashed=' + str(summary['hashed'])
+        + ' skipped=' + str(summary['skipped'])
+        + ' errors=' + str(len(summary['errors']))
+        + ' elapsed=' + '{:.1f}'.format(summary['elapsed'])
+    )
+    for key, error in summary['errors']:
+        print('  error ' + key + ' ' + error)
+
+    return 1 if summary['errors'] else 0
+
+
+def build_dictionary(args):
+    import app
+
+    try:
+        (dictionary, s3_keys, size) = app.build_dictionary_file(
+            args.path, with_s3_keys=args.s3)
+    except ValueError as e:
+        raise SystemExit('[Dictionary File] ' + str(e))
+
+    print('[Dictionary File] ' + args.path
+        + ' bytes=' + str(size)
+        + ' source_version=' + str(dictionary.source_version)
+        + ' intents=' + str(len(dictionary.intents))
+        + ' entities=' + str(len(dictionary.entities))
+        + ' replies=' + str(len(dictionary.replies))
+        + ' s3_keys=' + str(sum(len(keys) for keys in s3_keys.values()))
+    )
+    return 0
+
+
+def _print_loadtest_summary(name, summary):
+    print('  {:<32} requests={:<7} errors={:<5} ({:.1%}) rps={:<8.1f}'
+        ' p50={:.3f} p95={:.3f} p99={:.3f} max={:.3f}'.format(
+            name, summary['requests'], summary['errors'], summary['error_rate'],
+            summary['throughput'], summary['p50'], summary['p95'], summary['p99'], summary['max']))
+
+
+def loadtest(args):
+    import loadtest
+
+    app = None
+    recorder = None
+    if args.url:
+        channel_secret = os.environ['LINE_CHANNEL_SECRET']
+    else:
+        import app
+
+        loadtest.install_stubs(app,
+            db_latency=args.db_latency / 1000.0,
+            s3_latency=args.s3_latency / 1000.0,
+            line_latency=args.line_latency / 1000.0,
+            dictionary_file=args.dictionary_file)
+        app.flood_control.enabled = args.flood_control
+
+        recorder = loadtest._Route_Recorder()
+        recorder.install(app)
+        channel_secret = app.CHANNEL_SECRET
+
+    texts = args.text or loadtest.DEFAULT_TEXTS
+    generator = loadtest.Webhook_Generator(
+        channel_secret, texts=texts, image_ratio=args.image_ratio, users=args.users)
+    test = loadtest.Load_Test(generator, url=args.url, app=app, recorder=recorder,
+        events_per_body=args.events)
+
+    print('[Load Test]'
+        + ' target=' + (args.url or 'in-process stubs')
+        + ' duration=' + str(args.duration)
+        + (' rps=' + str(args.rps) if args.rps else '')
+        + ' concurrency=' + str(args.concurrency)
+        + ' events=' + str(args.events)
+    )
+
+    try:
+        summaries = test.run(args.duration, rps=args.rps, concurrency=args.concurrency)
+    finally:
+        if app is not None:
+            loadtest.remove_stubs_tmp(app)
+
+    total = summaries.pop('total', None)
+    for name in sorted(summaries):
+        _print_loadtest_summary(name, summaries[name])
+    if total:
+        _print_loadtest_summary('total (per webhook)', total)
+
+    return 1 if total is None or total['errors'] else 0
+
+
+def tabelog_reparse(args):
+    import app
+
+    if args.archive_dir:
+        app.tabelog_archive.root_dir = args.archive_dir
+    if not app.tabelog_archive.enabled:
+        raise SystemExit('set TABELOG_ARCHIVE_DIR or TABELOG_ARCHIVE_S3_PREFIX')
+
+    summary = app.Tabelog().update.reparse_archive(workers=args.workers, dry_run=args.dry_run)
+
+    print('[Tabelog Reparse]'
+        + ' rows=' + str(summary['rows'])
+        + ' archived=' + str(summary['archived'])
+        + ' missing=' + str(len(summary['missing']))
+        + ' parsed=' + str(summary['parsed'])
+        + ' errors=' + str(len(summary['errors']))
+        + ' updated=' + str(summary['updated'])
+        + ' elapsed=' + '{:.1f}'.format(summary['elapsed'])
+        + (' (dry run)' if args.dry_run else '')
+    )
+    for url in summary['missing']:
+        print('  missing ' + url)
+    for url, error in summary['errors']:
+        print('  error   ' + url + ' ' + error)
+
+    return 1 if summary['errors'] else 0
+
+
+_BENCH_SQL_POSITION = 'SELECT id, name, synonym, weight, POSITION(synonym IN %s) \
+                FROM bench_entities \
+                WHERE 0 < POSITION(synonym IN %s) \
+                ORDER BY weight DESC;'
+
+_BENCH_SQL_GROW = "INSERT INTO bench_entities(name, synonym, weight) \
+                SELECT '@bench', SUBSTR(MD5(g::text), 1, 2 + g %% 7), g %% 10 \
+                FROM generate_series(%s, %s) AS g;"
+
+
+def _explain(curs, sql, params, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        curs.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)
+        (plan,) = curs.fetchone()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        elapsed.append(plan[0]['Execution Time'])
+
+    nodes = []
+    stack = [plan[0]['Plan']]
+    while stack:
+        node = stack.pop()
+        if 'Scan' in node['Node Type']:
+            nodes.append(node['Node Type'])
+        stack.extend(node.get('Plans', []))
+
+    return sorted(elapsed)[len(elapsed) // 2], ','.join(sorted(set(nodes)))
+
+
+def bench_lookup(args):
+    import app
+
+    text = app.my_normalize(args.text)
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+
+    print('[Bench Lookup] text=' + text + ' length=' + str(len(text)))
+    print('  {:>8}  {:<30} {:>10}  {:<30} {:>10}  {:>10}'.format(
+        'rows', 'POSITION plan', 'ms', '= ANY plan', 'ms', 'candidates'))
+
+    with app._db_connect(statement_timeout=0) as conn:
+        with conn.cursor() as curs:
+
+            curs.execute('CREATE TEMP TABLE bench_entities \
+                (id serial, name text, synonym text, weight integer) ON COMMIT DROP;')
+            curs.execute('CREATE INDEX ON bench_entities (synonym);')
+
+            rows = 0
+            for size in sizes:
+                curs.execute(_BENCH_SQL_GROW, (rows + 1, size,))
+                curs.execute('ANALYZE bench_entities;')
+                rows = size
+
+                curs.execute('SELECT MAX(CHAR_LENGTH(synonym)) FROM bench_entities;')
+                (max_length,) = curs.fetchone()
+                candidates = app.database_lookup.candidates(text, max_length)
+
+                (position_ms, position_plan) = _explain(
+                    curs, _BENCH_SQL_POSITION, (text, text,), args.repeat)
+                (any_ms, any_plan) = _explain(
+                    curs, app.database_lookup.sql('entity', table='bench_entities'),
+                    (text, candidates,), args.repeat)
+
+                print('  {:>8}  {:<30} {:>10.3f}  {:<30} {:>10.3f}  {:>10}'.format(
+                    size, position_plan, position_ms, any_plan, any_ms, len(candidates)))
+
+            conn.rollback()
+
+    return 0
+
+
+def _top(counts, limit):
+    return ', '.join('{}={}'.format(name, count) for (name, count)
+        in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit])
+
+
+def _ms(value):
+    return '-' if value is None else '{:.0f}'.format(value * 1000)
+
+
+def analytics(args):
+    import datetime
+    import app
+
+    if args.dir:
+        app.event_store.root_dir = args.dir
+    if not app.event_store.enabled:
+        raise SystemExit('set EVENT_STORE_DIR or --dir')
+
+    if args.rebuild:
+        print('[Analytics] rebuilt summaries=' + str(app.event_store.rebuild_summaries()))
+
+    since = args.since
+    if since is None and args.days:
+        since = (datetime.date.today() - datetime.timedelta(days=args.days - 1)).isoformat()
+
+    (days, segments) = app.event_store.daily(since=since, until=args.until)
+
+    print('[Analytics] segments=' + str(segments) + ' days=' + str(len(days))
+        + ' since=' + str(since) + ' until=' + str(args.until))
+    print('  {:<10} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'day', 'events', 'avg_ms', 'p50_ms', 'p95_ms', 'max_ms'))
+
+    total = app.event_store.new_summary()
+    for day, summary in days.items():
+        app.event_store.merge_summary(total, summary)
+        latency = summary['latency']
+
+        print('  {:<10} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+            day, sum(summary['events'].values()),
+            _ms(latency['sum'] / latency['count'] if latency['count'] else None),
+            _ms(app.event_store.latency_quantile(latency, 0.5)),
+            _ms(app.event_store.latency_quantile(latency, 0.95)),
+            _ms(latency['max'] if latency['count'] else None)))
+        for field in ('intent', 'entity_exact', 'entity_partial'):
+            if summary[field]:
+                print('  {:<10} {:<15} {}'.format('', field, _top(summary[field], args.top)))
+
+    if len(days) > 1:
+        print('  {:<10} {}'.format('total', ' '.join(
+            '{}={}'.format(kind, count) for (kind, count) in sorted(total['events'].items()))))
+        for field in ('intent', 'entity_exact', 'entity_partial'):
+            if total[field]:
+                print('  {:<10} {:<15} {}'.format('', field, _top(total[field], args.top)))
+
+    return 0
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='nekobot management commands')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('coldstart', help='profile import time of app.py')
+    p.add_argument('--budget', type=float, default=1.5,
+        help='allowed median seconds for import app')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--top', type=int, default=15)
+    p.set_defaults(func=coldstart)
+
+    p = subparsers.add_parser('compact-random-values',
+        help='keep only the newest rows per category in public.random_values')
+    p.add_argument('--retention', type=int, default=None,
+        help='rows to keep in every category, overriding RANDOM_VALUES_RETENTION_CATEGORIES '
+            '(default: per-category setting, else RANDOM_VALUES_RETENTION)')
+    p.add_argument('--dry-run', action='store_true')
+    p.add_argument('--vacuum', action='store_true', help='VACUUM ANALYZE after deleting')
+    p.set_defaults(func=compact_random_values)
+
+    p = subparsers.add_parser('import-tabelog',
+        help='scrape and insert Tabelog URLs listed in a file')
+    p.add_argument('file', help="one URL per line, '-' for stdin")
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--rate', type=float, default=0.5,
+        help='max pages fetched per second')
+    p.add_argument('--dry-run', action='store_true',
+        help='only normalize and check against the table')
+    p.set_defaults(func=import_tabelog)
+
+    p = subparsers.add_parser('upload-images',
+        help='upload a local directory of images and thumbnails to S3')
+    p.add_argument('directory')
+    p.add_argument('category', help='S3 prefix such as image/neko/')
+    p.add_argument('--workers', type=int, default=8, help='upload threads')
+    p.add_argument('--thumb-workers', type=int, default=None,
+        help='thumbnail processes (default: CPU count)')
+    p.add_argument('--dry-run', action='store_true')
+    p.set_defaults(func=upload_images)
+
+    p = subparsers.add_parser('phash-backfill',
+        help='compute perceptual hashes for images already in S3')
+    p.add_argument('--prefix', default='image/')
+    p.add_argument('--workers', type=int, default=8)
+    p.set_defaults(func=phash_backfill)
+
+    p = subparsers.add_parser('build-dictionary',
+        help='write the dictionary tables to a binary file shared by mmap (DICTIONARY_FILE)')
+    p.add_argument('path')
+    p.add_argument('--s3', action='store_true',
+        help='also embed S3 image key lists (frozen until the file is rebuilt; '
+            'images uploaded afterwards are not served until then)')
+    p.set_defaults(func=build_dictionary)
+
+    p = subparsers.add_parser('loadtest',
+        help='drive /callback with signed synthetic webhooks and report per-route latency')
+    p.add_argument('--url', default=None,
+        help='POST to a running server instead of app.py in-process with stub backends')
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--rps', type=float, default=0,
+        help='open-loop target rate (default: closed loop at --concurrency)')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--events', type=int, default=1, help='events per webhook body')
+    p.add_argument('--image-ratio', type=float, default=0.1)
+    p.add_argument('--users', type=int, default=100)
+    p.add_argument('--text', action='append', help='message text (repeatable)')
+    p.add_argument('--dictionary-file', default=None,
+        help='file from build-dictionary (default: built-in fixture)')
+    p.add_argument('--db-latency', type=float, default=2, help='stub DB latency ms')
+    p.add_argument('--s3-latency', type=float, default=20, help='stub S3 latency ms')
+    p.add_argument('--line-latency', type=float, default=30, help='stub LINE API latency ms')
+    p.add_argument('--flood-control', action='store_true')
+    p.set_defaults(func=loadtest)
+
+    p = subparsers.add_parser('tabelog-reparse',
+        help='rebuild public.tabelog rows from archived HTML without fetching')
+    p.add_argument('--archive-dir', default=None,
+        help='local archive directory (default TABELOG_ARCHIVE_DIR / TABELOG_ARCHIVE_S3_PREFIX)')
+    p.add_argument('--workers', type=int, default=None,
+        help='parser processes (default: CPU count)')
+    p.add_argument('--dry-run', action='store_true')
+    p.set_defaults(func=tabelog_reparse)
+
+    p = subparsers.add_parser('bench-lookup',
+        help='compare POSITION() scans with indexed = ANY(substrings) lookups (EXPLAIN ANALYZE)')
+    p.add_argument('--text', default='今日は猫と一緒に飲みに行きたい')
+    p.add_argument('--sizes', default='100,1000,10000,100000',
+        help='dictionary sizes to grow a temporary table through')
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_lookup)
+
+    p = subparsers.add_parser('analytics',
+        help='daily intent / entity hit counts and latency from event store summaries')
+    p.add_argument('--dir', default=None, help='event store directory (default EVENT_STORE_DIR)')
+    p.add_argument('--days', type=int, default=7, help='last N days (0: all)')
+    p.add_argument('--since', default=None, help='YYYY-MM-DD')
+    p.add_argument('--until', default=None, help='YYYY-MM-DD')
+    p.add_argument('--top', type=int, default=5)
+    p.add_argument('--rebuild', action='store_true',
+        help='rebuild summaries from raw segments first')
+    p.set_defaults(func=analytics)
+
+    args = parser.parse_args(argv)
+    if not getattr(args, 'func', None):
+        parser.print_help()
+        return 2
+
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,8 @@
+-- Shared webhook de-duplication store (WEBHOOK_DEDUP_SHARED=True)
+CREATE TABLE IF NOT EXISTS public.webhook_events (
+    event_key   text PRIMARY KEY,
+    received_at timestamp with time zone NOT NULL DEFAULT current_timestamp
+);
+
+CREATE INDEX IF NOT EXISTS webhook_events_received_at_idx
+    ON public.webhook_events (received_at);
@@ -0,0 +1,46 @@
+-- Change counter for the dictionary tables.
+-- Every write to intents/entities/replies/categories bumps the counter and
+-- sends NOTIFY nekobot_dictionary so running workers rebuild their snapshot.
+CREATE TABLE IF NOT EXISTS public.dictionary_version (
+    id         integer PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version    bigint NOT NULL DEFAULT 0,
+    updated_at timestamp with time zone NOT NULL DEFAULT current_timestamp
+);
+
+INSERT INTO public.dictionary_version (id, version)
+    VALUES (1, 0)
+    ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION public.bump_dictionary_version() RETURNS trigger AS $$
+DECLARE
+    new_version bigint;
+BEGIN
+    UPDATE public.dictionary_version
+        SET version = version + 1, updated_at = current_timestamp
+        WHERE id = 1
+        RETURNING version INTO new_version;
+
+    PERFORM pg_notify('nekobot_dictionary', new_version::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS intents_dictionary_version ON public.intents;
+CREATE TRIGGER intents_dictionary_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.intents
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_dictionary_version();
+
+DROP TRIGGER IF EXISTS entities_dictionary_version ON public.entities;
+CREATE TRIGGER entities_dictionary_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.entities
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_dictionary_version();
+
+DROP TRIGGER IF EXISTS replies_dictionary_version ON public.replies;
+CREATE TRIGGER replies_dictionary_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.replies
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_dictionary_version();
+
+DROP TRIGGER IF EXISTS categories_dictionary_version ON public.categories;
+CREATE TRIGGER categories_dictionary_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.categories
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_dictionary_version();
@@ -0,0 +1,4 @@
+-- select_recent_random_values / compaction read the newest rows per category.
+-- Run outside a transaction (psql default) because of CONCURRENTLY.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS random_values_category_timestamp_idx
+    ON public.random_values (category, timestamp DESC);
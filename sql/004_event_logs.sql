@@ -0,0 +1,16 @@
+-- Persisted event log (EVENT_LOG_DB=True), written in batches by _Write_Behind.
+CREATE TABLE IF NOT EXISTS public.event_logs (
+    id             bigserial PRIMARY KEY,
+    received_at    timestamp with time zone NOT NULL,
+    kind           text NOT NULL,
+    user_id        text,
+    group_id       text,
+    room_id        text,
+    text           text,
+    intent         text,
+    entity_exact   text,
+    entity_partial text
+);
+
+CREATE INDEX IF NOT EXISTS event_logs_received_at_idx
+    ON public.event_logs (received_at);
@@ -0,0 +1,9 @@
+-- Perceptual hashes (64-bit dHash) of stored images, used to reject
+-- near-duplicate uploads. Filled by handle_image_message, upload-images
+-- and `python manage.py phash-backfill`.
+CREATE TABLE IF NOT EXISTS public.image_hashes (
+    key        text PRIMARY KEY,
+    category   text NOT NULL,
+    hash       bigint NOT NULL,
+    created_at timestamp with time zone NOT NULL DEFAULT current_timestamp
+);
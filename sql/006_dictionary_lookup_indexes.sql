@@ -0,0 +1,7 @@
+-- DICTIONARY_MODE=database probes example / synonym with = ANY(substrings of the text).
+-- Run outside a transaction (psql default) because of CONCURRENTLY.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS intents_example_idx
+    ON public.intents (example);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS entities_synonym_idx
+    ON public.entities (synonym);
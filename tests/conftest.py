@@ -0,0 +1,8 @@
+import os
+import sys
+
+# app.pyは読み込み時にLINEの設定が無いと終了するのでダミーを入れておく
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test-secret')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test-token')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
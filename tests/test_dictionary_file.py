@@ -0,0 +1,128 @@
+import pytest
+
+import app
+
+
+def make_dictionary(intents=None, entities=None):
+    dictionary = app._Dictionary(3, 42)
+    dictionary.intents = intents if intents is not None else [
+        (1, '#is_bad', 'ダメ', 10),
+        (2, '#update', '更新', -5),
+    ]
+    dictionary.entities = entities if entities is not None else [
+        (11, '@neko', 'ねこ', 1),
+        (12, '@neko', '猫', None),
+        (13, '@nomicomm', '飲み', 2 ** 31 - 1),
+    ]
+    dictionary.categories = {'@neko': ['neko/', 'neko2/']}
+    dictionary.replies = {'@neko': [('にゃー',), ('ごろごろ', 'すりすり')]}
+    return dictionary.build()
+
+
+def write(tmp_path, dictionary, s3_keys=None):
+    path = str(tmp_path / 'dictionary.bin')
+    app._Dictionary_File().write(path, dictionary, s3_keys)
+    return path
+
+
+def test_round_trip(tmp_path):
+    dictionary = make_dictionary()
+    path = write(tmp_path, dictionary, {'neko/': ['neko/a.jpg', 'neko/b.jpg']})
+
+    mapped = app._Mapped_Dictionary(path, 7)
+
+    assert mapped.version == 7
+    assert mapped.source_version == 42
+    assert mapped.built_at == dictionary.built_at
+    assert [mapped.row('intent', i) for i in range(2)] == dictionary.intents
+    assert [mapped.row('entity', i) for i in range(3)] == [
+        (11, '@neko', 'ねこ', 1),
+        (12, '@neko', '猫', 0),
+        (13, '@nomicomm', '飲み', 2 ** 31 - 1),
+    ]
+    assert mapped.get_category_names() == ['neko/', 'neko2/']
+    assert mapped.get_category('@neko') in ('neko/', 'neko2/')
+    assert mapped.get_category('@inu') == 'Unknown'
+    assert mapped.get_reply_texts('@neko')[0] == 'にゃー'
+    assert mapped.get_reply_texts('@neko')[1] in ('ごろごろ', 'すりすり')
+    assert mapped.get_s3_keys('neko/') == ['neko/a.jpg', 'neko/b.jpg']
+    assert mapped.get_s3_keys('neko2/') is None
+
+
+def test_matcher_round_trip(tmp_path):
+    dictionary = make_dictionary(entities=[
+        (11, '@neko', 'ねこ', 1),
+        (12, '@neko', '猫', 1),
+        (13, '@nomicomm', '飲み', 2),
+        (14, '@godrinking', '飲みいく', 9),
+    ])
+    mapped = app._Mapped_Dictionary(write(tmp_path, dictionary))
+
+    for text in ('ねこはダメ', '猫を更新', '飲みねこ飲みいく', 'いぬ', ''):
+        assert list(mapped.matcher.iter_matches(text)) == list(dictionary.matcher.iter_matches(text))
+
+
+def test_source_version_none(tmp_path):
+    dictionary = make_dictionary()
+    dictionary.source_version = None
+
+    assert app._Mapped_Dictionary(write(tmp_path, dictionary)).source_version is None
+
+
+@pytest.mark.parametrize('weight', [1.5, 2 ** 31, -2 ** 31 - 1, 2 ** 40, 'x'])
+def test_rejects_weight(tmp_path, weight):
+    dictionary = make_dictionary(entities=[(11, '@neko', 'ねこ', weight)])
+
+    with pytest.raises(ValueError):
+        write(tmp_path, dictionary)
+
+    # 途中まで書いたファイルは残さない
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize('weight', [2.0, -7])
+def test_accepts_integral_weight(tmp_path, weight):
+    dictionary = make_dictionary(entities=[(11, '@neko', 'ねこ', weight)])
+    mapped = app._Mapped_Dictionary(write(tmp_path, dictionary))
+
+    assert mapped.row('entity', 0)[3] == int(weight)
+
+
+def corrupt(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def test_rejects_bad_magic(tmp_path):
+    path = write(tmp_path, make_dictionary())
+    corrupt(path, 0, b'XXXXXXXX')
+
+    with pytest.raises(ValueError):
+        app._Mapped_Dictionary(path)
+
+
+def test_rejects_other_format_version(tmp_path):
+    path = write(tmp_path, make_dictionary())
+    corrupt(path, 8, (app._Dictionary_File._FORMAT_VERSION + 1).to_bytes(4, 'little'))
+
+    with pytest.raises(ValueError):
+        app._Mapped_Dictionary(path)
+
+
+def test_rejects_byte_order(tmp_path):
+    path = write(tmp_path, make_dictionary())
+    # 逆のバイトオーダーで書かれたファイルに見せかける
+    corrupt(path, 12, app._Dictionary_File._BYTE_ORDER.to_bytes(4, 'big' if app.sys.byteorder == 'little' else 'little'))
+
+    with pytest.raises(ValueError):
+        app._Mapped_Dictionary(path)
+
+
+def test_rejects_truncated(tmp_path):
+    path = write(tmp_path, make_dictionary())
+    with open(path, 'r+b') as f:
+        f.truncate(10)
+
+    with pytest.raises(Exception):
+        app._Mapped_Dictionary(path)
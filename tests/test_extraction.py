@@ -0,0 +1,88 @@
+import pytest
+
+import app
+
+
+INTENTS = [
+    (1, '#is_bad', 'ダメ', 10),
+    (2, '#is_bad', 'だめ', 10),
+    (3, '#update', '更新', 5),
+    (4, '#check_setting', '設定', 3),
+    (5, '#change_setting', '設定変更', 8),
+]
+
+ENTITIES = [
+    (11, '@neko', 'ねこ', 1),
+    (12, '@neko', '猫', 1),
+    (13, '@nomicomm', '飲み', 4),
+    (14, '@godrinking', '飲みいく', 9),
+    (15, '@kitada', 'きただ', 2),
+    (16, '@thumb', 'サムネ', 6),
+    (17, '@access_management', 'アクセス管理', 6),
+]
+
+TEXTS = [
+    'ねこ',
+    '猫',
+    'ねこはダメ',
+    'きただはだめ',
+    '飲みいく',
+    '今日は飲みいく？飲み',
+    'サムネ更新',
+    'アクセス管理設定変更',
+    'アクセス管理の設定',
+    'ねこねこ猫',
+    'いぬ',
+    '',
+]
+
+
+def baseline_select(rows, text, exact):
+    # 元のSQLと同じ条件で、同じweightは出現位置・idの順に並べる
+    #   WHERE example = %s / WHERE 0 < POSITION(example IN %s) ORDER BY weight DESC
+    hits = []
+    for (row_id, name, pattern, weight) in rows:
+        position = text.find(pattern) + 1
+        if (pattern == text) if exact else (0 < position):
+            hits.append((-weight, position, row_id, name))
+
+    if not hits:
+        return None
+
+    (weight, position, row_id, name) = min(hits)
+    return (row_id, name, -weight, position)
+
+
+def extract(text):
+    dictionary = app._Dictionary()
+    dictionary.intents = list(INTENTS)
+    dictionary.entities = list(ENTITIES)
+    dictionary.build()
+    return app.Extraction(text, dictionary).extract()
+
+
+def picked(target):
+    if not target.match:
+        return None
+    return (target.id, target.name, target.weight, target.position)
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_matches_sql_position(text):
+    extraction = extract(text)
+
+    assert picked(extraction.intent) == baseline_select(INTENTS, text, False)
+    assert picked(extraction.entity_partial) == baseline_select(ENTITIES, text, False)
+    assert picked(extraction.entity_exact) == baseline_select(ENTITIES, text, True)
+
+
+def test_all_hits_are_positions():
+    extraction = extract('ねこねこ猫')
+
+    assert [(hit.id, hit.position) for hit in extraction.entities] == [(11, 1), (11, 3), (12, 5)]
+
+
+def test_overlapping_patterns():
+    matcher = app._Matcher().add('he', 'he').add('she', 'she').add('hers', 'hers').build()
+
+    assert sorted(matcher.iter_matches('ushers')) == [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')]
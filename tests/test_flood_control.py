@@ -0,0 +1,66 @@
+import types
+
+import app
+
+
+def event(user_id, group_id=None):
+    if group_id is None:
+        source = app.SourceUser(user_id=user_id)
+    else:
+        source = app.SourceGroup(group_id=group_id, user_id=user_id)
+    return types.SimpleNamespace(source=source)
+
+
+def test_token_bucket():
+    bucket = app._Token_Bucket(rate=1.0, burst=2)
+    now = bucket.updated
+
+    assert bucket.take(now)
+    assert bucket.take(now)
+    assert not bucket.take(now)
+    assert not bucket.take(now + 0.5)
+    assert bucket.take(now + 1.0)
+    # 溜まるのはburstまで
+    assert bucket.take(now + 100)
+    assert bucket.take(now + 100)
+    assert not bucket.take(now + 100)
+
+
+def test_disabled():
+    flood_control = app._Flood_Control(False, rate=0.001, burst=1)
+
+    for _ in range(5):
+        assert flood_control.allow(event('u1'))
+        assert not flood_control.coalesce(event('u1'), 'にゃー')
+        assert flood_control.allow_admin(event('u1'), '#update')
+
+
+def test_allow_per_sender():
+    flood_control = app._Flood_Control(True, rate=0.001, burst=2)
+
+    assert flood_control.allow(event('u1', 'g1'))
+    assert flood_control.allow(event('u1', 'g1'))
+    assert not flood_control.allow(event('u1', 'g1'))
+
+    # 同じグループの別の人や、別のグループの同じ人は数えない
+    assert flood_control.allow(event('u2', 'g1'))
+    assert flood_control.allow(event('u1', 'g2'))
+    assert flood_control.allow(event('u1'))
+
+
+def test_coalesce_per_sender():
+    flood_control = app._Flood_Control(True, coalesce_window=60)
+
+    assert not flood_control.coalesce(event('u1', 'g1'), 'にゃー')
+    assert flood_control.coalesce(event('u1', 'g1'), 'にゃー')
+    assert not flood_control.coalesce(event('u1', 'g1'), 'わん')
+    assert not flood_control.coalesce(event('u2', 'g1'), 'にゃー')
+
+
+def test_admin_per_source():
+    flood_control = app._Flood_Control(True, admin_rate=0.001, admin_burst=1)
+
+    assert flood_control.allow_admin(event('u1', 'g1'), '#update')
+    assert not flood_control.allow_admin(event('u2', 'g1'), '#update')
+    assert flood_control.allow_admin(event('u1', 'g1'), '#check_setting')
+    assert flood_control.allow_admin(event('u1', 'g2'), '#update')
@@ -0,0 +1,51 @@
+import random
+
+import app
+
+
+def brute_force(values, value, max_distance):
+    found = []
+    for (key, other) in values.items():
+        distance = app._hamming_distance(value, other)
+        if distance <= max_distance:
+            found.append((distance, key))
+    return sorted(found)
+
+
+def test_empty():
+    assert app._BK_Tree().search(0, 64) == []
+
+
+def test_nearest_within_distance():
+    tree = app._BK_Tree()
+    tree.add(0b0000, 'a')
+    tree.add(0b0001, 'b')
+    tree.add(0b0011, 'c')
+    tree.add(0b1111, 'd')
+
+    assert tree.size == 4
+    assert tree.search(0b0000, 0) == [(0, 'a')]
+    assert tree.search(0b0000, 1) == [(0, 'a'), (1, 'b')]
+    assert tree.search(0b0111, 1) == [(1, 'c'), (1, 'd')]
+    assert tree.search(0b10000000, 0) == []
+
+
+def test_same_as_brute_force():
+    rnd = random.Random(0)
+    base = [rnd.getrandbits(64) for _ in range(20)]
+
+    values = {}
+    for i in range(500):
+        # 近い値がまとまってできるように元の値のビットを少しだけ反転させる
+        value = base[i % len(base)]
+        for _ in range(rnd.randrange(12)):
+            value ^= 1 << rnd.randrange(64)
+        values['key' + str(i)] = value
+
+    tree = app._BK_Tree()
+    for (key, value) in values.items():
+        tree.add(value, key)
+
+    for value in base + [rnd.getrandbits(64) for _ in range(20)]:
+        for max_distance in (0, 4, 10):
+            assert tree.search(value, max_distance) == brute_force(values, value, max_distance)
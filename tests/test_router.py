@@ -0,0 +1,149 @@
+import itertools
+import types
+
+import pytest
+
+import app
+
+
+def baseline_route(ctx, attempt):
+    # 元の handle_text_message の if/elif の並びをそのまま写したもの
+    exact = ctx.entity_exact
+    intent = ctx.intent
+    partial = ctx.entity_partial
+
+    if exact.match:
+        if exact.name in {'@gatarou', '@ghost'}:
+            if attempt('exact:special'):
+                return 'exact:special'
+        elif exact.name in {'@godrinking'}:
+            if attempt('exact:godrinking'):
+                return 'exact:godrinking'
+        elif exact.name.startswith('@tabelog_'):
+            if attempt('exact:tabelog_exact'):
+                return 'exact:tabelog_exact'
+        elif exact.name in {'@dog'}:
+            if attempt('exact:dog'):
+                return 'exact:dog'
+        elif partial.name in {'@nomicomm'}:
+            if attempt('exact:nomicomm_exact'):
+                return 'exact:nomicomm_exact'
+        else:
+            if attempt('exact:text_image'):
+                return 'exact:text_image'
+
+    if intent.match:
+        for (names, route) in (
+                ({'#is_bad', '#bad_is'}, 'intent:is_bad'),
+                ({'#change_setting'}, 'intent:change_setting'),
+                ({'#change_setting_on'}, 'intent:change_setting_on'),
+                ({'#change_setting_off'}, 'intent:change_setting_off'),
+                ({'#change_upload_target'}, 'intent:change_upload_target'),
+                ({'#check_setting'}, 'intent:check_setting'),
+                ({'#update'}, 'intent:update')):
+            if intent.name in names:
+                if attempt(route):
+                    return route
+                break
+
+    if partial.match:
+        if partial.name in {'@nomicomm'}:
+            if attempt('partial:nomicomm_partial'):
+                return 'partial:nomicomm_partial'
+        elif partial.name.startswith('@tabelog_'):
+            if attempt('partial:tabelog_partial'):
+                return 'partial:tabelog_partial'
+
+    if ctx.message_pattern == 'test':
+        if attempt('pattern:test'):
+            return 'pattern:test'
+
+    if attempt('fallback:tabelog_link'):
+        return 'fallback:tabelog_link'
+
+    return None
+
+
+def stub_router(attempt):
+    # 本物のルールの並びと条件だけを使い、処理は差し替える
+    router = app._Text_Router()
+    for rule in app.text_router._rules:
+        action = (lambda name: lambda ctx: attempt(name))(rule.name)
+        action.__name__ = rule.action.__name__
+        router.rule(rule.stage, **rule.keys)(action)
+    return router.compile()
+
+
+def target(name):
+    return types.SimpleNamespace(match=name is not None, name=name)
+
+
+EXACTS = [None, '@gatarou', '@godrinking', '@tabelog_1', '@dog', '@neko']
+INTENTS = [None, '#is_bad', '#bad_is', '#change_setting', '#change_setting_on', '#change_setting_off',
+    '#change_upload_target', '#check_setting', '#update', '#unknown']
+PARTIALS = [None, '@nomicomm', '@tabelog_2', '@yoshi']
+PATTERNS = ['', 'test']
+
+
+def cases():
+    for (exact, intent, partial, pattern) in itertools.product(EXACTS, INTENTS, PARTIALS, PATTERNS):
+        yield types.SimpleNamespace(
+            entity_exact=target(exact), intent=target(intent),
+            entity_partial=target(partial), message_pattern=pattern, route='')
+
+
+def test_rule_names():
+    names = {rule.name for rule in app.text_router._rules}
+
+    tried = []
+    for ctx in cases():
+        baseline_route(ctx, lambda name: tried.append(name))
+
+    assert names == set(tried)
+
+
+@pytest.mark.parametrize('declined', [
+    set(),
+    {'exact:godrinking', 'exact:tabelog_exact', 'exact:text_image'},
+    {'intent:update', 'intent:change_setting_off', 'intent:is_bad'},
+    {'partial:tabelog_partial', 'pattern:test'},
+    {'exact:text_image', 'intent:update', 'partial:tabelog_partial', 'pattern:test', 'fallback:tabelog_link'},
+])
+def test_same_order_as_baseline(declined):
+    for ctx in cases():
+        expected_tried = []
+        expected = baseline_route(ctx,
+            lambda name: expected_tried.append(name) or name not in declined)
+
+        tried = []
+        router = stub_router(lambda name: tried.append(name) or name not in declined)
+
+        assert router.dispatch(ctx) == expected
+        assert tried == expected_tried
+
+
+def test_first_registered_rule_wins():
+    def _route_prefix(ctx):
+        return True
+
+    def _route_name(ctx):
+        return True
+
+    router = app._Text_Router()
+    router.rule('exact', entity_prefix='@tabelog_')(_route_prefix)
+    router.rule('exact', entity='@tabelog_x')(_route_name)
+
+    ctx = types.SimpleNamespace(
+        entity_exact=target('@tabelog_x'), intent=target(None),
+        entity_partial=target(None), message_pattern='', route='')
+
+    assert router.dispatch(ctx) == 'exact:prefix'
+    assert ctx.route == 'exact:prefix'
+
+
+def test_unknown_key():
+    router = app._Text_Router()
+    router.rule('intent', entity='@neko')(lambda ctx: True)
+
+    with pytest.raises(ValueError):
+        router.compile()
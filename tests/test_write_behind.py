@@ -0,0 +1,106 @@
+import psycopg2
+
+import app
+
+
+class Writer:
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.written = []
+
+    def __call__(self, name, values):
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        self.written.append((name, list(values)))
+
+
+def counter(name):
+    return app.metrics.snapshot()['counters'].get(name, 0)
+
+
+def make(writer, max_pending=100):
+    # 自動のフラッシュは走らせずにテストから flush を呼ぶ
+    write_behind = app._Write_Behind(True, max_rows=1000, flush_second=3600, max_pending=max_pending)
+    write_behind.register('a', 'INSERT INTO a VALUES %s;')
+    write_behind.register('b', 'INSERT INTO b VALUES %s;')
+    write_behind._write = writer
+    return write_behind
+
+
+def test_flush():
+    writer = Writer()
+    write_behind = make(writer)
+
+    write_behind.append('a', (1,))
+    write_behind.append('b', (2,))
+    write_behind.append('a', (3,))
+    assert write_behind.pending_rows('a') == [(1,), (3,)]
+
+    assert write_behind.flush() == 3
+    assert writer.written == [('a', [(1,), (3,)]), ('b', [(2,)])]
+    assert write_behind.pending_rows('a') == []
+    assert write_behind.flush() == 0
+
+
+def test_retry_on_operational_error():
+    writer = Writer(psycopg2.OperationalError('connection lost'))
+    write_behind = make(writer)
+
+    write_behind.append('a', (1,))
+    write_behind.append('b', (2,))
+
+    # aは戻され、bはそのまま書かれる
+    assert write_behind.flush() == 1
+    assert writer.written == [('b', [(2,)])]
+    assert write_behind.pending_rows('a') == [(1,)]
+
+    write_behind.append('a', (3,))
+    assert write_behind.flush() == 2
+    assert writer.written[-1] == ('a', [(1,), (3,)])
+
+
+def test_drop_on_other_error():
+    writer = Writer(psycopg2.ProgrammingError('relation "a" does not exist'))
+    write_behind = make(writer)
+    dropped = counter('write_behind.dropped')
+
+    write_behind.append('a', (1,))
+    write_behind.append('a', (2,))
+    write_behind.append('b', (3,))
+
+    assert write_behind.flush() == 1
+    assert writer.written == [('b', [(3,)])]
+    assert write_behind.pending_rows('a') == []
+    assert counter('write_behind.dropped') == dropped + 2
+
+
+def test_drop_when_full():
+    writer = Writer(psycopg2.OperationalError('connection lost'))
+    write_behind = make(writer, max_pending=2)
+    dropped = counter('write_behind.dropped')
+
+    assert write_behind.append('a', (1,))
+    assert write_behind.append('a', (2,))
+    assert not write_behind.append('a', (3,))
+    assert counter('write_behind.dropped') == dropped + 1
+
+    # 書けなかった行を戻す間に入った行の分だけ溢れる
+    write_behind._write = lambda name, values: (write_behind.append('b', (4,)), writer(name, values))
+    assert write_behind.flush() == 0
+    assert write_behind.pending_rows('a') == [(1,)]
+    assert write_behind.pending_rows('b') == [(4,)]
+    assert counter('write_behind.dropped') == dropped + 2
+
+
+def test_close():
+    writer = Writer()
+    write_behind = make(writer)
+
+    write_behind.append('a', (1,))
+    write_behind.close()
+
+    assert writer.written == [('a', [(1,)])]
+    assert not write_behind.append('a', (2,))